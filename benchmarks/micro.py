@@ -0,0 +1,161 @@
+""" Microbenchmarks of the hot paths: reading recordings, spectrograms, rendering, converting model results and tidying detections, on deterministic synthetic data (see synthetic.py).
+    Results are stored as JSON, so the results of two commits can be compared:
+
+        python -m benchmarks.micro --output before.json
+        python -m benchmarks.micro --output after.json --compare before.json
+"""
+import argparse
+import fnmatch
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from types import SimpleNamespace
+import numpy as np
+from benchmarks.synthetic import synthetic_audio, write_synthetic_wav, synthetic_detections
+from source.misc import read_clean_wav, highpass_normalise
+from source.predict import predict_sono
+from source.postprocess import overlap_tidy
+import source.visualise as vis
+
+SAMPLE_RATES = (250_000, 384_000, 500_000)
+DURATIONS = (1, 10, 60) # Seconds of the recordings that are read
+CHANNELS = (1, 2)
+DETECTION_ROWS = (1_000, 10_000, 100_000, 1_000_000) # Rows of the detection tables that are tidied
+RENDERERS = ("lut", "direct")
+TOLERANCE = 0.1 # Benchmarks that are more than 10% slower or faster are flagged by compare
+
+""" Helpers that mimic the YOLO-like objects (see test/predict_test.py): every image gets the same boxes """
+class DummyBoxes:
+    def __init__(self, n, rng):
+        x = rng.uniform(0, 1100, n)
+        y = rng.uniform(0, 300, n)
+        self.xyxy = np.stack([x, y, x + rng.uniform(20, 180, n), y + rng.uniform(20, 100, n)], axis=1).astype(np.float32)
+        self.cls = rng.integers(0, 3, n).astype(np.float32)
+        self.conf = rng.uniform(0.1, 1, n).astype(np.float32)
+    def __len__(self):
+        return len(self.xyxy)
+
+class DummyModel:
+    def __init__(self, n_images, n_boxes, seed=0):
+        rng = np.random.default_rng(seed)
+        self._results = [SimpleNamespace(boxes=DummyBoxes(n_boxes, rng), orig_shape=vis.IMG_SIZE[::-1], names={0: "Feeding buzz", 1: "Social call", 2: "Other"}) for _ in range(n_images)]
+    def to(self, device):
+        pass
+    def predict(self, *, source, save, verbose, device, conf, iou):
+        return self._results[:len(source)]
+
+""" Benchmarks as (name, function to time). Synthetic data is made when a benchmark is selected. quick only runs the shortest recordings and smaller tables """
+def benchmarks(tmp_dir, quick=False):
+    durations = DURATIONS[:1] if quick else DURATIONS
+    channels = CHANNELS[:1] if quick else CHANNELS
+    rows = DETECTION_ROWS[:2] if quick else DETECTION_ROWS
+
+    for fs in SAMPLE_RATES:
+        for duration in durations:
+            for n_channels in channels:
+                def setup(fs=fs, duration=duration, n_channels=n_channels):
+                    path = write_synthetic_wav(os.path.join(tmp_dir, f"bench_{fs}_{duration}_{n_channels}.wav"), fs=fs, duration=duration, channels=n_channels)
+                    return lambda: read_clean_wav(path)
+                yield f"read_clean_wav[fs={fs},duration={duration},channels={n_channels}]", setup
+
+    for fs in SAMPLE_RATES:
+        def setup(fs=fs):
+            segment = highpass_normalise(synthetic_audio(fs=fs, duration=1), fs)
+            return lambda: vis.create_spectrogram_data(segment, fs=fs, magn_weight=0, segment_duration=1)
+        yield f"create_spectrogram_data[fs={fs}]", setup
+
+        for renderer in RENDERERS:
+            def setup(fs=fs, renderer=renderer):
+                segment = highpass_normalise(synthetic_audio(fs=fs, duration=1), fs)
+                return lambda: vis.viz_audio_segment(segment, fs=fs, folder_struc=".", filename_original="bench", segment_duration=1, segment_number=1, time_img=[0, 1000],
+                                                     colour_scale="jet", write_plot=False, magn_weight=0, draw_freq_lines=True, renderer=renderer)
+            yield f"viz_audio_segment[fs={fs},renderer={renderer}]", setup
+
+    for n_images, n_boxes in [(64, 0), (64, 10), (64, 100)]:
+        def setup(n_images=n_images, n_boxes=n_boxes):
+            model = DummyModel(n_images, n_boxes)
+            images = [np.zeros((1, 1, 3), dtype=np.uint8)] * n_images
+            filenames = [f"bench_{i * 700}_{i * 700 + 1000}.png" for i in range(n_images)]
+            return lambda: predict_sono(model, images, filenames, "/data/bench.wav")
+        yield f"predict_sono[images={n_images},boxes={n_boxes}]", setup
+
+    for n_rows in rows:
+        def setup(n_rows=n_rows):
+            df = synthetic_detections(n_rows)
+            return lambda: overlap_tidy(df, threshold=5)
+        yield f"overlap_tidy[rows={n_rows}]", setup
+
+""" Seconds per call of func: the fastest, median and mean of repeat runs of as many calls as take at least 0.2 seconds """
+def measure(func, repeat=5):
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    times = np.array(timer.repeat(repeat=repeat, number=number)) / number
+
+    return {"min": float(times.min()), "median": float(np.median(times)), "mean": float(times.mean()), "calls": number, "repeat": repeat}
+
+""" Commit, versions and computer the benchmarks run on """
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(__file__)).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    import scipy, pandas, torch
+    return {"commit": commit, "time": time.strftime("%Y-%m-%d %H:%M:%S"), "python": platform.python_version(), "numpy": np.__version__, "scipy": scipy.__version__,
+            "pandas": pandas.__version__, "torch": torch.__version__, "platform": platform.platform(), "processor": platform.processor(), "cpus": os.cpu_count()}
+
+""" Runs the benchmarks whose names are in select or match one of its patterns (all when None) and returns the results as {"environment": ..., "results": {name: seconds per call}} """
+def run(select=None, quick=False, repeat=5, verbose=True):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, setup in benchmarks(tmp_dir, quick=quick):
+            if select and not any(name == pattern or fnmatch.fnmatchcase(name, pattern) for pattern in select): continue # Names contain [], which fnmatch reads as a set of characters
+
+            results[name] = measure(setup(), repeat=repeat)
+            if verbose: print(f"{name:60s} {results[name]['min'] * 1000:10.3f} ms")
+
+    return {"environment": environment(), "results": results}
+
+""" Compares results with baseline results (see run) by the fastest time per call. Returns a row per benchmark in both: baseline and current seconds, ratio (current / baseline) and "slower" or "faster" when the ratio is more than tolerance away from 1 """
+def compare(baseline, results, tolerance=TOLERANCE):
+    rows = []
+    for name, result in results["results"].items():
+        if name not in baseline["results"]: continue
+
+        ratio = result["min"] / baseline["results"][name]["min"]
+        flag = "slower" if ratio > 1 + tolerance else "faster" if ratio < 1 - tolerance else ""
+        rows.append({"name": name, "baseline": baseline["results"][name]["min"], "current": result["min"], "ratio": ratio, "flag": flag})
+
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the hot paths on synthetic data")
+    parser.add_argument("--output", help="JSON file to store the results in")
+    parser.add_argument("--compare", help="JSON file with results to compare with (e.g. of another commit)")
+    parser.add_argument("--select", nargs="*", help="Only run the benchmarks that match these patterns, e.g. 'overlap_tidy*'")
+    parser.add_argument("--quick", action="store_true", help="Only the shortest recordings and smaller detection tables")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    results = run(select=args.select, quick=args.quick, repeat=args.repeat)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+
+        print(f"\nCompared with {args.compare} (commit {baseline['environment'].get('commit')}):")
+        for row in compare(baseline, results, tolerance=args.tolerance):
+            print(f"{row['name']:60s} {row['baseline'] * 1000:10.3f} -> {row['current'] * 1000:10.3f} ms  x{row['ratio']:.2f} {row['flag']}")
+
+        sys.exit(1 if any(row["flag"] == "slower" for row in compare(baseline, results, tolerance=args.tolerance)) else 0)
@@ -0,0 +1,73 @@
+import os
+import numpy as np
+import pandas as pd
+from scipy.io import wavfile
+
+CATEGORIES = ("Feeding buzz", "Social call", "Other") # Categories of the synthetic detections
+
+""" Deterministic synthetic recording (int16, samples x channels, or samples when channels is 1): background noise with ultrasonic search calls (downward FM chirps) and buzz-like pulse trains.
+    The same seed, sample rate, duration and channels always give the same samples """
+def synthetic_audio(fs=250_000, duration=1.0, channels=1, seed=0):
+    rng = np.random.default_rng(seed)
+    n = int(round(fs * duration))
+    nyquist = fs / 2
+    audio = 0.02 * rng.standard_normal((n, channels)).astype(np.float32)
+
+    # Search calls: 4 ms chirps from 80 to 30 kHz every 80-120 ms
+    call_samples = int(0.004 * fs)
+    t = np.arange(call_samples) / fs
+    f_start, f_end = min(80_000, 0.9 * nyquist), 30_000
+    phase = 2 * np.pi * (f_start * t + (f_end - f_start) / (2 * t[-1]) * t**2)
+    chirp = (np.sin(phase) * np.hanning(call_samples)).astype(np.float32)
+
+    start = int(rng.uniform(0, 0.05) * fs)
+    while start + call_samples < n:
+        audio[start:start + call_samples] += rng.uniform(0.2, 0.8) * chirp[:, None] * rng.uniform(0.5, 1, channels)
+        start += int(rng.uniform(0.08, 0.12) * fs)
+
+    # Feeding buzzes: trains of 1 ms pulses at 150-200 Hz, lasting 200-400 ms, once per second
+    pulse_samples = int(0.001 * fs)
+    pulse_t = np.arange(pulse_samples) / fs
+    pulse = (np.sin(2 * np.pi * 40_000 * pulse_t) * np.hanning(pulse_samples)).astype(np.float32)
+    for second in range(int(np.ceil(duration))):
+        buzz_start = int((second + rng.uniform(0.1, 0.5)) * fs)
+        interval = int(fs / rng.uniform(150, 200))
+        buzz_end = min(buzz_start + int(rng.uniform(0.2, 0.4) * fs), n - pulse_samples)
+        for pulse_start in range(buzz_start, buzz_end, interval):
+            audio[pulse_start:pulse_start + pulse_samples] += 0.5 * pulse[:, None]
+
+    audio = (np.clip(audio, -1, 1) * 32767).astype(np.int16)
+
+    return audio[:, 0] if channels == 1 else audio
+
+""" Writes a synthetic recording (see synthetic_audio) to path and returns the path """
+def write_synthetic_wav(path, fs=250_000, duration=1.0, channels=1, seed=0):
+    wavfile.write(path, fs, synthetic_audio(fs=fs, duration=duration, channels=channels, seed=seed))
+    return path
+
+""" Writes a corpus of n_dirs dirs with n_files synthetic recordings each in root (every recording has its own seed) and returns the paths of the recordings per dir """
+def synthetic_corpus(root, n_dirs=2, n_files=4, fs=250_000, duration=1.0, channels=1, seed=0):
+    corpus = {}
+    for d in range(n_dirs):
+        dir = os.path.join(root, f"station_{d:02d}")
+        os.makedirs(dir, exist_ok=True)
+        corpus[dir] = [write_synthetic_wav(os.path.join(dir, f"rec_{d:02d}_{f:04d}.wav"), fs=fs, duration=duration, channels=channels, seed=seed + d * n_files + f) for f in range(n_files)]
+
+    return corpus
+
+""" Deterministic table of n_rows detections (output columns, see predict.COLUMNS) spread over recordings of 30 s, with calls that start or end at about the same time (within a few ms) like the raw output of overlapping segments """
+def synthetic_detections(n_rows, rows_per_file=500, seed=0):
+    rng = np.random.default_rng(seed)
+    n_files = max(n_rows // rows_per_file, 1)
+    file = rng.integers(0, n_files, n_rows)
+    start = rng.integers(0, 300, n_rows) * 100 + rng.integers(0, 8, n_rows) # Calls every 100 ms, detected a few ms apart
+    filename = pd.Categorical.from_codes(file, [f"rec_{i:06d}.wav" for i in range(n_files)])
+
+    return pd.DataFrame({"filename": filename,
+                         "filepath": pd.Categorical.from_codes(file, [f"/data/rec_{i:06d}.wav" for i in range(n_files)]),
+                         "category": pd.Categorical.from_codes(rng.integers(0, len(CATEGORIES), n_rows), CATEGORIES),
+                         "confidence": rng.uniform(0.1, 1, n_rows),
+                         "start_time_ms": start,
+                         "end_time_ms": start + rng.integers(30, 60, n_rows),
+                         "freq_min": rng.integers(20, 40, n_rows),
+                         "freq_max": rng.integers(60, 100, n_rows)})
@@ -0,0 +1,220 @@
+""" End-to-end throughput of main.main on a synthetic corpus (see synthetic.py): recordings and segments per second, peak memory and wall time per stage, for a grid of proc, overlap and files_per_batch.
+    Compares the results with a baseline (baseline.json next to this file by default) and flags configurations that are more than a tolerance slower or use more memory:
+
+        python -m benchmarks.throughput                          # Stub model (untrained, finds boxes in every segment)
+        python -m benchmarks.throughput --model model/0016_best.pt --proc 4 8 --overlap 0.3
+        python -m benchmarks.throughput --update-baseline        # Store the results as the new baseline
+"""
+import argparse
+import contextlib
+import glob
+import io
+import itertools
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import psutil
+from benchmarks.synthetic import synthetic_corpus
+from benchmarks.micro import environment
+from source.misc import find_wav_files, load_wav
+from source.predict import iter_recording_images, predict_images, results_to_block, segment_count
+from source.workers import get_model
+from source.writer import tidy_blocks
+import main
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+GRID = {"proc": (1, 2), "overlap": (0, 0.3), "files_per_batch": (4, 5_000)} # Configurations that are run by default (every combination)
+CORPUS = {"n_dirs": 2, "n_files": 8, "fs": 384_000, "duration": 5, "channels": 1} # Synthetic corpus: dirs x recordings per dir, sample rate, seconds and channels of every recording
+PROFILE_FILES = 4 # Recordings that the stages are timed on (in this process)
+REPEAT = 3 # Runs of every configuration, the fastest is kept (like micro.measure)
+TOLERANCE = 0.2 # Configurations with more than 20% fewer recordings per second or more peak memory than the baseline are flagged
+
+""" Untrained YOLOv8n model saved at path that finds boxes in every segment (like test/onnx_backend_test.py), so the writer and tidying get work too. Returns the path """
+def stub_model(path):
+    import torch
+    from ultralytics import YOLO
+    torch.manual_seed(0)
+    model = YOLO("yolov8n.yaml", verbose=False)
+    for head in model.model.model[-1].cv3: # Confidences above predict.CONF
+        torch.nn.init.constant_(head[-1].bias, -0.5)
+    model.save(path)
+
+    return path
+
+""" Starts a thread that samples the memory (RSS) of this process and its child processes together every interval seconds. stop_memory_monitor returns the highest sample in MB """
+def start_memory_monitor(interval=0.05):
+    monitor = {"stop": threading.Event(), "peak": 0}
+
+    def sample():
+        process = psutil.Process()
+        while True:
+            rss = 0
+            for p in [process] + process.children(recursive=True):
+                try:
+                    rss += p.memory_info().rss
+                except (psutil.NoSuchProcess, psutil.AccessDenied):
+                    continue
+            monitor["peak"] = max(monitor["peak"], rss)
+            if monitor["stop"].wait(interval): return
+
+    monitor["thread"] = threading.Thread(target=sample, daemon=True)
+    monitor["thread"].start()
+
+    return monitor
+
+""" Stops a memory monitor (see start_memory_monitor) and returns its peak in MB """
+def stop_memory_monitor(monitor):
+    monitor["stop"].set()
+    monitor["thread"].join()
+
+    return monitor["peak"] / 1024**2
+
+""" Number of segments (spectrograms) of the recordings with overlap (see predict.iter_recording_images) """
+def count_segments(wav_files, overlap, output_size=1):
+    segments = 0
+    for wav_file in wav_files:
+        fs, audio = load_wav(wav_file, mmap=True)
+        segment_samples = int(round(output_size * fs, 0))
+        segments += segment_count(len(audio), segment_samples, segment_samples - int(round(overlap * fs, 0)))
+
+    return segments
+
+""" Seconds per recording of the stages of the analysis of a recording, timed one after the other in this process: read (and filter), render (spectrogram images), predict (model and converting its results) and tidy (overlap_tidy of the detections) """
+def profile_stages(wav_files, model_path, overlap):
+    model = get_model(model_path)
+    predict_images(model, next(iter_recording_images(wav_files[0], overlap=overlap))[:1]) # Warm up
+    stages = {"read": 0.0, "render": 0.0, "predict": 0.0, "tidy": 0.0}
+
+    for wav_file in wav_files:
+        start = time.perf_counter()
+        images = iter_recording_images(wav_file, overlap=overlap) # Reads the recording, the images are rendered when iterated
+        stages["read"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        img_array, filenames, offsets = zip(*images)
+        stages["render"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        block = results_to_block(predict_images(model, list(img_array)), filenames, wav_file, offsets=offsets)
+        stages["predict"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        tidy_blocks([block])
+        stages["tidy"] += time.perf_counter() - start
+
+    return {stage: seconds / len(wav_files) for stage, seconds in stages.items()}
+
+""" Name of a configuration in the results """
+def config_name(proc, overlap, files_per_batch):
+    return f"proc={proc},overlap={overlap},files_per_batch={files_per_batch}"
+
+""" Runs main.main repeat times on the recordings in root with a configuration and returns the wall time of the fastest run, its recordings and segments per second, and the highest peak memory of the runs. The output files are removed after every run """
+def run_main(root, model_path, wav_files, segments, proc, overlap, files_per_batch, repeat=REPEAT, verbose=False, **kwargs):
+    wall, peak = float("inf"), 0
+    for _ in range(repeat):
+        monitor = start_memory_monitor()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(sys.stdout if verbose else io.StringIO()):
+            main.main(root, log_path=False, model_path=model_path, proc=proc, overlap=overlap, files_per_batch=files_per_batch, **kwargs)
+        wall = min(wall, time.perf_counter() - start)
+        peak = max(peak, stop_memory_monitor(monitor))
+
+        for output in glob.glob(os.path.join(root, "*", "output_*")):
+            os.remove(output)
+
+    return {"proc": proc, "overlap": overlap, "files_per_batch": files_per_batch, "files": len(wav_files), "segments": segments,
+            "wall_s": wall, "files_per_s": len(wav_files) / wall, "segments_per_s": segments / wall, "peak_rss_mb": peak}
+
+""" Generates the synthetic corpus, times the stages and runs main.main for every combination in grid. Returns {"environment", "corpus", "stages", "results": {configuration: result}} (see run_main).
+    Without model_path the stub model is used (see stub_model). kwargs are passed to main.main """
+def run(grid=GRID, corpus=CORPUS, model_path=None, repeat=REPEAT, verbose=True, **kwargs):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root = os.path.join(tmp_dir, "corpus")
+        synthetic_corpus(root, **corpus)
+        model = model_path or "stub"
+        model_path = os.path.abspath(model_path) if model_path else stub_model(os.path.join(tmp_dir, "stub.pt"))
+
+        start = time.perf_counter()
+        wav_files = [f for files in find_wav_files(root).values() for f, _ in files]
+        stages = {"discover": time.perf_counter() - start}
+
+        for overlap in grid["overlap"]:
+            stages[f"overlap={overlap}"] = profile_stages(wav_files[:PROFILE_FILES], model_path, overlap)
+            if verbose: print(f"Stages (s per recording) with overlap {overlap}: " + ", ".join(f"{stage} {seconds:.3f}" for stage, seconds in stages[f"overlap={overlap}"].items()))
+
+        for proc, overlap, files_per_batch in itertools.product(grid["proc"], grid["overlap"], grid["files_per_batch"]):
+            name = config_name(proc, overlap, files_per_batch)
+            results[name] = run_main(root, model_path, wav_files, count_segments(wav_files, overlap), proc, overlap, files_per_batch, repeat=repeat, **kwargs)
+            if verbose: print(f"{name:50s} {results[name]['files_per_s']:8.2f} files/s {results[name]['segments_per_s']:8.1f} segments/s {results[name]['peak_rss_mb']:8.0f} MB {results[name]['wall_s']:8.1f} s")
+
+    return {"environment": environment(), "corpus": corpus, "model": model, "stages": stages, "results": results}
+
+""" Reason why results can't be compared with baseline results (see run): another corpus, model or number of CPUs (throughput depends on the CPUs and proc). None when they can be compared """
+def not_comparable(baseline, results):
+    for key, name in [("corpus", "corpus"), ("model", "model")]:
+        if baseline[key] != results[key]: return f"was measured on another {name}"
+
+    if baseline["environment"].get("cpus") != results["environment"].get("cpus"):
+        return f"was measured on {baseline['environment'].get('cpus')} CPUs, this computer has {results['environment'].get('cpus')} (store a baseline for this computer with --update-baseline)"
+
+    return None
+
+""" Compares results with baseline results (see run). Returns a row per configuration in both with the ratios (current / baseline) of recordings per second and peak memory,
+    flagged "slower", "faster" and/or "more memory" when they are more than tolerance away from 1 """
+def compare(baseline, results, tolerance=TOLERANCE):
+    rows = []
+    for name, result in results["results"].items():
+        if name not in baseline["results"]: continue
+
+        speed = result["files_per_s"] / baseline["results"][name]["files_per_s"]
+        memory = result["peak_rss_mb"] / baseline["results"][name]["peak_rss_mb"]
+        flags = ["slower" if speed < 1 - tolerance else "faster" if speed > 1 + tolerance else "", "more memory" if memory > 1 + tolerance else ""]
+        rows.append({"name": name, "speed": speed, "memory": memory, "flag": " ".join(f for f in flags if f)})
+
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end throughput of main.main on a synthetic corpus")
+    parser.add_argument("--model", help="Model to analyse with (default: untrained stub model)")
+    parser.add_argument("--dirs", type=int, default=CORPUS["n_dirs"])
+    parser.add_argument("--files", type=int, default=CORPUS["n_files"], help="Recordings per dir")
+    parser.add_argument("--fs", type=int, default=CORPUS["fs"])
+    parser.add_argument("--duration", type=float, default=CORPUS["duration"], help="Seconds per recording")
+    parser.add_argument("--proc", type=int, nargs="+", default=GRID["proc"])
+    parser.add_argument("--overlap", type=float, nargs="+", default=GRID["overlap"])
+    parser.add_argument("--files-per-batch", type=int, nargs="+", default=GRID["files_per_batch"])
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("--output", help="JSON file to store the results in")
+    parser.add_argument("--baseline", default=BASELINE, help="JSON file with results to compare with")
+    parser.add_argument("--update-baseline", action="store_true", help="Store the results as the baseline instead of comparing")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    corpus = {"n_dirs": args.dirs, "n_files": args.files, "fs": args.fs, "duration": args.duration, "channels": CORPUS["channels"]}
+    results = run(grid={"proc": args.proc, "overlap": args.overlap, "files_per_batch": args.files_per_batch}, corpus=corpus, model_path=args.model, repeat=args.repeat)
+
+    for path in [args.output, args.baseline if args.update_baseline else None]:
+        if path:
+            with open(path, "w") as file:
+                json.dump(results, file, indent=2)
+
+    if not args.update_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+        reason = not_comparable(baseline, results)
+        if reason:
+            print(f"\n{args.baseline} {reason}, not compared")
+            sys.exit(0)
+
+        rows = compare(baseline, results, tolerance=args.tolerance)
+        print(f"\nCompared with {args.baseline} (commit {baseline['environment'].get('commit')}, {baseline['environment'].get('cpus')} CPUs):")
+        for row in rows:
+            print(f"{row['name']:50s} files/s x{row['speed']:.2f}  peak memory x{row['memory']:.2f} {row['flag']}")
+
+        sys.exit(1 if any("slower" in row["flag"] or "more memory" in row["flag"] for row in rows) else 0)
@@ -1,20 +1,21 @@
 
 from datetime import datetime, timedelta
-import glob
 import os
-import time
 import source.log as log
 import csv
 import sys
 import math
-import pandas as pd
 from pathlib import Path
-from ultralytics import YOLO
 from concurrent.futures import ProcessPoolExecutor
 from functools import partial
-from source.misc import read_clean_wav, get_dirs_wav
-from source.predict import recording_to_predict
-from source.postprocess import overlap_tidy
+from source.misc import read_clean_wav, find_wav_files
+from source.predict import recording_to_predict, model_input_layout, result_parameters, model_for_precision
+from source.cache import open_cache, open_image_cache, cached_results
+from source.visualise import image_shape
+from source.writer import start_writer, stop_writer, resolve_output_format
+import source.pipeline as pipeline
+import source.scheduler as scheduler
+from source.workers import init_worker, get_model, load_shared_model, worker_memory, submit_as_completed
 
 """ Make path to model executable-safe """
 def resource_path(rel):
@@ -28,19 +29,53 @@ def main(
     msg_queue=None, # needed for app
     cancel_event=None, # needed for app
     model_path=r"model\0016_best.pt", # Location of YOLOv8 model, only change when you moved the model or want to use another one
-    files_per_batch=5_000, # Number of recordings checked before writing to output file
+    backend="torch", # "torch" (PyTorch, uses the GPU when there is one) or "onnx" to export the model once to ONNX (stored next to the weights) and predict with ONNX Runtime on the CPU, which is faster on computers without a GPU (needs onnxruntime)
+    precision="fp32", # "fp32", "bf16" to predict in bfloat16 with the torch backend (faster on CPUs with bf16 support), or "int8" to predict with a quantised model with the onnx backend (calibrated once on spectrograms of the recordings, stored next to the weights, needs onnx). Compare the detections with source/accuracy.py before using them
+    files_per_batch=5_000, # Number of recordings per output file
+    write_every=None, # Number of recordings whose detections are written to the output file at once (the output file gets its final name when all recordings of the batch are done). None: 1 with a log, so every recording is logged as soon as it is written, and 100 without
+    output_format="csv", # "csv", or "parquet" or "arrow" (Arrow IPC stream) for typed, dictionary encoded output that is faster to read (needs pyarrow). Every dir gets its own output files, like csv
     output_name=False, # False or name of output name. Output name will be supplemented with the recording file index of which the output is stored in that specific file
     recursive=True, # True (if all folders should be checked recursively for wav files) or False (if only wav files in the folder paths as assigned in 'dir_list' should be analysed)
+    include=None, # None or (list of) filename patterns of the recordings to analyse, e.g. "*Chan08*" (* matches anything, ? a single character)
+    exclude=None, # None or (list of) filename patterns of recordings to skip
     proc=8, # Number of processors to use to speed up analysis
+    threads_per_worker=None, # Threads of torch, OpenMP, BLAS and OpenCV per process. None: the CPUs divided over the processes (1 per render process in pipeline_mode, the inference processes share the other CPUs)
+    pin_workers=False, # True to pin every process to its own CPUs (threads_per_worker CPUs per process)
+    autotune=False, # True to first analyse a few recordings with different numbers of processes and threads per process, and analyse all recordings with the fastest combination (replaces proc and threads_per_worker, not used in pipeline_mode)
+    max_pending=None, # Number of recordings that are analysed (or waiting for a free process) at once, taken from all folders. None: two per process (plus two batches per inference process in pipeline_mode)
     overlap=0.3, # 0 when not using sliding window approach. 0.1-0.9 when using sliding window, where 0.1 if the proportion overlap between subsequent spectrograms analysed.
+    shared_stft=False, # True to compute the spectrogram of a whole recording once and cut the overlapping segments from it (faster when using overlap). Every segment start is rounded to the nearest spectrogram frame (at most half a frame hop, 0.5 ms at 250 kHz)
+    renderer="lut", # "lut" to render spectrogram images with a colour lookup table and cached resampling weights, "pil" to use matplotlib and PIL (slower, gives the same images), "direct" to compute the spectrogram at the image resolution without resizing (fastest, but different images than the model was trained on: calls are at the same places, up to 2.5 times wider in frequency at high sample rates. Ignores shared_stft)
+    tensor_input=False, # True to render spectrograms at the input size and padding of the model and predict them as one tensor, skipping the resize and padding of ultralytics (needs the lut or direct renderer)
+    stream=False, # True to read recordings in chunks from disk instead of loading them whole, for very long recordings that don't fit in memory (ignores shared_stft)
+    normalise="two_pass", # Normalisation when using stream: "two_pass" reads every recording twice and gives the same result as without stream, "running" reads it once and normalises by the highest peak so far
+    pipeline_mode=False, # True to only create spectrograms in the 'proc' processes and predict them in separate inference processes, which combine spectrograms of many recordings in one batch
+    inference_proc=1, # Number of inference processes when using pipeline_mode
+    batch_size=64, # Number of spectrograms predicted at once by an inference process when using pipeline_mode
+    max_wait=0.5, # Seconds an inference process waits for a full batch before predicting a smaller one when using pipeline_mode
+    image_slots=None, # Number of spectrograms in shared memory that render workers and inference processes exchange in pipeline_mode instead of sending copies (None: two batches per inference process plus two spectrograms per render worker, 0: send copies). Recordings with more segments than slots are sent as copies
+    share_model=False, # True to load the model once in this process and share its weights with all worker processes instead of loading a copy per worker (saves memory when using many processes)
+    report_memory=False, # True to print the unique memory used per worker process after every batch
+    cache_dir=None, # None or dir of a cache of the detections per recording: recordings that were analysed before with the same model and parameters are taken from the cache instead of analysed again
+    cache_size=1024, # Maximum size of the cache in MB, the least recently used recordings are removed from it
+    cache_hash=False, # True to recognise cached recordings by their size and a hash of their first and last MB (also after copying or moving them) instead of by path, size and modification time
+    image_cache_dir=None, # None or dir of a cache of the spectrogram images: recordings that were rendered before with the same parameters are read from it instead of rendered again, so analysing them with another model only runs the model (1.5 MB per segment, not used in pipeline_mode)
+    image_cache_size=10240, # Maximum size of the image cache in MB (None for no limit), the shard files with the least recently used images are removed from it
     app=False # needed for app
     ):
 
     """ Preliminaries (find directories with recordings, set parameters, etc) """
-    model_path_fix = resource_path(model_path)
-    model = YOLO(model_path_fix)
-
-    if recursive: dir_list = get_dirs_wav(head_dir_list=dir_list)
+    output_format = resolve_output_format(output_format) # Fails before analysing when pyarrow is missing
+    model_path_fix = resource_path(model_path) # Model itself is loaded once in every worker process (see init_worker)
+    image_cache = open_image_cache(image_cache_dir, max_size=image_cache_size, fast_hash=cache_hash) if image_cache_dir else None
+    if image_cache and pipeline_mode: print("The image cache is not used in pipeline_mode")
+    if renderer == "direct": print("Note: the direct renderer gives different spectrogram images than the model was trained on, check its detections against the lut renderer before relying on them")
+
+    wav_files = find_wav_files(dir_list, recursive=recursive, include=include, exclude=exclude) # Recordings (with their size) per dir, found in a single pass
+    model_path_fix = model_for_precision(model_path_fix, backend=backend, precision=precision, calibration_files=[f for files in wav_files.values() for f, _ in files]) # With the onnx backend the worker processes load the exported (and quantised) model in ONNX Runtime (see get_model)
+    model = load_shared_model(model_path_fix) if share_model and backend == "torch" else None
+    cache = open_cache(cache_dir, model_path_fix, max_size=cache_size, fast_hash=cache_hash) if cache_dir else None
+    if recursive: dir_list = list(wav_files)
     dir_list.sort()
 
     dir_list_check = log.logging(path=log_path, dirs=dir_list) # Handles all logging functionality when path is not False
@@ -50,124 +85,177 @@ def main(
         if app: msg_queue.put(("update", f"No folders with wav-files found"))
         return
 
-    print(f"Starting analysis using {proc} logical processors. Total dirs: {len(dir_list_check)}")
+    recording_to_predict_with_model = partial(recording_to_predict, model=model_path_fix, output_size=1, overlap=overlap, colour_scale="jet", write_plot=False, cancel_event=cancel_event, shared_stft=shared_stft, renderer=renderer, tensor_input=tensor_input, stream=stream, normalise=normalise, cache=cache, image_cache=image_cache, precision=precision)
+    if autotune and pipeline_mode: print("autotune is not used in pipeline_mode")
+    elif autotune:
+        if app: msg_queue.put(("update", "Finding the fastest number of processes and threads for this computer"))
+        all_files = [f for files in wav_files.values() for f, _ in files]
+        sample_files = all_files[::max(len(all_files) // 16, 1)][:16] # Spread over the recordings
+        (proc, threads_per_worker), throughput = scheduler.autotune(sample_files, partial(recording_to_predict_with_model, cache=None, image_cache=None), partial(init_worker, model_path_fix, model), pin_workers=pin_workers)
+        print("Autotune (processes, threads per process: recordings per second): " + ", ".join(f"{p}x{t}: {rate:.2f}" for (p, t), rate in throughput.items()))
+
+    # Threads per process, so the processes don't use more threads than there are CPUs together
+    worker_threads = threads_per_worker or (1 if pipeline_mode else scheduler.thread_budget(proc))
+    inference_threads = threads_per_worker or max((len(scheduler.available_cpus()) - proc * worker_threads) // inference_proc, 1)
+    cores = scheduler.core_sets(proc, worker_threads) if pin_workers else None
+
+    print(f"Starting analysis using {proc} logical processors ({worker_threads} threads per process). Total dirs: {len(dir_list_check)}")
     if app: msg_queue.put(("update", f"Starting analysis of {len(dir_list_check)} folders using {proc} logical processors"))
 
 
-    """ Analyse recordings per directory """
-    recording_to_predict_with_model = partial(recording_to_predict, model=model, output_size=1, overlap=overlap, colour_scale="jet", write_plot=False, cancel_event=cancel_event)
+    """ Analyse the recordings of all directories in a single queue """
+    if max_pending is None: max_pending = 2 * proc if not pipeline_mode else 2 * proc + 2 * batch_size * inference_proc
 
-    count_dir = 1
-    for dir in dir_list_check:
-        start_time_dir = datetime.now()
-        
-        if app: 
-            msg_queue.put(("update", f"Analysing... Working on folder {count_dir} of {len(dir_list_check)} using {proc} logical processors"))
-            msg_queue.put(("current_folder", f"Current folder: {dir}"))
-            msg_queue.put(("progress", ""))
+    # The same worker processes are used for all batches and dirs
+    if pipeline_mode:
+        layout = model_input_layout(model if model is not None else get_model(model_path_fix)) if tensor_input else None # Render workers don't load the model
+        if image_slots is None: image_slots = 2 * batch_size * inference_proc + 2 * proc
+        shm, slots = pipeline.create_image_slots(image_slots, image_shape(colour_scale="jet", layout=layout)) if image_slots else (None, None)
 
-            count_dir += 1
+        image_queue, result_queue, inference_processes = pipeline.start_inference(model_path_fix, inference_proc=inference_proc, batch_size=batch_size, max_wait=max_wait, model=model, tensor_input=tensor_input, image_slots=slots, precision=precision,
+                                                                                   threads=inference_threads, cores=scheduler.core_sets(inference_proc, inference_threads, scheduler.available_cpus()[proc * worker_threads:]) if pin_workers else None)
+        executor = ProcessPoolExecutor(max_workers=proc, initializer=pipeline.init_render_worker, initargs=(image_queue, slots, worker_threads, cores))
+    else:
+        executor = ProcessPoolExecutor(max_workers=proc, initializer=init_worker, initargs=(model_path_fix, model, worker_threads, cores))
 
-        file_paths = glob.glob(os.path.join(dir, "*.[Ww][Aa][Vv]"))
+    # Recordings of every dir are split in batches of files_per_batch recordings, every batch gets its own output file
+    dirs = {} # Batches left, start time and last output of the dirs that are analysed
+    batches = []
+    for dir in dir_list_check:
+        file_sizes = dict(wav_files.get(str(dir), []))
+        file_paths = list(file_sizes)
 
-        # file_paths = [
-        #     f for f in glob.glob(os.path.join(dir, "*.[Ww][Aa][Vv]"))
-        #     if "Chan08" in os.path.basename(f)
-        # ]
+        if log_path is not False: # Skip recordings that were analysed before the analysis was interrupted
+            done = log.done_files(log_path, dir)
+            if done:
+                file_paths = [f for f in file_paths if f not in done]
+                print(f"Already analysed files in {dir}: {len(done)}")
 
-        total_files = len(file_paths)
+                if len(file_paths) == 0:
+                    log.dir_done(log_path, dir)
+                    continue
 
         if len(file_paths) == 0: 
-            print("No wav-files found") 
-            if app: msg_queue.put(("progress", f"No wav-files found"))
-            time.sleep(5)
+            print(f"No wav-files found in {dir}") 
+            if app: msg_queue.put(("progress", f"No wav-files found in {dir}"))
             continue
-        
-        
-        print("---------")
-
-        print(f"Analysing {total_files} wav-files in {dir}.")
-
-        """ Analyse in multiple batches when too many wav-files in dir """
-        rounds = math.ceil(total_files / files_per_batch)
-        start_idx = 0
-
-        for i in range(0, rounds):
-            csv_data_total = []
-            
-            stop_idx = min((start_idx + files_per_batch), total_files)
-            index_file_paths = file_paths[start_idx:stop_idx]
-            index_file_paths_len = len(index_file_paths)
-
-            print_batch_message = f"\tAnalysing files {start_idx+1} - {stop_idx}... "
-            sys.stdout.write(print_batch_message)
-            sys.stdout.flush()
-            if app: msg_queue.put(("progress", f"Analysing files {start_idx+1} - {stop_idx}... "))
-
-            """ Using multiprocessing to process files in parallel """
-            with ProcessPoolExecutor(max_workers=proc) as executor:
-                results = executor.map(recording_to_predict_with_model, index_file_paths)
-
-                # Track progress
-                start_time = datetime.now()
-                for counter, result in enumerate(results, start=1):
-
-                    if cancel_event and cancel_event.is_set(): return
-
-                    if result: csv_data_total.extend(result)
-
-                    if counter % 10 == 0 or counter == index_file_paths_len or counter == 0:
-                        elapsed_time = (datetime.now() - start_time).total_seconds()
-                        time_per_file = elapsed_time / counter
-                        remaining_files = index_file_paths_len - counter
-                        estimated_time_left = time_per_file * remaining_files
-
-                        if app: 
-                            msg_queue.put(("progress", f"Analysing files {start_idx+1} - {stop_idx}... : Processed {counter}/{index_file_paths_len} files... ETA: {str(timedelta(seconds=int(estimated_time_left)))}"))
-                        else:
-                            sys.stdout.write(f"\r{print_batch_message} Processed {counter}/{index_file_paths_len} files... Estimated time left: {str(timedelta(seconds=int(estimated_time_left)))} ")
-                            sys.stdout.flush()
-
-            """ Predictions to csv file """
-            if not output_name: 
-                output_name_new = f"output_{start_idx+1}-{stop_idx}.csv"
-            else:
-                output_name_new = output_name + f"_{start_idx+1}-{stop_idx}.csv"
-
-            output_name_path = os.path.join(dir, output_name_new)
-            
-            # with open(output_name_path, mode='w', newline='', encoding='utf-8') as file:
-            #     writer = csv.DictWriter(file, fieldnames=["filename", "filepath", "category", "confidence", "start_time_ms", "end_time_ms", "freq_min", "freq_max"])
-            #     writer.writeheader()
-            #     writer.writerows(csv_data_total)
-
-            df_total = pd.DataFrame(csv_data_total)
-            df_total_tidy = overlap_tidy(df_total, threshold=5)
-
-            df_total_tidy.to_csv(output_name_path, index=False, encoding='utf-8')
-
-            time_batch = datetime.now() - start_time
-            formatted_time = str(timedelta(seconds=int(time_batch.total_seconds())))
-            sys.stdout.write(f"\r{print_batch_message} Finished in {formatted_time}. Output stored in {output_name_new}\n")
-            sys.stdout.flush()
-
-            if app: msg_queue.put(("progress", f"{print_batch_message} Finished in {formatted_time}. Output stored in {output_name_new}"))
-
-            start_idx += files_per_batch
-
-
-        """ Log results and print to console/app """
-        timestamp = datetime.now().strftime("[%Y-%m-%d %H:%M:%S]")
-        dir_duration = str(timedelta(seconds=int((datetime.now() - start_time).total_seconds())))
-        if app: msg_queue.put(("log", f"{timestamp} Finished in {dir_duration}. Output stored in {os.path.join(dir, output_name_new)}\n"))
-
-        # Update log file
-        if log_path is not False:
-            log_path_csv = os.path.join(log_path, "log.csv")
-            log_file = pd.read_csv(log_path_csv)
-            log_file["done"] = log_file["done"].astype("object") # Ensure column is string-compatible
-            log_file.loc[log_file["dir"] == dir, "done"] = "yes"
-            log_file.to_csv(log_path_csv, index=False)
+
+        dirs[dir] = {"batches": math.ceil(len(file_paths) / files_per_batch), "size": sum(file_sizes[f] for f in file_paths), "start_time": None, "output": None}
+        for start_idx in range(0, len(file_paths), files_per_batch):
+            stop_idx = min(start_idx + files_per_batch, len(file_paths))
+            batches.append({"dir": dir, "files": file_paths[start_idx:stop_idx], "start_idx": start_idx, "stop_idx": stop_idx, "remaining": stop_idx - start_idx, "writer": None})
+
+    file_paths = [wav_file for batch in batches for wav_file in batch["files"]]
+    batch_of_file = {wav_file: batch for batch in batches for wav_file in batch["files"]} # Routes the results to the output of their batch
+    total_files = len(file_paths)
+
+    print("---------")
+    print(f"Analysing {total_files} wav-files ({sum(d['size'] for d in dirs.values()) / 1e6:,.0f} MB) in {len(dirs)} folders.")
+
+    """ Using multiprocessing to process files in parallel, results arrive as soon as they are done (from any dir) """
+    if pipeline_mode:
+        render_kwargs = dict(output_size=1, overlap=overlap, colour_scale="jet", cancel_event=cancel_event, shared_stft=shared_stft, renderer=renderer, layout=layout, stream=stream, normalise=normalise)
+        analyse = lambda file_paths: pipeline.predict_files(executor, file_paths, result_queue, inference_processes, max_pending=max_pending, **render_kwargs)
+        if cache is not None:
+            params = result_parameters(output_size=1, overlap=overlap, colour_scale="jet", shared_stft=shared_stft, renderer=renderer, tensor_input=tensor_input, stream=stream, normalise=normalise, precision=precision)
+            results = cached_results(cache, file_paths, params, analyse)
+        else:
+            results = analyse(file_paths)
+    else:
+        results = submit_as_completed(executor, recording_to_predict_with_model, file_paths, max_pending=max_pending)
+
+    # Track progress
+    start_time = datetime.now()
+    dirs_done = 0
+    failed = False
+    try:
+        for counter, (wav_file, result) in enumerate(results, start=1):
+
+            if cancel_event and cancel_event.is_set(): 
+                failed = True # The queued images aren't needed, so the inference processes are stopped without waiting on them
+                executor.shutdown(cancel_futures=True)
+                for batch in batches:
+                    if batch["writer"] is not None and batch["remaining"]: stop_writer(batch["writer"], commit=False)
+                return
+
+            batch = batch_of_file.pop(wav_file)
+            dir = batch["dir"]
+            if batch["writer"] is None: # First recording of the batch that is done
+                if not output_name: 
+                    output_name_new = f"output_{batch['start_idx']+1}-{batch['stop_idx']}.{output_format}"
+                else:
+                    output_name_new = output_name + f"_{batch['start_idx']+1}-{batch['stop_idx']}.{output_format}"
+
+                output_name_path = os.path.join(dir, output_name_new)
+                if os.path.exists(output_name_path): # Output of an interrupted analysis of the same dir
+                    output_name_new = f"{Path(output_name_new).stem}_{datetime.now():%Y%m%d-%H%M%S}{Path(output_name_new).suffix}"
+                    output_name_path = os.path.join(dir, output_name_new)
+
+                # Detections are tidied and written in the background while the next recordings are analysed
+                batch["writer"] = start_writer(output_name_path, write_every=write_every, threshold=5, output_format=output_format, log_path=log_path)
+                batch["output_name"] = output_name_new
+                batch["start_time"] = datetime.now()
+                if dirs[dir]["start_time"] is None: dirs[dir]["start_time"] = batch["start_time"]
+
+                if app: msg_queue.put(("current_folder", f"Current folder: {dir}"))
+
+            batch["writer"]["queue"].put(result) # Block of detections, see results_to_block
+            batch["remaining"] -= 1
+
+            """ Predictions to output file when the last recording of the batch is done """
+            if batch["remaining"] == 0:
+                stop_writer(batch["writer"]) # Writes the last detections and moves the output to its name
+
+                formatted_time = str(timedelta(seconds=int((datetime.now() - batch["start_time"]).total_seconds())))
+                print_batch_message = f"\t{dir}: files {batch['start_idx']+1} - {batch['stop_idx']} finished in {formatted_time}. Output stored in {batch['output_name']}"
+                sys.stdout.write(f"\r{print_batch_message}\n")
+                sys.stdout.flush()
+                if app: msg_queue.put(("progress", print_batch_message))
+
+                if report_memory:
+                    memory = worker_memory()
+                    if memory: print(f"\tUnique memory per worker process: {sum(memory.values()) / len(memory):.0f} MB on average, {max(memory.values()):.0f} MB max ({len(memory)} processes)")
+
+                dirs[dir]["batches"] -= 1
+                dirs[dir]["output"] = batch["output_name"]
+                if dirs[dir]["batches"] == 0: # Last batch of the dir
+                    dirs_done += 1
+
+                    """ Log results and print to console/app """
+                    timestamp = datetime.now().strftime("[%Y-%m-%d %H:%M:%S]")
+                    dir_duration = str(timedelta(seconds=int((datetime.now() - dirs[dir]["start_time"]).total_seconds())))
+                    if app: 
+                        msg_queue.put(("log", f"{timestamp} Finished {dir} in {dir_duration}. Output stored in {os.path.join(dir, dirs[dir]['output'])}\n"))
+                        msg_queue.put(("update", f"Analysing... Finished {dirs_done} of {len(dirs)} folders using {proc} logical processors"))
+
+                    # Update log file
+                    if log_path is not False: log.dir_done(log_path, dir)
+
+            if counter % 10 == 0 or counter == total_files:
+                elapsed_time = (datetime.now() - start_time).total_seconds()
+                time_per_file = elapsed_time / counter
+                remaining_files = total_files - counter
+                estimated_time_left = time_per_file * remaining_files
+
+                print_progress_message = f"Processed {counter}/{total_files} files, finished {dirs_done}/{len(dirs)} folders..."
+                if app: 
+                    msg_queue.put(("progress", f"{print_progress_message} ETA: {str(timedelta(seconds=int(estimated_time_left)))}"))
+                else:
+                    sys.stdout.write(f"\r\t{print_progress_message} Estimated time left: {str(timedelta(seconds=int(estimated_time_left)))} ")
+                    sys.stdout.flush()
+
+    except BaseException:
+        failed = True
+        for batch in batches: # With a log the detections of the recordings that are done are kept, they are skipped when the analysis is continued. Without a log nothing tells the output is incomplete, so it is removed
+            if batch["writer"] is not None and batch["remaining"] and batch["writer"]["thread"].is_alive(): stop_writer(batch["writer"], commit=log_path is not False)
+        raise
+
+    finally: # Also after an error, so the inference processes don't keep running and the shared memory of the image slots is freed. Their queued images aren't needed then
+        if pipeline_mode: pipeline.stop_inference(image_queue, inference_processes, shm, wait=not failed)
+
+    print()
+
+    executor.shutdown()
 
     if app: 
         msg_end = "\nAll folders are analysed. See you next time!"
@@ -0,0 +1,120 @@
+import time
+import numpy as np
+import pandas as pd
+from source.predict import recording_to_predict, blocks_to_frame, model_for_precision, PRECISIONS
+from source.postprocess import overlap_tidy
+from source.workers import get_model
+
+MIN_OVERLAP = 0.5 # Detections match when their boxes (time x frequency) overlap at least this much (intersection over union)
+
+""" Matches detections to reference detections (tables with filepath, category, start_time_ms, end_time_ms, freq_min and freq_max, e.g. output of overlap_tidy) of the same recording and category.
+    Detections are matched in order of confidence to the unmatched reference detection they overlap most, when that is at least min_overlap.
+    Returns whether every reference detection and every detection is matched (boolean arrays) """
+def match_detections(reference, detections, min_overlap=MIN_OVERLAP):
+    matched_reference = np.zeros(len(reference), dtype=bool)
+    matched = np.zeros(len(detections), dtype=bool)
+
+    reference_groups = reference.reset_index(drop=True).groupby(["filepath", "category"], observed=True).indices
+    detections = detections.reset_index(drop=True)
+    if "confidence" in detections: detections = detections.iloc[np.argsort(-detections["confidence"].to_numpy(), kind="stable")]
+
+    for key, rows in detections.groupby(["filepath", "category"], observed=True, sort=False).indices.items():
+        reference_rows = reference_groups.get(key)
+        if reference_rows is None: continue
+
+        boxes = detections.iloc[rows][["start_time_ms", "end_time_ms", "freq_min", "freq_max"]].to_numpy(dtype=float)
+        reference_boxes = reference.iloc[reference_rows][["start_time_ms", "end_time_ms", "freq_min", "freq_max"]].to_numpy(dtype=float)
+        overlap = box_overlap(boxes, reference_boxes)
+
+        for i, row in enumerate(detections.index[rows]):
+            overlap[i, matched_reference[reference_rows]] = 0 # Every reference detection is matched once
+            best = overlap[i].argmax()
+            if overlap[i, best] >= min_overlap and overlap[i, best] > 0:
+                matched[row] = True
+                matched_reference[reference_rows[best]] = True
+
+    return matched_reference, matched
+
+""" Intersection over union of every box in a with every box in b (rows of start time, end time, min frequency, max frequency) """
+def box_overlap(a, b):
+    time = (np.minimum(a[:, None, 1], b[None, :, 1]) - np.maximum(a[:, None, 0], b[None, :, 0])).clip(0)
+    freq = (np.minimum(a[:, None, 3], b[None, :, 3]) - np.maximum(a[:, None, 2], b[None, :, 2])).clip(0)
+    intersection = time * freq
+    area_a = (a[:, 1] - a[:, 0]) * (a[:, 3] - a[:, 2])
+    area_b = (b[:, 1] - b[:, 0]) * (b[:, 3] - b[:, 2])
+    union = area_a[:, None] + area_b[None, :] - intersection
+
+    return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+""" Recall (matched reference detections) and precision (matched detections) per category of detections compared to reference detections (see match_detections) """
+def category_scores(reference, detections, min_overlap=MIN_OVERLAP):
+    matched_reference, matched = match_detections(reference, detections, min_overlap=min_overlap)
+
+    categories = sorted(set(reference["category"].astype(str)) | set(detections["category"].astype(str)))
+    rows = []
+    for category in categories:
+        in_reference = (reference["category"].astype(str) == category).to_numpy()
+        in_detections = (detections["category"].astype(str) == category).to_numpy()
+        rows.append({"category": category, "reference": int(in_reference.sum()), "detections": int(in_detections.sum()),
+                     "recall": matched_reference[in_reference].mean() if in_reference.any() else np.nan,
+                     "precision": matched[in_detections].mean() if in_detections.any() else np.nan})
+
+    return pd.DataFrame(rows, columns=["category", "reference", "detections", "recall", "precision"])
+
+""" Analyses the recordings wav_files with the full precision model (torch, fp32) and the model in every precision (see predict.model_for_precision), and returns the tidied detections (see overlap_tidy) and the seconds it took per precision.
+    The int8 model is calibrated on calibration_files (default: wav_files) when it isn't quantised yet. kwargs are passed to recording_to_predict (overlap, tensor_input, ...) """
+def analyse_precisions(wav_files, model_path, precisions=("bf16", "int8"), calibration_files=None, threshold=5, **kwargs):
+    detections, seconds = {}, {}
+    for precision in ("fp32",) + tuple(p for p in precisions if p != "fp32"):
+        if precision not in PRECISIONS: raise ValueError(f"Unknown precision: {precision}")
+        backend = "onnx" if precision == "int8" else "torch"
+        model = get_model(model_for_precision(model_path, backend=backend, precision=precision, calibration_files=calibration_files or wav_files))
+
+        recording_to_predict(wav_files[0], model, precision=precision, **kwargs) # Warm up
+        start = time.perf_counter()
+        blocks = [recording_to_predict(wav_file, model, precision=precision, **kwargs) for wav_file in wav_files]
+        seconds[precision] = time.perf_counter() - start
+        detections[precision] = overlap_tidy(blocks_to_frame(blocks), threshold=threshold)
+
+    return detections, seconds
+
+""" Compares the detections of the model in reduced precision with those of the full precision model on a reference set of recordings, per category after overlap_tidy.
+    Without truth the full precision detections are the reference: recall is the part of them that is found in reduced precision as well, precision the part of the reduced precision detections that the full precision model finds too.
+    With truth (a table of annotated calls like the output) every precision is scored against it, and recall_diff and precision_diff are the differences with full precision.
+    speedup is how many times faster the reduced precision analysis is """
+def compare_precisions(wav_files, model_path, precisions=("bf16", "int8"), truth=None, min_overlap=MIN_OVERLAP, **kwargs):
+    detections, seconds = analyse_precisions(wav_files, model_path, precisions=precisions, **kwargs)
+    reference = detections["fp32"] if truth is None else truth
+
+    reports = []
+    for precision, found in detections.items():
+        if truth is None and precision == "fp32": continue
+
+        report = category_scores(reference, found, min_overlap=min_overlap)
+        report.insert(0, "precision_mode", precision)
+        report["seconds"] = seconds[precision]
+        report["speedup"] = seconds["fp32"] / seconds[precision]
+        reports.append(report)
+
+    report = pd.concat(reports, ignore_index=True)
+    if truth is not None:
+        full = report[report["precision_mode"] == "fp32"].set_index("category")
+        report["recall_diff"] = report["recall"] - report["category"].map(full["recall"])
+        report["precision_diff"] = report["precision"] - report["category"].map(full["precision"])
+    else:
+        report["recall_diff"] = report["recall"] - 1
+        report["precision_diff"] = report["precision"] - 1
+
+    return report
+
+
+if __name__ == "__main__":
+    import glob
+
+    wav_files = sorted(glob.glob(R"data\reference_set\*.wav"))
+    truth = None # pd.read_csv(R"data\reference_set\annotations.csv")
+
+    report = compare_precisions(wav_files, R"model\0016_best.pt", precisions=("bf16", "int8"), truth=truth, overlap=0.3)
+
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print(report)
@@ -0,0 +1,266 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from functools import lru_cache
+import numpy as np
+import source.predict as predict
+
+CACHE_NAME = "results.sqlite" # Cache of the detections per recording in the cache dir
+IMAGE_CACHE_NAME = "images.sqlite" # Index of the spectrogram images per recording in the image cache dir
+HASH_BYTES = 2**20 # Bytes at the start and end of a recording that are hashed with fast_hash
+SHARD_SIZE = 2**30 # Bytes of images in a shard file of the image cache before a new one is started
+
+TABLES = {
+    CACHE_NAME: ["CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, filepath TEXT, status TEXT, names TEXT, detections BLOB, size INTEGER, last_used REAL)",
+                 "CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)",
+                 "CREATE TABLE IF NOT EXISTS total (id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER)", # Size of all results, so it doesn't have to be summed for every new result
+                 "INSERT OR IGNORE INTO total (id, size) VALUES (0, 0)"],
+    IMAGE_CACHE_NAME: ["CREATE TABLE IF NOT EXISTS images (key TEXT PRIMARY KEY, filepath TEXT, shard TEXT, offset INTEGER, shape TEXT, filenames TEXT, offsets TEXT, last_used REAL)", # shard is NULL for recordings that can't be read
+                       "CREATE INDEX IF NOT EXISTS images_shard ON images (shard)"],
+} # Tables of the cache databases
+
+_connections = {} # Connections to caches opened in this process, by (cache dir, database, process id)
+_shards = {} # Shard file this process appends images to, by image cache dir and process id
+
+""" Opens (or creates) the cache of detections in the dir 'path' and returns its settings, to pass to recording_to_predict (or cached_results).
+    Detections are cached per recording, model (hash of the weights at model_path) and analysis parameters, and the least recently used recordings are removed when the cache is larger than max_size MB.
+    Recordings are identified by path, size and modification time, or by size and a hash of their first and last MB (fast_hash, also finds recordings that are copied or moved) """
+def open_cache(path, model_path, max_size=1024, fast_hash=False):
+    os.makedirs(path, exist_ok=True)
+    cache = {"path": path, "database": CACHE_NAME, "model": model_hash(str(model_path), os.stat(model_path).st_mtime_ns), "max_size": int(max_size * 1024**2), "fast_hash": fast_hash}
+    _open(cache).close() # Creates the tables. Not kept open, connections can't be used in (forked) worker processes
+
+    return cache
+
+""" Hash of the weights of a model (computed once per process for every version of the model) """
+@lru_cache(maxsize=None)
+def model_hash(model_path, mtime_ns=None):
+    digest = hashlib.sha256()
+    with open(model_path, "rb") as file:
+        while chunk := file.read(2**24):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+""" Key of the detections of a recording in the cache, for the model and analysis parameters of the cache. None when the recording doesn't exist """
+def result_key(cache, wav_file, params):
+    return _key(cache, wav_file, cache["model"], params)
+
+""" Key of a recording in the cache, for the other parts of the key (model, parameters) """
+def _key(cache, wav_file, *parts):
+    try:
+        stat = os.stat(wav_file)
+    except OSError:
+        return None
+
+    if cache["fast_hash"]:
+        identity = [stat.st_size, _fast_hash(wav_file, stat.st_size)]
+    else:
+        identity = [os.path.abspath(wav_file), stat.st_size, stat.st_mtime_ns]
+
+    return hashlib.sha256(json.dumps([identity, *parts], sort_keys=True).encode()).hexdigest()
+
+""" Hash of the first and last HASH_BYTES of a file """
+def _fast_hash(wav_file, size):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(wav_file, "rb") as file:
+        digest.update(file.read(HASH_BYTES))
+        if size > 2 * HASH_BYTES:
+            file.seek(size - HASH_BYTES)
+            digest.update(file.read(HASH_BYTES))
+
+    return digest.hexdigest()
+
+""" Connection to the cache in this process. Every process opens its own connection """
+def _connection(cache):
+    key = (cache["path"], cache["database"], os.getpid())
+    if key not in _connections: _connections[key] = _open(cache)
+
+    return _connections[key]
+
+""" Opens the cache database, and creates its tables when they don't exist """
+def _open(cache):
+    connection = sqlite3.connect(os.path.join(cache["path"], cache["database"]), timeout=60)
+    connection.execute("PRAGMA journal_mode=WAL") # Worker processes read while others write
+    connection.execute("PRAGMA synchronous=NORMAL")
+
+    with connection:
+        for statement in TABLES[cache["database"]]:
+            connection.execute(statement)
+
+    return connection
+
+""" Returns the block of detections (see predict.results_to_block) of wav_file from the cache, or None when it isn't cached. The status of the recording ("ok", "empty" or "corrupt") is in header["status"] """
+def get_result(cache, wav_file, params, key=None):
+    key = key or result_key(cache, wav_file, params)
+    if key is None: return None
+
+    connection = _connection(cache)
+    row = connection.execute("SELECT status, names, detections FROM results WHERE key = ?", (key,)).fetchone()
+    if row is None: return None
+
+    with connection:
+        connection.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+
+    status, names, detections = row
+    header = {"filename": os.path.basename(wav_file), "filepath": wav_file, "names": tuple(json.loads(names)), "status": status}
+
+    return header, np.frombuffer(detections, dtype=predict.DETECTION_DTYPE).copy()
+
+""" Stores the block of detections of wav_file in the cache, and removes the least recently used results when the cache is too large """
+def put_result(cache, wav_file, params, block, key=None):
+    key = key or result_key(cache, wav_file, params)
+    if key is None: return
+
+    header, detections = block
+    status = header.get("status") or ("ok" if len(detections) else "empty")
+    data = np.ascontiguousarray(detections, dtype=predict.DETECTION_DTYPE).tobytes()
+    size = len(data) + 256 # Rough size of the row without the detections
+
+    connection = _connection(cache)
+    with connection:
+        connection.execute("BEGIN IMMEDIATE") # Other processes can't replace the result between reading its old size and the upsert, which would count it twice in the total
+        replaced = connection.execute("SELECT size FROM results WHERE key = ?", (key,)).fetchone()
+        connection.execute("INSERT OR REPLACE INTO results (key, filepath, status, names, detections, size, last_used) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           (key, wav_file, status, json.dumps(list(header["names"])), data, size, time.time()))
+        connection.execute("UPDATE total SET size = size + ? WHERE id = 0", (size - (replaced[0] if replaced else 0),))
+
+        total, = connection.execute("SELECT size FROM total WHERE id = 0").fetchone()
+        while total > cache["max_size"]:
+            oldest = connection.execute("SELECT key, size FROM results ORDER BY last_used LIMIT 100").fetchall()
+            if not oldest: break
+
+            for old_key, old_size in oldest:
+                if total <= cache["max_size"]: break
+                connection.execute("DELETE FROM results WHERE key = ?", (old_key,))
+                total -= old_size
+
+            connection.execute("UPDATE total SET size = ? WHERE id = 0", (total,))
+
+""" Yields (wav_file, block of detections) of file_paths: from the cache when they are cached, and the others from analyse(file paths that are not cached), which are then stored in the cache.
+    Used in pipeline_mode, where the recordings are not analysed by recording_to_predict """
+def cached_results(cache, file_paths, params, analyse):
+    missing = []
+    for wav_file in file_paths:
+        block = get_result(cache, wav_file, params)
+        if block is None:
+            missing.append(wav_file)
+        else:
+            yield wav_file, block
+
+    if not missing: return
+
+    for wav_file, block in analyse(missing):
+        put_result(cache, wav_file, params, block)
+        yield wav_file, block
+
+""" Opens (or creates) the cache of spectrogram images in the dir 'path' and returns its settings, to pass to recording_to_predict.
+    The images of a recording are rendered once per set of render parameters (see predict.render_parameters) and read back from memory mapped shard files, so analysing the same recordings with another model only runs the model.
+    Images take 1.5 MB per segment (less with tensor_input). When the shards are larger than max_size MB together, the least recently used shards are removed (see _evict_shards), None for no limit. fast_hash: see open_cache """
+def open_image_cache(path, max_size=10240, fast_hash=False):
+    os.makedirs(path, exist_ok=True)
+    max_size = int(max_size * 1024**2) if max_size is not None else None
+    cache = {"path": path, "database": IMAGE_CACHE_NAME, "fast_hash": fast_hash, "max_size": max_size,
+             "shard_size": min(SHARD_SIZE, max_size // 8) if max_size is not None else SHARD_SIZE} # A shard is removed at once, so it is at most an eighth of the cache
+    _open(cache).close()
+
+    return cache
+
+""" Yields the spectrogram images of wav_file like predict.iter_recording_images: from the image cache when they are cached (as read-only memory mapped arrays), otherwise from render(), which are stored in the cache while they are yielded.
+    Returns None when the recording can't be read. Images of a cancelled recording are not added to the cache """
+def cached_images(cache, wav_file, params, render, cancel_event=None):
+    key = _key(cache, wav_file, params)
+    if key is None: return render()
+
+    connection = _connection(cache)
+    row = connection.execute("SELECT shard, offset, shape, filenames, offsets FROM images WHERE key = ?", (key,)).fetchone()
+    if row is not None:
+        shard, offset, shape, filenames, offsets = row
+        if shard is None: return None # Can't be read
+
+        try:
+            images = np.memmap(os.path.join(cache["path"], shard), dtype=np.uint8, mode="r", offset=offset, shape=(len(json.loads(filenames)),) + tuple(json.loads(shape)))
+        except (OSError, ValueError): # Shard removed or cut short: render again
+            pass
+        else:
+            with connection:
+                connection.execute("UPDATE images SET last_used = ? WHERE key = ?", (time.time(), key))
+            return zip(images, json.loads(filenames), json.loads(offsets))
+
+    images = render()
+    if images is None:
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO images (key, filepath) VALUES (?, ?)", (key, wav_file))
+        return None
+
+    return _store_images(cache, key, wav_file, images, cancel_event)
+
+""" Appends the images to the shard file of this process while yielding them, and adds them to the index when all images of the recording are stored.
+    When they aren't all stored (cancelled, an error while rendering or the images aren't read to the end) the shard is cut back to where they started """
+def _store_images(cache, key, wav_file, images, cancel_event=None):
+    shard = _shard(cache)
+    offset = shard["file"].tell()
+    shape, filenames, offsets = None, [], []
+    stored = False
+
+    try:
+        for img_array, filename, start_time in images:
+            image = np.ascontiguousarray(img_array, dtype=np.uint8)
+            if shape is None: shape = image.shape
+            if image.shape == shape: shard["file"].write(image.data)
+            else: shape = False # Different sizes can't be read as one array, the recording isn't cached
+
+            filenames.append(filename)
+            offsets.append(start_time)
+            yield img_array, filename, start_time
+
+        if not shape or (cancel_event is not None and cancel_event.is_set()): return
+
+        shard["file"].flush() # Readable by other processes before it's in the index
+        with _connection(cache):
+            _connection(cache).execute("INSERT OR REPLACE INTO images (key, filepath, shard, offset, shape, filenames, offsets, last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                       (key, wav_file, shard["name"], offset, json.dumps(shape), json.dumps(filenames), json.dumps(offsets), time.time()))
+        stored = True
+
+    finally:
+        if not stored and not shard["file"].closed: # Only this process appends to its shard, so nothing comes after the images
+            shard["file"].flush()
+            shard["file"].truncate(offset)
+            shard["file"].seek(offset)
+
+    if cache["max_size"] is not None: _evict_shards(cache)
+
+""" Shard file this process appends images to. A new shard is started when it's larger than the shard size of the cache (only between recordings, the images of a recording are in one shard) """
+def _shard(cache):
+    key = (cache["path"], os.getpid())
+    shard = _shards.get(key)
+    if shard is None or shard["file"].tell() >= cache["shard_size"] or not os.path.exists(os.path.join(cache["path"], shard["name"])): # Also after it was removed by _evict_shards
+        if shard is not None: shard["file"].close()
+        name = f"shard_{os.getpid()}_{time.time_ns()}.bin"
+        shard = _shards[key] = {"name": name, "file": open(os.path.join(cache["path"], name), "ab")}
+
+    return shard
+
+""" Removes the least recently used shards (and their recordings from the index) until the shards are at most max_size bytes together. The shard this process appends to is kept.
+    Shards are counted by their size on disk, so images of recordings that weren't stored completely (e.g. after a crash) are removed with their shard too """
+def _evict_shards(cache):
+    sizes = {entry.name: entry.stat() for entry in os.scandir(cache["path"]) if entry.name.startswith("shard_") and entry.name.endswith(".bin")}
+    total = sum(stat.st_size for stat in sizes.values())
+    if total <= cache["max_size"]: return
+
+    connection = _connection(cache)
+    last_used = dict(connection.execute("SELECT shard, MAX(last_used) FROM images WHERE shard IS NOT NULL GROUP BY shard").fetchall())
+    current = _shards.get((cache["path"], os.getpid()), {}).get("name")
+    for name in sorted(sizes, key=lambda name: last_used.get(name) or sizes[name].st_mtime): # Shards without recordings in the index by when they were written
+        if total <= cache["max_size"]: break
+        if name == current: continue
+
+        with connection:
+            connection.execute("DELETE FROM images WHERE shard = ?", (name,))
+        try:
+            os.remove(os.path.join(cache["path"], name))
+        except OSError: # Removed by another process, or still in use (Windows)
+            continue
+        total -= sizes[name].st_size
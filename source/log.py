@@ -1,6 +1,12 @@
 
 import pandas as pd
 import os
+import sqlite3
+from contextlib import closing
+from datetime import datetime
+
+LOG_NAME = "log.sqlite" # Log of the analysis in the log dir
+FINISHED = ("ok", "empty", "corrupt", "done") # Status of recordings that are skipped when continuing ("done": logs of earlier versions)
 
 """ Try to read log file with error management """
 def read_log_file(log_path):
@@ -34,31 +40,55 @@ def log_file_correctness_check(df):
 
     return
 
-""" Check if logging is requested. If so, if log file already exists and continue where left of. If not exists, create new log file """
+""" Opens the log of the analysis (a SQLite database in WAL mode) in the log dir 'path', with a row per dir and per analysed recording, and the output files they are written to.
+    Every process or thread that writes to the log opens its own connection """
+def open_log(path):
+    connection = sqlite3.connect(os.path.join(path, LOG_NAME), timeout=60)
+    connection.execute("PRAGMA journal_mode=WAL") # Readers don't block the writer
+    connection.execute("PRAGMA synchronous=NORMAL") # Commits survive a crash of the analysis (not of the OS), without a sync per commit
+
+    with connection:
+        connection.execute("CREATE TABLE IF NOT EXISTS dirs (dir TEXT PRIMARY KEY, done INTEGER NOT NULL DEFAULT 0)")
+        connection.execute("CREATE TABLE IF NOT EXISTS files (filepath TEXT PRIMARY KEY, dir TEXT, status TEXT, detections INTEGER, duration REAL, output TEXT, finished TEXT)")
+        connection.execute("CREATE INDEX IF NOT EXISTS files_dir ON files (dir)")
+        connection.execute("CREATE TABLE IF NOT EXISTS outputs (path TEXT PRIMARY KEY, part_path TEXT, output_format TEXT, committed_size INTEGER, done INTEGER NOT NULL DEFAULT 0)")
+
+    return connection
+
+""" Check if logging is requested. If so, if log file already exists and continue where left of. If not exists, create new log file.
+    An existing log.csv (of an older version) is taken over in the log. Output of recordings of an interrupted analysis is recovered (see recover_outputs) """
 def logging(path, dirs):
     
     if path is False:  
         print("No log requested. Starting analysis without logging progress.")
         return(dirs)
     else:
-        log_path = os.path.join(path, "log.csv")  
+        log_path = os.path.join(path, LOG_NAME)
+        log_path_csv = os.path.join(path, "log.csv")
 
-        log_file = pd.DataFrame({"dir": dirs}) # To compare to existing log file or save when no log file exists
-        log_file["done"] = "no"
+        with closing(open_log(path)) as connection:
+            logged = connection.execute("SELECT COUNT(*) FROM dirs").fetchone()[0] > 0
 
-        if os.path.isfile(log_path): # Checks if there is an existing log file
+        if logged or os.path.isfile(log_path_csv): # Checks if there is an existing log file
             print(f"Log file exists. ", end="")
 
-            df = read_log_file(log_path)
+            df = None
+            if not logged: # log.csv of an older version, taken over in the log
+                df = read_log_file(log_path_csv)
+                log_file_correctness_check(df)
 
-            log_file_correctness_check(df) 
+            with closing(open_log(path)) as connection:
+                if df is not None:
+                    with connection:
+                        connection.executemany("INSERT INTO dirs (dir, done) VALUES (?, ?)", [(dir, int(done == "yes")) for dir, done in zip(df["dir"], df["done"])])
 
-            log_file_read = df.sort_values("dir")
+                log_file_read = connection.execute("SELECT dir, done FROM dirs ORDER BY dir").fetchall()
+                recover_outputs(connection)
 
-            if list(log_file["dir"]) == list(log_file_read["dir"]): # Will continue analysis if list of dirs to analyse match the list of dirs in the log file
+            if sorted(dirs) == [dir for dir, _ in log_file_read]: # Will continue analysis if list of dirs to analyse match the list of dirs in the log file
                 print(f"Continue analysis where we left off. ", end="")
                 len_dirs = len(dirs)
-                dir_list = log_file_read.loc[log_file_read["done"] == "no", "dir"].tolist()
+                dir_list = [dir for dir, done in log_file_read if not done]
                 skipped_dirs = len_dirs - len(dir_list)
                 print(f"Already analysed dirs: {skipped_dirs}")
 
@@ -72,9 +102,69 @@ def logging(path, dirs):
 
         else:
             print(f"No log file exists. Initialising log file for analysis. ", end="")
-            log_file.to_csv(log_path, index=False)
+            with closing(open_log(path)) as connection, connection:
+                connection.executemany("INSERT INTO dirs (dir) VALUES (?)", [(dir,) for dir in dirs])
 
             print(f"Log file stored in {log_path}")
             return(dirs)
     
-    return(dir_list)
\ No newline at end of file
+    return(dir_list)
+
+""" Recordings of 'dir' that are analysed and written to an output file already (to skip when continuing) """
+def done_files(path, dir):
+    with closing(open_log(path)) as connection:
+        dir = os.path.dirname(os.path.join(dir, "")) # The same as the dir of the logged recordings, also with a trailing separator
+        return {filepath for filepath, in connection.execute(f"SELECT filepath FROM files WHERE dir = ? AND status IN ({', '.join('?' * len(FINISHED))})", (dir, *FINISHED))}
+
+""" Marks 'dir' as done """
+def dir_done(path, dir):
+    with closing(open_log(path)) as connection, connection:
+        connection.execute("UPDATE dirs SET done = 1 WHERE dir = ?", (dir,))
+
+""" Registers the output file that is written to part_path and moved to 'output' when it is complete (see writer.start_writer) """
+def start_output(connection, output, part_path, output_format):
+    with connection:
+        connection.execute("INSERT OR REPLACE INTO outputs (path, part_path, output_format, committed_size, done) VALUES (?, ?, ?, 0, 0)", (output, part_path, output_format))
+
+""" Logs the recordings (headers of their blocks of detections, see predict.results_to_block) that are written to 'output' in a single transaction, with their status: "ok", "empty" (no detections) or "corrupt" (can't be read).
+    committed_size is the size of the part file after writing them, up to where it is recovered after a crash (None when the output format can't be recovered) """
+def log_files(connection, headers, output, committed_size=None):
+    finished = datetime.now().isoformat(timespec="seconds")
+    with connection:
+        connection.executemany("INSERT OR REPLACE INTO files (filepath, dir, status, detections, duration, output, finished) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                               [(header["filepath"], os.path.dirname(header["filepath"]), header.get("status") or ("ok" if detections else "empty"), detections, header.get("duration"), output, finished) for header, detections in headers])
+        connection.execute("UPDATE outputs SET committed_size = ? WHERE path = ?", (committed_size, output))
+
+""" Marks the output file as complete (moved from its part file), or forgets the output and its recordings when it is not kept (cancelled) """
+def finish_output(path, output, keep=True):
+    with closing(open_log(path)) as connection, connection:
+        if keep:
+            connection.execute("UPDATE outputs SET done = 1 WHERE path = ?", (output,))
+        else:
+            connection.execute("DELETE FROM files WHERE output = ?", (output,))
+            connection.execute("DELETE FROM outputs WHERE path = ?", (output,))
+
+""" Recovers the output files of an interrupted analysis: csv and arrow part files are cut off after the last logged recordings and moved to their output path.
+    Parquet part files can't be read without their footer, so they are removed and their recordings are analysed again """
+def recover_outputs(connection):
+    outputs = connection.execute("SELECT path, part_path, output_format, committed_size FROM outputs WHERE done = 0").fetchall()
+
+    for output, part_path, output_format, committed_size in outputs:
+        if os.path.isfile(output) and not os.path.isfile(part_path): # Moved, but not logged yet
+            finish = True
+        elif output_format != "parquet" and committed_size and os.path.isfile(part_path):
+            with open(part_path, "r+b") as file:
+                file.truncate(committed_size)
+            os.replace(part_path, output)
+            print(f"Recovered output of interrupted analysis: {output}. ", end="")
+            finish = True
+        else:
+            if os.path.isfile(part_path): os.remove(part_path)
+            finish = False
+
+        with connection:
+            if finish:
+                connection.execute("UPDATE outputs SET done = 1 WHERE path = ?", (output,))
+            else:
+                connection.execute("DELETE FROM files WHERE output = ?", (output,))
+                connection.execute("DELETE FROM outputs WHERE path = ?", (output,))
@@ -1,19 +1,31 @@
-
 import os
 import numpy as np
 import warnings
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from fnmatch import fnmatchcase
+from functools import lru_cache
 from scipy.io import wavfile
 from scipy.io.wavfile import WavFileWarning
-from scipy.signal import butter, lfilter
+from scipy.signal import butter, sosfilt
+
+warnings.filterwarnings("ignore", category=WavFileWarning) # Throws warning for many wav files because it doesnt recognise the metadata. Audio data itself is still fine though
 
+FILTER_CHUNK = 2**16 # Samples filtered at once, small enough to stay in cache for the normalisation
+
+""" High-pass filter (5th order Butterworth, 15 kHz) as second-order sections, which stay stable in float32. Designed once per sample rate """
+@lru_cache(maxsize=None)
+def highpass_sos(fs, dtype=np.float32):
+    cutoff = 15_000 # 15kHz
+    return butter(5, cutoff, btype='high', fs=fs, output='sos').astype(dtype)
 
-""" Reads recording (with high-pass filter and error checks) """
-def read_clean_wav(filepath): 
-    warnings.filterwarnings("ignore", category=WavFileWarning) # Throws warning for many wav files because it doesnt recognise the metadata. Audio data itself is still fine though
-    
-    # Load file
+""" Loads the samples of a recording (memory mapped with mmap, which reads them from disk only when they are used). Logs unreadable and empty files and returns None, None for them """
+def load_wav(filepath, mmap=False):
     try:
-        fs, Audiodata = wavfile.read(filepath)
+        try:
+            fs, Audiodata = wavfile.read(filepath, mmap=mmap)
+        except ValueError:
+            if not mmap: raise
+            fs, Audiodata = wavfile.read(filepath) # Not every format can be memory mapped (e.g. 24-bit)
 
         if Audiodata.size == 0:
             with open(os.path.join(os.path.dirname(filepath), "corrupted_files_log.txt"), "a") as log:
@@ -25,31 +37,117 @@ def read_clean_wav(filepath):
             log.write(os.path.basename(filepath) + "\t" + str(e) + "\n")
         return None, None
 
-    if Audiodata.ndim == 2: Audiodata = Audiodata.mean(axis=1) # convert stereo to mono
+    return fs, Audiodata
 
-    # High-pass filter
-    cutoff = 15_000 # 15kHz
-    nyq = 0.5 * fs
-    normal_cutoff = cutoff / nyq
-    b, a = butter(5, normal_cutoff, btype='high', analog=False)
-    Audiodata = lfilter(b, a, Audiodata)
-    Audiodata = Audiodata / np.max(np.abs(Audiodata)) # normalise audio data
+""" Reads recording (with high-pass filter and error checks). Filters and normalises in 'dtype'.
+    With keep_int the (int16) samples are only converted per chunk in the filter step, instead of converting the whole recording first """
+def read_clean_wav(filepath, dtype=np.float32, keep_int=True): 
+    fs, Audiodata = load_wav(filepath)
+    if fs is None: return None, None
+
+    if not keep_int: Audiodata = Audiodata.astype(dtype)
+
+    Audiodata = highpass_normalise(Audiodata, fs, dtype)
 
     return fs, Audiodata
 
+""" Reads recording in chunks from a memory map, so only a few chunks are in memory at once (for very long recordings).
+    Returns the sample rate, the number of samples and a generator of the high-pass filtered and normalised chunks (None, None, None when the file can't be read).
+    normalise is "two_pass" to filter the recording twice, first only to find the peak (same output as read_clean_wav), or "running" to divide by the highest peak so far (single pass) """
+def stream_clean_wav(filepath, dtype=np.float32, normalise="two_pass", chunk_size=FILTER_CHUNK):
+    if normalise not in ("two_pass", "running"):
+        raise ValueError(f"Unknown normalisation: {normalise}")
+
+    fs, Audiodata = load_wav(filepath, mmap=True)
+    if fs is None: return None, None, None
+
+    def chunks():
+        peak = 0
+        if normalise == "two_pass":
+            for filtered in highpass_chunks(Audiodata, fs, dtype, chunk_size):
+                peak = max(peak, np.abs(filtered).max())
+
+        for filtered in highpass_chunks(Audiodata, fs, dtype, chunk_size):
+            if normalise == "running":
+                peak = max(peak, np.abs(filtered).max())
+                if peak == 0: # Leading silence stays silent until the first sound, instead of 0 / 0
+                    yield filtered
+                    continue
+            filtered /= peak # normalise audio data
+            yield filtered
+
+    return fs, len(Audiodata), chunks()
+
+""" High-pass filters audio data (samples or samples x channels, any dtype) chunk by chunk, carrying the filter state over between chunks. Channels are averaged to mono (per chunk) """
+def highpass_chunks(audio_data, fs, dtype=np.float32, chunk_size=FILTER_CHUNK):
+    sos = highpass_sos(fs, dtype)
+    zi = np.zeros((sos.shape[0], 2), dtype=dtype) # Filter state
+
+    for start in range(0, len(audio_data), chunk_size):
+        chunk = audio_data[start:start + chunk_size]
+        if chunk.ndim == 2: chunk = chunk.mean(axis=1, dtype=dtype) # convert stereo to mono
+
+        filtered, zi = sosfilt(sos, chunk.astype(dtype, copy=False), zi=zi)
+        yield filtered
+
+""" High-pass filters audio data and normalises it to a maximum of 1, in only two passes over the data (the peak is found while each chunk is still in cache) """
+def highpass_normalise(audio_data, fs, dtype=np.float32):
+    filtered = np.empty(len(audio_data), dtype=dtype)
+    peak = 0
+
+    start = 0
+    for chunk in highpass_chunks(audio_data, fs, dtype):
+        filtered[start:start + len(chunk)] = chunk
+        peak = max(peak, np.abs(chunk).max())
+        start += len(chunk)
+
+    filtered /= peak # normalise audio data
+
+    return filtered
+
 """ Get dirs that contain at least one wav file """
 def get_dirs_wav(head_dir_list):
+    return list(find_wav_files(head_dir_list))
+
+""" Finds the wav files in the dirs of head_dir_list (and all their subdirs with recursive) in a single pass, listing 'workers' dirs at once with os.scandir (faster on network shares).
+    include and exclude are (lists of) patterns of filenames (fnmatch, e.g. "*Chan08*"): only files that match an include pattern (when given) and no exclude pattern are found.
+    Returns {dir: [(path, size in bytes), ...] sorted by path} of the dirs that contain wav files, sorted by dir. Dirs that can't be read are skipped, like os.walk does """
+def find_wav_files(head_dir_list, recursive=True, include=None, exclude=None, workers=16):
     if not isinstance(head_dir_list, list): head_dir_list = [head_dir_list] # Make sure head_dir is a list
+    if isinstance(include, str): include = [include]
+    if isinstance(exclude, str): exclude = [exclude]
 
-    # Get list of paths to dirs containing wav files 
-    list_dirs = set()
-    for head_dir in head_dir_list:
-        for root, _, files in os.walk(head_dir):
-            for file in files:
-                
-                if not file.lower().endswith(".wav"):
-                    continue
+    def wanted(name):
+        if not name.lower().endswith(".wav"): return False
+        if include and not any(fnmatchcase(name, pattern) for pattern in include): return False
+        return not (exclude and any(fnmatchcase(name, pattern) for pattern in exclude))
+
+    found = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(scan_dir, str(head_dir), wanted) for head_dir in head_dir_list}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                dir, files, subdirs = future.result()
+                if files: found[dir] = sorted(files)
+                if recursive: pending |= {executor.submit(scan_dir, subdir, wanted) for subdir in subdirs}
 
-                list_dirs.add(root)
+    return dict(sorted(found.items()))
+
+""" Lists a single dir: returns the dir, the (path, size) of the files for which wanted(filename) is true and the paths of the subdirs (not following links to dirs) """
+def scan_dir(dir, wanted):
+    files, subdirs = [], []
+    try:
+        with os.scandir(dir) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif wanted(entry.name) and entry.is_file():
+                        files.append((entry.path, entry.stat().st_size))
+                except OSError: # Removed or unreadable while listing
+                    continue
+    except OSError:
+        pass
 
-    return list(list_dirs)
\ No newline at end of file
+    return dir, files, subdirs
@@ -0,0 +1,148 @@
+import ast
+import os
+import numpy as np
+import cv2
+import torch
+import torchvision
+from pathlib import Path
+from types import SimpleNamespace
+from ultralytics.engine.results import Boxes
+import source.visualise as vis
+
+MAX_DET = 300 # Maximum number of boxes per image, same as ultralytics
+MAX_NMS = 30_000 # Boxes with the highest confidence that go into the non maximum suppression, same as ultralytics
+MAX_WH = 7680 # Offset per class, so boxes of different classes never overlap in the non maximum suppression (same as ultralytics)
+
+""" Exports the PyTorch model at model_path to ONNX (with a dynamic batch size and image size) next to the weights and returns the path of the ONNX model.
+    The model is only exported again when the weights are newer than the exported model """
+def export_onnx(model_path):
+    onnx_path = Path(model_path).with_suffix(".onnx")
+    if onnx_path.exists() and os.stat(onnx_path).st_mtime >= os.stat(model_path).st_mtime:
+        return onnx_path
+
+    from ultralytics import YOLO
+    model = YOLO(model_path)
+    exported = model.export(format="onnx", dynamic=True, imgsz=model.overrides.get("imgsz", 640), simplify=False, verbose=False)
+
+    return Path(exported)
+
+""" Quantises the ONNX model at onnx_path to int8 next to it (static quantisation, QDQ) and returns the path of the int8 model.
+    The convolutions are quantised per channel, with the ranges of their inputs calibrated on the model input images that calibration() returns (see predict.calibration_images). The box decoding (DFL) stays in float.
+    The model is only quantised again when the ONNX model is newer, remove the int8 model to calibrate it again """
+def quantize_onnx(onnx_path, calibration, batch_size=8):
+    int8_path = Path(onnx_path).with_suffix(".int8.onnx")
+    if int8_path.exists() and os.stat(int8_path).st_mtime >= os.stat(onnx_path).st_mtime:
+        return int8_path
+
+    try:
+        import onnx
+        from onnxruntime.quantization import quantize_static, CalibrationDataReader, QuantFormat, QuantType
+        from onnxruntime.quantization.shape_inference import quant_pre_process
+    except ImportError as e:
+        raise ImportError("The int8 model needs onnx and onnxruntime (pip install onnx onnxruntime)") from e
+
+    images = calibration()
+    batches = iter([model_inputs(images[i:i + batch_size]) for i in range(0, len(images), batch_size)])
+
+    preprocessed = str(int8_path) + ".pre"
+    quant_pre_process(str(onnx_path), preprocessed, skip_symbolic_shape=True) # Shapes and folded constants, which quantisation needs
+    graph = onnx.load(preprocessed).graph
+    input_name = graph.input[0].name
+
+    class Reader(CalibrationDataReader):
+        def get_next(self):
+            batch = next(batches, None)
+            return None if batch is None else {input_name: batch}
+
+    try:
+        quantize_static(preprocessed, str(int8_path) + ".part", Reader(), quant_format=QuantFormat.QDQ, per_channel=True,
+                        activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8, op_types_to_quantize=["Conv"],
+                        nodes_to_exclude=[node.name for node in graph.node if "dfl" in node.name.lower()])
+        os.replace(str(int8_path) + ".part", int8_path) # Only complete models are reused
+    finally:
+        os.remove(preprocessed)
+
+    return int8_path
+
+""" Loads an exported model in ONNX Runtime (CPU), with the class names and model input layout (see vis.letterbox_layout) from its metadata.
+    Uses as many threads as torch, so the thread settings of the analysis apply to both backends """
+def load_onnx(onnx_path):
+    try:
+        import onnxruntime as ort
+    except ImportError as e:
+        raise ImportError("The onnx backend needs onnxruntime (pip install onnxruntime)") from e
+
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = torch.get_num_threads()
+    options.inter_op_num_threads = 1
+    session = ort.InferenceSession(str(onnx_path), sess_options=options, providers=["CPUExecutionProvider"])
+
+    metadata = session.get_modelmeta().custom_metadata_map
+    imgsz = ast.literal_eval(metadata.get("imgsz", "640"))
+    stride = max(int(metadata.get("stride", 32)), 32)
+
+    return {"backend": "onnx", "session": session, "input": session.get_inputs()[0].name, "names": ast.literal_eval(metadata["names"]),
+            "layout": vis.letterbox_layout(imgsz, stride), "end2end": metadata.get("end2end") == "True"}
+
+""" Predicts images with an ONNX model (see load_onnx) in a single batch and returns results like model.predict(): boxes on the spectrogram image (vis.IMG_SIZE), the original shape and the class names.
+    With tensor_input the images are model input images (RGB, see predict.model_input_layout), otherwise spectrogram images (BGR) that are resized and padded like ultralytics does """
+def predict_onnx(model, img_array, tensor_input=False, conf=0.1, iou=0.4):
+    layout = model["layout"]
+    inputs = model_inputs(img_array if tensor_input else [letterbox(img, layout) for img in img_array])
+
+    predictions = model["session"].run(None, {model["input"]: inputs})[0]
+
+    orig_shape = vis.IMG_SIZE[::-1]
+    results = []
+    for detections in non_max_suppression(predictions, conf=conf, iou=iou, end2end=model["end2end"]):
+        # Remove padding and scaling of the layout
+        detections[:, [0, 2]] = ((detections[:, [0, 2]] - layout["left"]) / layout["scale"]).clip(0, orig_shape[1])
+        detections[:, [1, 3]] = ((detections[:, [1, 3]] - layout["top"]) / layout["scale"]).clip(0, orig_shape[0])
+        results.append(SimpleNamespace(boxes=Boxes(detections, orig_shape), orig_shape=orig_shape, names=model["names"]))
+
+    return results
+
+""" Batch of model input images (height x width x 3, RGB) as the input of the network: batch x channels x height x width, 0-1 """
+def model_inputs(images):
+    return np.ascontiguousarray(np.stack(images).transpose(0, 3, 1, 2), dtype=np.float32) / 255
+
+""" Spectrogram image (BGR) resized (bilinear) and padded to the model input layout as RGB, the same as the LetterBox of ultralytics """
+def letterbox(img, layout):
+    width, height = layout["size"]
+    model_input = np.full(layout["shape"] + (3,), vis.PAD_VALUE, dtype=np.uint8)
+    resized = cv2.resize(img, (width, height), interpolation=cv2.INTER_LINEAR) if img.shape[:2] != (height, width) else img
+    model_input[layout["top"]:layout["top"] + height, layout["left"]:layout["left"] + width] = resized[..., ::-1]
+
+    return model_input
+
+""" Non maximum suppression of the raw output of a batch (batch x 4 + classes x anchors), the same as ultralytics with a single class per box.
+    Returns an array per image with a row per box: x_min, y_min, x_max, y_max, confidence, class """
+def non_max_suppression(predictions, conf=0.1, iou=0.4, end2end=False):
+    if end2end or predictions.shape[-1] == 6: # Model that does its own suppression (batch x boxes x 6)
+        return [pred[pred[:, 4] > conf][:MAX_DET].astype(np.float32) for pred in predictions]
+
+    output = []
+    for pred in predictions.transpose(0, 2, 1): # Anchors x 4 + classes
+        scores = pred[:, 4:]
+        classes = scores.argmax(1)
+        confidence = scores[np.arange(len(scores)), classes]
+        keep = confidence > conf
+        boxes, confidence, classes = xywh_to_xyxy(pred[keep, :4]), confidence[keep], classes[keep]
+
+        order = np.argsort(-confidence, kind="stable")[:MAX_NMS]
+        offset = (classes[order, None] * MAX_WH).astype(np.float32) # In float32 like ultralytics, so overlaps close to iou are decided the same
+        selected = nms(boxes[order] + offset, confidence[order], iou)[:MAX_DET]
+        order = order[selected]
+
+        output.append(np.concatenate((boxes[order], confidence[order, None], classes[order, None]), axis=1).astype(np.float32))
+
+    return output
+
+""" Boxes as centre x, centre y, width, height to corners """
+def xywh_to_xyxy(boxes):
+    xy, half = boxes[:, :2], boxes[:, 2:] / 2
+    return np.concatenate((xy - half, xy + half), axis=1)
+
+""" Indices of the boxes that don't overlap more than iou with a box of higher confidence, highest confidence first. Uses the compiled nms of torchvision, like ultralytics """
+def nms(boxes, confidence, iou):
+    return torchvision.ops.nms(torch.from_numpy(boxes), torch.from_numpy(confidence), iou).numpy()
@@ -0,0 +1,202 @@
+import queue
+import time
+import multiprocessing as mp
+import numpy as np
+from multiprocessing import shared_memory
+from source.workers import get_model
+from source.scheduler import setup_worker
+from source.predict import recording_to_images, predict_images, results_to_block, empty_block
+
+_image_queue = None # Queue to the inference processes, set per render worker by init_render_worker
+_image_slots = None # Image slots in shared memory of this process as (slots, shared memory, slot arrays), see attach_image_slots
+
+""" Creates n_slots images of 'shape' (uint8) in shared memory, and a queue with the numbers of the free slots.
+    Render workers render into free slots and only send the slot numbers to the inference processes, which release the slots after predicting them, so images aren't pickled.
+    Returns the shared memory (to unlink when done) and the slots to pass to the processes """
+def create_image_slots(n_slots, shape):
+    shm = shared_memory.SharedMemory(create=True, size=n_slots * int(np.prod(shape)))
+    free = mp.Queue()
+    for slot in range(n_slots):
+        free.put(slot)
+
+    return shm, {"name": shm.name, "n_slots": n_slots, "shape": tuple(shape), "free": free, "lock": mp.Lock()}
+
+""" Makes the image slots in shared memory available in this process (as a numpy view, without copying) """
+def attach_image_slots(image_slots):
+    global _image_slots
+    shm = shared_memory.SharedMemory(name=image_slots["name"])
+    images = np.ndarray((image_slots["n_slots"],) + image_slots["shape"], dtype=np.uint8, buffer=shm.buf)
+    _image_slots = (image_slots, shm, images)
+
+""" Returns the function that gives the slots to render the n images of a recording in. Takes all n slots at once, so render workers can't all wait for slots that the others hold.
+    The taken slots are added to 'taken'. Returns None (render as usual) when a recording has more images than there are slots """
+def _slot_buffers(taken):
+    image_slots, _, images = _image_slots
+
+    def buffers(n):
+        if n > image_slots["n_slots"]: return None
+
+        with image_slots["lock"]:
+            taken.extend(image_slots["free"].get() for _ in range(n)) # Waits until the inference processes released enough slots
+
+        return [images[slot] for slot in taken]
+
+    return buffers
+
+""" Gives the image slots back after their images are predicted (or not needed anymore) """
+def release_slots(slots):
+    for slot in slots:
+        _image_slots[0]["free"].put(slot)
+
+""" Gives a render worker access to the queue that is read by the inference processes (and to the image slots in shared memory, when used) """
+def init_render_worker(image_queue, image_slots=None, threads=None, cores=None):
+    global _image_queue
+    setup_worker(threads, cores)
+    _image_queue = image_queue
+    if image_slots is not None: attach_image_slots(image_slots)
+
+""" Renders the spectrograms of a single wav file and hands them to the inference processes (runs in render worker) """
+def render_to_queue(wav_file, output_size=1, overlap=0, colour_scale="jet", cancel_event=None, shared_stft=False, renderer="lut", layout=None, stream=False, normalise="two_pass"):
+    taken = [] # Image slots the images are rendered in
+    queued = False
+    try:
+        buffers = _slot_buffers(taken) if _image_slots is not None else None
+        images = recording_to_images(wav_file, output_size=output_size, overlap=overlap, colour_scale=colour_scale, cancel_event=cancel_event, shared_stft=shared_stft, renderer=renderer, layout=layout, stream=stream, normalise=normalise, buffers=buffers)
+
+        if cancel_event and cancel_event.is_set(): # Inference processes may already be stopped, so don't wait on the queue
+            return wav_file
+
+        img_array, filenames, offsets = images if images is not None else ([], [], [])
+        if images is None: # Unreadable recording, the slots it took aren't used
+            release_slots(taken)
+            taken = []
+        if taken: img_array = [] # Images are in the slots
+        _image_queue.put((wav_file, img_array, filenames, offsets, taken)) # Always put something on the queue, so every file gets a result
+        queued = True
+
+    finally: # Slots that aren't queued (unreadable recording, cancelled or an error) are released, the inference processes release the others
+        if not queued and taken: release_slots(taken)
+
+    return wav_file
+
+""" Runs the model on one batch of images and sends the results of recordings that are complete back to the main process """
+def _predict_batch(model, batch, result_queue, tensor_input=False, precision="fp32"):
+    results = predict_images(model=model, img_array=[img for _, img, _, _ in batch], tensor_input=tensor_input, precision=precision)
+    release_slots([slot for _, _, _, slot in batch if slot is not None])
+
+    for (entry, _, segment, _), result in zip(batch, results):
+        entry["results"].append(result)
+        entry["segments"].append(segment)
+        entry["remaining"] -= 1
+
+        if entry["remaining"] == 0:
+            filenames, offsets = zip(*entry["segments"])
+            block = results_to_block(results=entry["results"], filenames=filenames, wav_path=entry["wav_file"], offsets=offsets)
+            block[0]["duration"] = time.perf_counter() - entry["start"] # From the arrival of the images until all are predicted
+            result_queue.put((entry["wav_file"], block))
+
+""" Collects images of many recordings into batches of batch_size (or less when max_wait seconds passed) and predicts them. Stops at None """
+def inference_loop(model, image_queue, result_queue, batch_size=64, max_wait=0.5, tensor_input=False, precision="fp32"):
+    pending = [] # Images waiting for prediction as (recording entry, image, (filename, start time), image slot)
+    deadline = None
+    running = True
+
+    while running or pending:
+        if running:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                item = image_queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False # Deadline passed without new images
+
+            if item is None:
+                running = False
+
+            elif item:
+                wav_file, img_array, filenames, offsets, slots = item
+
+                if slots: # Images are in shared memory, viewed the same way as the images viz_audio_segment returns
+                    images = _image_slots[2]
+                    img_array = [images[slot] if tensor_input else images[slot][..., ::-1] for slot in slots]
+
+                if len(img_array) == 0: # Unreadable or empty recording, nothing to predict
+                    result_queue.put((wav_file, empty_block(wav_file, status="corrupt")))
+                    continue
+
+                entry = {"wav_file": wav_file, "results": [], "segments": [], "remaining": len(img_array), "start": time.perf_counter()}
+                pending.extend((entry, img, segment, slot) for img, segment, slot in zip(img_array, zip(filenames, offsets), slots or [None] * len(img_array)))
+                if deadline is None: deadline = time.monotonic() + max_wait
+
+        # Predict full batches, and whatever is left when waited long enough or when stopping
+        while len(pending) >= batch_size:
+            _predict_batch(model, pending[:batch_size], result_queue, tensor_input, precision)
+            pending = pending[batch_size:]
+            deadline = time.monotonic() + max_wait if pending else None
+
+        if pending and (not running or time.monotonic() >= deadline):
+            _predict_batch(model, pending, result_queue, tensor_input, precision)
+            pending = []
+            deadline = None
+
+""" Entry point of an inference process """
+def inference_worker(model_path, image_queue, result_queue, batch_size=64, max_wait=0.5, model=None, tensor_input=False, image_slots=None, precision="fp32", threads=None, cores=None):
+    setup_worker(threads, cores)
+    if model is None: model = get_model(model_path)
+    if image_slots is not None: attach_image_slots(image_slots)
+    inference_loop(model, image_queue, result_queue, batch_size=batch_size, max_wait=max_wait, tensor_input=tensor_input, precision=precision)
+
+""" Starts the inference processes (that use 'model' when it's loaded already). Returns the queues that connect them to the render workers and main process.
+    With tensor_input the render workers put model input images on the queue (see predict.model_input_layout). With image_slots (see create_image_slots) they put the slots of the images on the queue instead """
+def start_inference(model_path, inference_proc=1, batch_size=64, max_wait=0.5, queue_size=64, model=None, tensor_input=False, image_slots=None, precision="fp32", threads=None, cores=None):
+    image_queue = mp.Queue(maxsize=queue_size) # Limits the number of rendered recordings waiting in memory
+    result_queue = mp.Queue()
+
+    processes = []
+    for _ in range(inference_proc):
+        p = mp.Process(target=inference_worker, args=(model_path, image_queue, result_queue, batch_size, max_wait, model, tensor_input, image_slots, precision, threads, cores), daemon=True)
+        p.start()
+        processes.append(p)
+
+    return image_queue, result_queue, processes
+
+""" Stops the inference processes after they finished the images that are still queued, and frees the shared memory of the image slots (when given).
+    Without wait (after an error) they are terminated right away: their results may never be read, which would keep them from stopping """
+def stop_inference(image_queue, processes, shm=None, wait=True):
+    if wait:
+        for _ in processes:
+            image_queue.put(None)
+    for p in processes:
+        if not wait: p.terminate()
+        p.join()
+
+    if shm is not None:
+        shm.close()
+        shm.unlink()
+
+""" Renders files in the render workers and yields (wav_file, block of detections) in the order the inference processes finish them.
+    With max_pending only that many files are rendered or predicted at once, and file_paths (any iterable) is read as files are done """
+def predict_files(executor, file_paths, result_queue, processes, max_pending=None, **render_kwargs):
+    file_paths = iter(file_paths)
+    futures = [] # Render tasks that may not be done yet
+    submitted = received = 0
+
+    while True:
+        while (max_pending is None or submitted - received < max_pending) and (wav_file := next(file_paths, None)) is not None:
+            futures.append(executor.submit(render_to_queue, wav_file, **render_kwargs))
+            submitted += 1
+
+        if received == submitted: return
+
+        while True:
+            try:
+                result = result_queue.get(timeout=1)
+                break
+            except queue.Empty:
+                # Make sure we don't wait forever on files that will never arrive
+                failed = [f for f in futures if f.done() and f.exception() is not None]
+                if failed: raise failed[0].exception()
+                futures = [f for f in futures if not f.done()]
+                if not any(p.is_alive() for p in processes): raise RuntimeError("Inference processes stopped unexpectedly")
+
+        received += 1
+        yield result
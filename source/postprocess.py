@@ -2,6 +2,8 @@ import os, glob
 import numpy as np
 import pandas as pd
 import networkx as nx
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
 
 """ Finds instances where calls start or end at the same time, and groups these in start-groups or end-groups """
 def assign_groups(g, threshold):
@@ -33,7 +35,20 @@ def merge_via_graph(g):
     g['group_nr'] = g['start_group'].map(comp_map)
     return g
 
-""" Finds calls (within the same category and file) that start or end at the same time and merges these """
+""" Group number of every row of sorted values (within sorted keys): values that are at most threshold apart (chained) get the same number. NaN values get a group of their own. Same grouping as assign_groups """
+def _threshold_groups(keys, values, threshold):
+    order = np.lexsort((values, keys)) # NaN values sort last within a key
+    sorted_keys, sorted_values = keys[order], values[order]
+
+    new_group = np.ones(len(order), dtype=bool)
+    new_group[1:] = (sorted_keys[1:] != sorted_keys[:-1]) | ~(np.diff(sorted_values) <= threshold)
+
+    groups = np.empty(len(order), dtype=np.intp)
+    groups[order] = np.cumsum(new_group) - 1
+    return groups
+
+""" Finds calls (within the same category and file) that start or end at the same time and merges these.
+    Vectorised over the whole DataFrame, gives the same result as applying assign_groups, merge_via_graph and nlargest per file and category """
 def overlap_tidy(df, threshold=5):
     df = df.copy()
 
@@ -44,30 +59,34 @@ def overlap_tidy(df, threshold=5):
     # Only keep Feeding buzz and Social call categories
     df = df[df['category'] != "Other"]
 
-    # Check if calls (within a file and the same category) start or end at the same time and assign these to the same group number  
-    df_out = []
-    counter = 1
-    for (fname, cat), g in df.groupby(['filename', 'category'], group_keys=False):
-        g2 = assign_groups(g, threshold)
-        g3 = merge_via_graph(g2)
-        g2['filename'] = fname
-        g2['category'] = cat
-        df_out.append(g3)
-    df = pd.concat(df_out, ignore_index=True)
-
-    # When calls start or end at the same time, take the one with the highest confidence
-    df_out = []
-    for (fname, cat, group_nr), g in df.groupby(['filename', 'category', 'group_nr'], group_keys=False):
-        best_row = g.nlargest(1, 'confidence')
-        best_row = best_row.copy()
-        best_row['filename'] = fname
-        best_row['category'] = cat
-        best_row['group_nr'] = group_nr
-        df_out.append(best_row)
-    df_out = pd.concat(df_out, ignore_index=True)
-
-    # Remove helper columns and return
-    return df_out.drop(columns=['start_group', 'end_group', 'group_nr'])
+    # Number the (filename, category) combinations in sorted order, rows with a missing filename or category are dropped (like groupby)
+    keys = df.groupby(['filename', 'category'], sort=True, observed=True).ngroup().to_numpy()
+    df, keys = df[keys >= 0], keys[keys >= 0]
+
+    # Calls that start or end at the same time get the same start or end group (numbered over all files and categories)
+    start_groups = _threshold_groups(keys, df['start_time_ms'].to_numpy(dtype=float), threshold)
+    end_groups = _threshold_groups(keys, df['end_time_ms'].to_numpy(dtype=float), threshold)
+
+    # Link start and end groups: calls connected by a shared start or end group end up in the same group
+    n_start = start_groups.max() + 1 if len(df) else 0
+    n_nodes = n_start + (end_groups.max() + 1 if len(df) else 0)
+    links = csr_matrix((np.ones(len(df), dtype=bool), (start_groups, end_groups + n_start)), shape=(n_nodes, n_nodes))
+    _, node_groups = connected_components(links, directed=False)
+    groups = node_groups[start_groups]
+
+    # Take the call with the highest confidence per group (the first one when equal, NaN counts as lowest)
+    confidence = df['confidence'].to_numpy(dtype=float)
+    order = np.lexsort((np.arange(len(df)), -confidence, groups))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = groups[order][1:] != groups[order][:-1]
+    best = order[first]
+
+    # Sort per file and category, with groups in order of their first call (same order as the group numbers of merge_via_graph)
+    first_row = np.full(n_nodes, len(df))
+    np.minimum.at(first_row, groups, np.arange(len(df)))
+    best = best[np.lexsort((first_row[groups[best]], keys[best]))]
+
+    return df.iloc[best].reset_index(drop=True)
 
 
 if __name__ == "__main__":
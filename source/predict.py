@@ -1,143 +1,444 @@
 
 import ntpath
+import math
+from itertools import islice
+from functools import partial, lru_cache
 import os
+import time
 from pathlib import Path
 import source.visualise as vis
+import numpy as np
+import pandas as pd
 import torch
 import warnings
-from source.misc import read_clean_wav
+from types import SimpleNamespace
+from ultralytics.engine.results import Boxes
+from ultralytics.utils import nms, ops
+from source.misc import read_clean_wav, stream_clean_wav
+from source.workers import get_model
+import source.cache as result_cache
+import source.onnx_backend as onnx_backend
 
 warnings.filterwarnings("ignore", "You are using `torch.load` with `weights_only=False`*.")
 
-""" Predicts based on nparray (data of spectogram) and outputs tabular data """
+COLUMNS = {"filename": "category", "filepath": "category", "category": "category", "confidence": np.float64, "start_time_ms": np.int64, "end_time_ms": np.int64, "freq_min": np.int64, "freq_max": np.int64} # Columns of the predictions and their types
+CONF = 0.1 # Minimum confidence of detections
+IOU = 0.4 # Detections that overlap more are suppressed (non maximum suppression)
+BACKENDS = ("torch", "onnx") # Backends that run the model: PyTorch (ultralytics) or ONNX Runtime on the CPU (see onnx_backend)
+PRECISIONS = ("fp32", "bf16", "int8") # Precision of the model: full, bfloat16 (torch backend, CPUs with bf16 support) or int8 (onnx backend, quantised with calibration on spectrograms, see onnx_backend.quantize_onnx)
+CALIBRATION_IMAGES = 64 # Spectrograms the int8 model is calibrated on
+DETECTION_DTYPE = np.dtype([("category", np.int16), ("confidence", np.float32), ("start_time_ms", np.int32), ("end_time_ms", np.int32), ("freq_min", np.int16), ("freq_max", np.int16)]) # Detections sent from the workers (see results_to_block), 16 bytes per box
+
+""" Predicts based on nparray (data of spectogram) and outputs tabular data (a DataFrame with COLUMNS) """
 def predict_sono(model,
                  img_array,
                  filenames,
                  wav_path,
                  save_directory=R"kaas",
-                 save=False):
+                 save=False,
+                 tensor_input=False, # True when img_array holds model input images (see model_input_layout)
+                 offsets=None, # Start times (ms) of the segments of the images, read from the filenames when not given
+                 backend="torch", # "torch" or "onnx" to predict with ONNX Runtime on the CPU, with the model exported once next to its weights (see backend_model)
+                 precision="fp32"): # "fp32" or "bf16" to predict in bfloat16 (torch backend). int8 models are made with model_for_precision
 
     if save and save_directory == R"kaas":
         raise ValueError("Define save dir before continuing")
 
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    model.to(device)
-
     subfolder_name = "img_predict"
     if save: os.makedirs(os.path.join(save_directory, subfolder_name), exist_ok=True)
 
-    # Use these values in the model.predict() call
-    results = model.predict(source=img_array, 
-                            save=save, 
-                            verbose=False,
-                            device=device,
-                            # project=os.path.join(save_directory, subfolder_name), 
-                            # name="", 
-                            conf=0.1, iou=0.4)
-
-    # Data to tabular format
-    csv_data = []
-    for idx, result in enumerate(results):
-
-        for box in result.boxes:
-            # Extract bounding box information
-            x_min, y_min, x_max, y_max = box.xyxy[0].tolist()
-
-            # Timing and frequency
-            height, width = result.orig_shape[:2]
-            y_min_corrected = height - y_max  # Reverse y_min if spectrogram has reversed y-axis
-            y_max_corrected = height - y_min  # Reverse y_max if spectrogram has reversed y-axis
-
-            filename_stem = os.path.splitext(filenames[idx])[0]
-
-            start_file = (int(filename_stem.split("_")[-2]))
-            start_time = f"{(x_min / width) * 1000 + start_file :.0f}"  # Start time in ms
-            end_time = f"{(x_max / width) * 1000 + start_file :.0f}"    # End time in ms
-
-            # Frequency range calculations
-            freq_min = f"{y_min_corrected * (120 / height) :.0f}"  # Min frequency in kHz
-            freq_max = f"{y_max_corrected * (120 / height) :.0f}"  # Max frequency in kHz
-
-            # Other metadata
-            category = result.names[int(box.cls[0])]  # Get category name
-            confidence = float(box.conf[0])  # Get confidence score
-
-            # Prepare row for CSV
-            csv_data.append({
-                "filename": os.path.basename(wav_path),
-                "filepath": wav_path,
-                "category": category,
-                "confidence": confidence,
-                "start_time_ms": start_time,
-                "end_time_ms": end_time,
-                "freq_min": freq_min,
-                "freq_max": freq_max
-            })
-
-    return csv_data 
-
-""" Function to process a single wav file with overlapping segments """
-def recording_to_predict(wav_file, model, output_size=1, overlap=0, colour_scale="jet", write_plot=False, cancel_event=None):
-    fs, Audiodata = read_clean_wav(wav_file)
-
-    if fs is None or Audiodata is None:
-        return []
+    results = predict_images(model=backend_model(model, backend), img_array=img_array, save=save, tensor_input=tensor_input, precision=precision)
+
+    return results_to_rows(results=results, filenames=filenames, wav_path=wav_path, offsets=offsets)
+
+""" Model that predicts with the backend: the model itself for "torch", and the model exported to ONNX (once, see onnx_backend.export_onnx) and loaded in ONNX Runtime for "onnx". model is a model or the path of its weights """
+def backend_model(model, backend="torch"):
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend: {backend}")
+
+    if backend == "torch" or isinstance(model, dict): return model # dict: already an ONNX Runtime model
+
+    model_path = model.ckpt_path if hasattr(model, "ckpt_path") else model
+    return get_model(onnx_backend.export_onnx(model_path))
+
+""" Path of the model that predicts with the backend and precision: the weights for "torch", the model exported to ONNX for "onnx", and the exported model quantised to int8 for "int8" (once, see onnx_backend.quantize_onnx).
+    The int8 model is calibrated on CALIBRATION_IMAGES spectrograms of recordings spread over calibration_files """
+def model_for_precision(model_path, backend="torch", precision="fp32", calibration_files=()):
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend: {backend}")
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision: {precision}")
+    if precision == "bf16" and backend != "torch":
+        raise ValueError("precision='bf16' needs backend='torch'")
+    if precision == "int8" and backend != "onnx":
+        raise ValueError("precision='int8' needs backend='onnx'")
+    if precision == "bf16" and not torch.cuda.is_available() and not torch.ops.mkldnn._is_mkldnn_bf16_supported():
+        print("This CPU has no bfloat16 support, predicting in bf16 will be slower than in fp32")
+
+    if backend == "torch": return model_path
+
+    onnx_path = onnx_backend.export_onnx(model_path)
+    if precision == "fp32": return onnx_path
+
+    layout = get_model(onnx_path)["layout"]
+    return onnx_backend.quantize_onnx(onnx_path, partial(calibration_images, calibration_files, layout))
+
+""" Model input images (see model_input_layout) of CALIBRATION_IMAGES segments, taken evenly from at most CALIBRATION_IMAGES recordings spread over wav_files """
+def calibration_images(wav_files, layout, n_images=CALIBRATION_IMAGES):
+    wav_files = list(wav_files)
+    step = max(len(wav_files) / n_images, 1)
+    selected = [wav_files[int(i * step)] for i in range(min(len(wav_files), n_images))]
+
+    images = []
+    for i, wav_file in enumerate(selected):
+        recording_images = iter_recording_images(wav_file, layout=layout)
+        if recording_images is None: continue # Can't be read
+
+        per_file = math.ceil((n_images - len(images)) / (len(selected) - i))
+        images.extend(img for img, _, _ in islice(recording_images, per_file))
+
+    if not images:
+        raise ValueError("No recordings to calibrate the int8 model on")
+
+    return images
+
+""" Device the PyTorch models predict on """
+@lru_cache(maxsize=None)
+def inference_device():
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+""" Layout of the model input (see vis.letterbox_layout), for the image size and stride the model predicts with """
+def model_input_layout(model):
+    if isinstance(model, dict): return model["layout"] # ONNX Runtime model
+    stride = max(int(model.model.stride.max()), 32)
+    return vis.letterbox_layout(model.overrides.get("imgsz", 640), stride)
+
+""" Runs the model on a list of spectrogram images (can contain images of multiple recordings).
+    With tensor_input the images are already rendered in the model input layout (RGB, padded) and go into the network as one tensor, without the preprocessing of model.predict().
+    ONNX Runtime models (see onnx_backend.load_onnx) always predict the images as one batch, in the precision they are exported in.
+    With precision "bf16" PyTorch models predict in bfloat16 (autocast), which is faster on CPUs with bf16 support """
+def predict_images(model, img_array, save=False, tensor_input=False, precision="fp32"):
+    if isinstance(model, dict):
+        return onnx_backend.predict_onnx(model, img_array, tensor_input=tensor_input, conf=CONF, iou=IOU)
+
+    device = inference_device()
+    model.to(device)
+
+    with torch.autocast(device.type, dtype=torch.bfloat16, enabled=precision == "bf16"):
+        if tensor_input:
+            return predict_tensor(model, img_array, device)
+
+        # Use these values in the model.predict() call
+        results = model.predict(source=img_array, 
+                                save=save, 
+                                verbose=False,
+                                device=device,
+                                # project=os.path.join(save_directory, subfolder_name), 
+                                # name="", 
+                                conf=CONF, iou=IOU)
+
+    return results
+
+""" Predicts model input images (height x width x 3, RGB) in a single batch. Boxes are mapped back to the spectrogram image (vis.IMG_SIZE), like the results of model.predict() """
+def predict_tensor(model, img_array, device):
+    network = model.model.eval()
+    if hasattr(network, "fuse") and not network.is_fused(): network.fuse(verbose=False) # Same as model.predict()
+
+    images = torch.from_numpy(np.stack(img_array)).to(device)
+    images = images.permute(0, 3, 1, 2).contiguous().float().div_(255) # Batch x channels x height x width, 0-1
+
+    with torch.inference_mode():
+        predictions = network(images)
+    if isinstance(predictions, (list, tuple)): predictions = predictions[0]
+    predictions = predictions.float() # bfloat16 with precision "bf16"
+
+    detections = nms.non_max_suppression(predictions, conf_thres=CONF, iou_thres=IOU, end2end=getattr(network, "end2end", False))
+
+    # Remove padding and scaling of the layout
+    layout = model_input_layout(model)
+    orig_shape = vis.IMG_SIZE[::-1]
+    results = []
+    for boxes in detections:
+        boxes[:, :4] = ops.scale_boxes(images.shape[2:], boxes[:, :4], orig_shape, ratio_pad=((layout["scale"], layout["scale"]), (layout["left"], layout["top"])))
+        results.append(SimpleNamespace(boxes=Boxes(boxes.cpu(), orig_shape), orig_shape=orig_shape, names=model.names))
+
+    return results
+
+""" Converts model results of a single recording to a table with a row per box (see blocks_to_frame) """
+def results_to_rows(results, filenames, wav_path, offsets=None):
+    return blocks_to_frame([results_to_block(results=results, filenames=filenames, wav_path=wav_path, offsets=offsets)])
+
+""" Converts model results of a single recording to a block of detections: (header, detections) with the file and category names in the header and a structured array (DETECTION_DTYPE) with a row per box.
+    The category of a box is its class number, the index of its name in header["names"]. Times (ms) and frequencies (kHz) are rounded to whole numbers and computed for the boxes of all results at once.
+    offsets are the start times (ms) of the segments of the results, read from the filenames when not given """
+def results_to_block(results, filenames, wav_path, offsets=None):
+    if offsets is None: offsets = [int(os.path.splitext(filename)[0].split("_")[-2]) for filename in filenames]
+
+    # Boxes of all results, with the offset and image size of their segment per box
+    boxes, confidence, category, offset, height, width = [], [], [], [], [], []
+    for result, start_file in zip(results, offsets):
+        n = len(result.boxes)
+        if n == 0: continue
+
+        boxes.append(_to_numpy(result.boxes.xyxy).reshape(n, 4))
+        confidence.append(_to_numpy(result.boxes.conf).reshape(n))
+        category.append(_to_numpy(result.boxes.cls).reshape(n))
+        offset.append(np.full(n, start_file, dtype=np.float64))
+        height.append(np.full(n, result.orig_shape[0], dtype=np.float64))
+        width.append(np.full(n, result.orig_shape[1], dtype=np.float64))
+
+    if not boxes:
+        return empty_block(wav_path)
+
+    x_min, y_min, x_max, y_max = np.concatenate(boxes).astype(np.float64).T
+    offset, height, width = np.concatenate(offset), np.concatenate(height), np.concatenate(width)
+
+    # Timing and frequency, the spectrogram has a reversed y-axis
+    detections = np.empty(len(x_min), dtype=DETECTION_DTYPE)
+    detections["category"] = np.concatenate(category)
+    detections["confidence"] = np.concatenate(confidence)
+    detections["start_time_ms"] = np.rint((x_min / width) * 1000 + offset) # Start time in ms
+    detections["end_time_ms"] = np.rint((x_max / width) * 1000 + offset)   # End time in ms
+    detections["freq_min"] = np.rint((height - y_max) * (120 / height))    # Min frequency in kHz
+    detections["freq_max"] = np.rint((height - y_min) * (120 / height))    # Max frequency in kHz
+
+    names = results[0].names
+    header = {"filename": os.path.basename(wav_path), "filepath": wav_path, "names": tuple(names.get(i) for i in range(max(names) + 1))}
+
+    return header, detections
+
+""" Block of detections (see results_to_block) of a recording without detections. status "corrupt" marks recordings that can't be read """
+def empty_block(wav_path, status=None):
+    header = {"filename": os.path.basename(wav_path), "filepath": wav_path, "names": ()}
+    if status is not None: header["status"] = status
+
+    return header, np.empty(0, dtype=DETECTION_DTYPE)
+
+""" Block of detections with the detections of several blocks of the same recording (predicted in batches) """
+def concat_blocks(blocks):
+    headers, detections = zip(*blocks)
+    header = max(headers, key=lambda header: len(header["names"])) # Blocks without detections have no names
+
+    return header, np.concatenate(detections)
+
+""" Converts blocks of detections (see results_to_block) to one table with COLUMNS, without creating Python objects per row.
+    The file and category names are categorical columns, with their categories sorted """
+def blocks_to_frame(blocks):
+    blocks = [(header, detections) for header, detections in blocks if len(detections)]
+    if not blocks:
+        return pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in COLUMNS.items()})
+
+    headers, detections = zip(*blocks)
+    lengths = [len(block) for block in detections]
+    detections = np.concatenate(detections)
+
+    # Category codes of the blocks to codes of all category names
+    names = sorted({name for header in headers for name in header["names"] if name is not None})
+    codes = {name: code for code, name in enumerate(names)}
+    category = np.empty(len(detections), dtype=np.int64)
+    for header, start, end in zip(headers, np.cumsum(lengths) - lengths, np.cumsum(lengths)):
+        category[start:end] = np.array([codes.get(name, -1) for name in header["names"]], dtype=np.int64)[detections["category"][start:end]]
+
+    columns = {}
+    for column in ["filename", "filepath"]:
+        values, inverse = np.unique(np.array([header[column] for header in headers], dtype=object), return_inverse=True)
+        columns[column] = pd.Categorical.from_codes(np.repeat(inverse, lengths), categories=values)
+
+    columns["category"] = pd.Categorical.from_codes(category, categories=names)
+    for column in ["confidence", "start_time_ms", "end_time_ms", "freq_min", "freq_max"]:
+        columns[column] = detections[column].astype(COLUMNS[column])
+
+    return pd.DataFrame(columns)
+
+""" Returns a tensor (of the results of the model) or array as numpy array """
+def _to_numpy(values):
+    return values.cpu().numpy() if hasattr(values, "cpu") else np.asarray(values)
+
+""" Function to process a single wav file with overlapping segments, returns a block of detections (see results_to_block). Segments are predicted in batches of batch_size as they are rendered, so the images of a long recording are never in memory all at once.
+    With stream the recording is read in chunks (see stream_clean_wav) instead of loading it whole. The seconds it took are in header["duration"] of the block.
+    With a cache (see cache.open_cache) the detections are taken from the cache when the recording was analysed before with the same model and parameters, and stored in it otherwise.
+    With an image_cache (see cache.open_image_cache) the spectrogram images are read from it instead of rendered when they were rendered before with the same parameters, e.g. to compare models on the same recordings """
+def recording_to_predict(wav_file, model, output_size=1, overlap=0, colour_scale="jet", write_plot=False, cancel_event=None, shared_stft=False, renderer="lut", tensor_input=False, stream=False, normalise="two_pass", batch_size=64, cache=None, image_cache=None, precision="fp32"):
+    start = time.perf_counter()
+
+    if cache is not None:
+        params = result_parameters(output_size=output_size, overlap=overlap, colour_scale=colour_scale, shared_stft=shared_stft, renderer=renderer, tensor_input=tensor_input, stream=stream, normalise=normalise, precision=precision)
+        key = result_cache.result_key(cache, wav_file, params)
+        block = result_cache.get_result(cache, wav_file, params, key=key)
+        if block is not None: return block
+
+    if isinstance(model, (str, os.PathLike)): model = get_model(model) # Model path: use the model loaded in this worker process
+
+    layout = model_input_layout(model) if tensor_input else None
+    render = partial(iter_recording_images, wav_file, output_size=output_size, overlap=overlap, colour_scale=colour_scale, cancel_event=cancel_event, shared_stft=shared_stft, renderer=renderer, layout=layout, stream=stream, normalise=normalise)
+    if image_cache is not None:
+        image_params = render_parameters(output_size=output_size, overlap=overlap, colour_scale=colour_scale, shared_stft=shared_stft, renderer=renderer, layout=layout, stream=stream, normalise=normalise)
+        images = result_cache.cached_images(image_cache, wav_file, image_params, render, cancel_event=cancel_event)
+    else:
+        images = render()
+
+    # Predict and return the result
+    blocks = []
+    while images is not None and (batch := list(islice(images, batch_size))):
+        list_img_array, filename_list, offsets = zip(*batch)
+        results = predict_images(model=model, img_array=list(list_img_array), tensor_input=tensor_input, precision=precision)
+        blocks.append(results_to_block(results=results, filenames=filename_list, wav_path=wav_file, offsets=offsets))
+
+    cancelled = cancel_event is not None and cancel_event.is_set()
+    if cancelled or not blocks: # Unreadable, empty or cancelled
+        blocks = [empty_block(wav_file, status="corrupt" if images is None else None)]
+
+    header, detections = concat_blocks(blocks)
+    header["duration"] = time.perf_counter() - start
+
+    if cache is not None and not cancelled: result_cache.put_result(cache, wav_file, params, (header, detections), key=key)
+
+    return header, detections
+
+""" Parameters of the analysis that change the detections of a recording (to recognise cached detections, see cache.result_key) """
+def result_parameters(output_size=1, overlap=0, colour_scale="jet", shared_stft=False, renderer="lut", tensor_input=False, stream=False, normalise="two_pass", precision="fp32"):
+    params = {"output_size": output_size, "overlap": overlap, "colour_scale": colour_scale, "shared_stft": shared_stft, "renderer": renderer,
+              "tensor_input": tensor_input, "stream": stream, "normalise": normalise if stream else None, "conf": CONF, "iou": IOU}
+    if precision != "fp32": params["precision"] = precision # Keeps the keys of detections cached before there was a precision
+    if shared_stft: params["segment_starts"] = "rounded" # Every start is rounded on its own (see iter_recording_images), detections cached before that don't match
+
+    return params
+
+""" Parameters that change the spectrogram images of a recording (to recognise cached images, see cache.cached_images) """
+def render_parameters(output_size=1, overlap=0, colour_scale="jet", shared_stft=False, renderer="lut", layout=None, stream=False, normalise="two_pass"):
+    params = {"output_size": output_size, "overlap": overlap, "colour_scale": colour_scale, "shared_stft": shared_stft and not stream, "renderer": renderer,
+              "layout": layout, "stream": stream, "normalise": normalise if stream else None}
+    if params["shared_stft"]: params["segment_starts"] = "rounded" # Images cached before every start was rounded on its own don't match
+
+    return params
+
+""" Converts a single wav file to spectrogram images of overlapping segments. Returns the images, their filenames and their start times (ms), or None when the file can't be read or analysis is cancelled (see iter_recording_images) """
+def recording_to_images(wav_file, output_size=1, overlap=0, colour_scale="jet", cancel_event=None, shared_stft=False, renderer="lut", layout=None, stream=False, normalise="two_pass", buffers=None):
+    images = iter_recording_images(wav_file, output_size=output_size, overlap=overlap, colour_scale=colour_scale, cancel_event=cancel_event, shared_stft=shared_stft, renderer=renderer, layout=layout, stream=stream, normalise=normalise, buffers=buffers)
+
+    if images is None:
+        return None
+
+    list_img_array = []
+    filename_list = []
+    offsets = []
+    for img_array, filename, start_time in images:
+        list_img_array.append(img_array)
+        filename_list.append(filename)
+        offsets.append(start_time)
+
+    if cancel_event and cancel_event.is_set():  # Check for cancellation
+        return None
+
+    if not list_img_array:
+        print(Path(ntpath.basename(wav_file)).stem)
+
+    return list_img_array, filename_list, offsets
+
+""" Yields the spectrogram images (with their filenames and start times in ms) of the overlapping segments of a single wav file, one segment at a time. Returns None when the file can't be read, and stops when analysis is cancelled.
+    With stream the recording is read in chunks from a memory map and only the samples of the current segments are kept in memory. normalise is passed to stream_clean_wav.
+    With shared_stft the spectrogram of the whole recording is computed once and every segment is cut from it, instead of computing the overlapping parts again per segment (not when streaming).
+    Every segment start is then rounded on its own to the nearest frame of the whole recording, so it is at most half a frame hop (vis.FRAME_HOP / 2 samples, 0.5 ms at 250 kHz) from the exact overlap, however long the recording is.
+    With a layout (see model_input_layout) the images are rendered as model input instead.
+    buffers is an optional function that gets the number of segments and returns the arrays (or None) to render the images in (see vis.image_shape) """
+def iter_recording_images(wav_file, output_size=1, overlap=0, colour_scale="jet", cancel_event=None, shared_stft=False, renderer="lut", layout=None, stream=False, normalise="two_pass", buffers=None):
+    if stream:
+        fs, total_samples, chunks = stream_clean_wav(wav_file, normalise=normalise)
+        shared_stft = False # Needs the whole recording
+    else:
+        fs, Audiodata = read_clean_wav(wav_file)
+        if Audiodata is not None: total_samples, chunks = len(Audiodata), iter([Audiodata])
+
+    if fs is None:
+        return None
 
     filename_original = Path(ntpath.basename(wav_file)).stem
     folder_struc = ntpath.dirname(wav_file)
     segment_samples = int(round((output_size) * fs, 0)) # Calculate samples with frames per second * output in seconds
     overlap_samples = int(round(overlap * fs, 0))  
 
-    list_img_array = []
-    filename_list = []
-    segment_number = 1
-    total_samples = len(Audiodata)
-    total_length = int((len(Audiodata) / fs) * 1000) # file length in ms
+    total_length = int((total_samples / fs) * 1000) # file length in ms
 
-    start = 0
-    end = 0
+    advance_samples = segment_samples - overlap_samples
+    step = 1 # Segment starts are rounded to a multiple of step samples
+    recording_spectrogram = None
+    if shared_stft and renderer != "direct" and total_samples >= vis.NPERSEG: # The direct renderer uses its own frames
+        recording_spectrogram = vis.recording_spectrogram_data(Audiodata, fs)
+        advance_samples = max(advance_samples, vis.FRAME_HOP)
+        step = vis.FRAME_HOP # Segments start at a frame of the whole recording
 
-    # Process each overlapping segment of the audio file
-    while end < total_samples:
+    def images():
+        segment_number = 1
+        out = buffers(segment_count(total_samples, segment_samples, advance_samples, step)) if buffers is not None else None
 
-        if cancel_event and cancel_event.is_set():  # Check for cancellation
-            return []
+        # Process each overlapping segment of the audio file
+        for start, end, segment_data in iter_segments(chunks, total_samples, segment_samples, advance_samples, step):
 
-        end = min(start + segment_samples, total_samples)
-        segment_data = Audiodata[start:end]
-        segment_start_time = start / fs
-        start_time_file = int(segment_start_time * 1000)
-        end_time_file = min(int((segment_start_time + output_size) * 1000), total_length) # calc end time without overshooting max file length
-        time_img_list = [start_time_file, end_time_file] # Start and end time of segment in miliseconds
-
-        img_array, filename = vis.viz_audio_segment(segment_data=segment_data, 
-                                            fs=fs, 
-                                            folder_struc=folder_struc, 
-                                            filename_original=filename_original, 
-                                            segment_duration=output_size,
-                                            segment_number=segment_number, 
-                                            time_img=time_img_list,
-                                            colour_scale=colour_scale,
-                                            write_plot=False,
-                                            magn_weight=0,
-                                            draw_freq_lines=True)
+            if cancel_event and cancel_event.is_set():  # Check for cancellation
+                return
 
-        list_img_array.append(img_array)
-        filename_list.append(filename)
-        segment_number += 1
+            segment_start_time = start / fs
+            start_time_file = int(segment_start_time * 1000)
+            end_time_file = min(int((segment_start_time + output_size) * 1000), total_length) # calc end time without overshooting max file length
+            time_img_list = [start_time_file, end_time_file] # Start and end time of segment in miliseconds
 
-        start += segment_samples - overlap_samples # advancing start position
-    
-    if not list_img_array:
-        print(filename_original)
-        
-    # Predict and return the result
-    csv_data = predict_sono(model=model,
-                            img_array=list_img_array,
-                            filenames=filename_list,
-                            wav_path=wav_file,
-                            save=False)
+            spectrogram_data = None
+            if recording_spectrogram is not None: # Falls back to computing the segment on its own when it can't be cut from the recording
+                spectrogram_data = vis.segment_spectrogram_data(recording_spectrogram, fs=fs, start=start, end=end, segment_duration=output_size)
+
+            img_array, filename = vis.viz_audio_segment(segment_data=segment_data, 
+                                                        fs=fs, 
+                                                        folder_struc=folder_struc, 
+                                                        filename_original=filename_original, 
+                                                        segment_duration=output_size,
+                                                        segment_number=segment_number, 
+                                                        time_img=time_img_list,
+                                                        colour_scale=colour_scale,
+                                                        write_plot=False,
+                                                        magn_weight=0,
+                                                        draw_freq_lines=True,
+                                                        spectrogram_data=spectrogram_data,
+                                                        renderer=renderer,
+                                                        layout=layout,
+                                                        out=out[segment_number - 1] if out is not None else None)
+
+            yield img_array, filename, start_time_file
+
+            segment_number += 1
+
+    return images()
+
+""" Start (sample) of segment k: k * advance_samples rounded to the nearest multiple of step """
+def segment_start(k, advance_samples, step=1):
+    return int(round(k * advance_samples / step)) * step
+
+""" Number of segments iter_segments yields """
+def segment_count(total_samples, segment_samples, advance_samples, step=1):
+    last = max(int(np.ceil((total_samples - segment_samples) / advance_samples)), 0) # Last segment with exact starts, rounding moves it by at most one
+    while last > 0 and segment_start(last - 1, advance_samples, step) + segment_samples >= total_samples: last -= 1
+    while segment_start(last, advance_samples, step) + segment_samples < total_samples: last += 1
+
+    return last + 1
+
+""" Yields (start, end, samples) of the overlapping segments of a recording that arrives in chunks. Only keeps the samples from the start of the current segment in memory.
+    Segment k starts at k * advance_samples rounded to a multiple of step (see segment_start) """
+def iter_segments(chunks, total_samples, segment_samples, advance_samples, step=1):
+    buffer = np.empty(0, dtype=np.float32)
+    offset = 0 # Sample of the recording at the start of the buffer
+    k = 0
+    start = 0
+    end = 0
+
+    while end < total_samples:
+        end = min(start + segment_samples, total_samples)
 
-    return csv_data
+        while offset + len(buffer) < end:
+            rest = buffer[start - offset:] # Drop the samples before the current segment
+            chunk = next(chunks)
+            offset += len(buffer) - len(rest)
+            buffer = np.concatenate((rest, chunk)) if len(rest) else chunk
 
+        yield start, end, buffer[start - offset:end - offset]
 
+        k += 1
+        start = segment_start(k, advance_samples, step) # advancing start position
@@ -0,0 +1,92 @@
+import os
+import queue
+import time
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+import psutil
+import torch
+import cv2
+
+THREAD_VARIABLES = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS", "VECLIB_MAXIMUM_THREADS") # Thread counts of OpenMP and BLAS libraries that are read when they are loaded
+AUTOTUNE_FILES = 2 # Recordings per process that every combination of autotune analyses
+
+""" CPUs this process may run on """
+def available_cpus():
+    try:
+        return sorted(psutil.Process().cpu_affinity())
+    except (AttributeError, psutil.Error): # cpu_affinity isn't available on macOS
+        return list(range(os.cpu_count() or 1))
+
+""" Threads per process when processes share the CPUs, so the processes don't run more threads than there are CPUs (at least 1) """
+def thread_budget(processes, cpus=None):
+    return max(len(cpus or available_cpus()) // max(processes, 1), 1)
+
+""" CPUs to pin processes to: a list of threads CPUs per process, consecutive CPUs for every process (starting again at the first CPU when there are more threads than CPUs).
+    Returns a queue the processes take their CPUs from (see setup_worker) """
+def core_sets(processes, threads, cpus=None):
+    cpus = cpus or available_cpus()
+    sets = mp.Queue()
+    for i in range(processes):
+        sets.put([cpus[(i * threads + j) % len(cpus)] for j in range(min(threads, len(cpus)))])
+
+    return sets
+
+""" Limits the threads of torch, OpenMP, BLAS and OpenCV in this process to threads. Libraries that are loaded later and child processes read the limit from THREAD_VARIABLES,
+    BLAS and OpenMP libraries that are loaded already are limited with threadpoolctl or mkl-service when installed """
+def limit_threads(threads):
+    for variable in THREAD_VARIABLES:
+        os.environ[variable] = str(threads)
+
+    torch.set_num_threads(threads)
+    cv2.setNumThreads(threads)
+
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(threads)
+    except ImportError:
+        try:
+            import mkl
+            mkl.set_num_threads(threads)
+        except ImportError:
+            pass
+
+""" Sets up the threads of a worker process: limits its threads (see limit_threads) and pins it to the CPUs it takes from cores (see core_sets) """
+def setup_worker(threads=None, cores=None):
+    if cores is not None:
+        try:
+            cpus = cores.get_nowait()
+            psutil.Process().cpu_affinity(cpus)
+        except (queue.Empty, AttributeError, psutil.Error): # No CPUs left (restarted worker), or pinning isn't supported
+            pass
+
+    if threads: limit_threads(threads)
+
+""" Combinations of processes and threads per process that autotune tries: 1, 2, 4, ... processes (and one per CPU) with the CPUs divided over them, at most max_proc processes """
+def autotune_candidates(cpus=None, max_proc=None):
+    n_cpus = len(cpus or available_cpus())
+    max_proc = min(max_proc or n_cpus, n_cpus)
+    processes = sorted({2**i for i in range(max_proc.bit_length()) if 2**i <= max_proc} | {max_proc})
+
+    return [(proc, thread_budget(proc, cpus)) for proc in processes]
+
+""" Analyses sample recordings with every combination of processes and threads per process (see autotune_candidates) and returns the fastest combination as (proc, threads) and the recordings per second of every combination.
+    Every combination analyses AUTOTUNE_FILES recordings per process, after loading the model in every process. analyse is the function that analyses a recording, init_worker(threads) sets up a worker """
+def autotune(sample_files, analyse, init_worker, candidates=None, pin_workers=False):
+    candidates = candidates or autotune_candidates()
+    throughput = {}
+    for proc, threads in candidates:
+        files = [sample_files[i % len(sample_files)] for i in range(AUTOTUNE_FILES * proc)]
+        cores = core_sets(proc, threads) if pin_workers else None
+
+        with ProcessPoolExecutor(max_workers=proc, initializer=init_worker, initargs=(threads, cores)) as executor:
+            list(executor.map(_ready, range(proc))) # Starts all processes and loads the model
+
+            start = time.perf_counter()
+            list(executor.map(analyse, files))
+            throughput[(proc, threads)] = len(files) / (time.perf_counter() - start)
+
+    return max(throughput, key=throughput.get), throughput
+
+""" Task that returns once the worker process is started """
+def _ready(_):
+    time.sleep(0.1) # Keeps this worker busy, so the other tasks start the other workers
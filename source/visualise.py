@@ -4,10 +4,20 @@ import ntpath
 import numpy as np
 from PIL import Image
 import os
+from functools import lru_cache
 from pathlib import Path
-from scipy.signal import istft, spectrogram, stft
+from scipy.fft import next_fast_len, rfft
+from scipy.signal import get_window, istft, spectrogram, stft
+from scipy.sparse import csr_matrix
 from source.misc import read_clean_wav
 
+NPERSEG = 512 # FFT size and samples per frame of the spectrograms
+NOVERLAP = NPERSEG // 2 # Overlap between frames (0.5)
+FRAME_HOP = NPERSEG - NOVERLAP # Samples between the starts of subsequent frames
+IMG_SIZE = (1280, 400) # Width and height of the spectrogram images
+PRECISION_BITS = 22 # Fixed point precision of the resampling weights (same as PIL for 8-bit images)
+PAD_VALUE = 114 # Colour of the padding around the images in the model input (same as ultralytics)
+
 
 """ Removes background noise form spectogram data (is not used in the call prediction but can be used for visualisation purposes) """
 def spectral_subtraction(signal,    
@@ -44,10 +54,8 @@ def create_spectrogram_data(segment_data,
                        magn_weight,
                        segment_duration):
         # Spectrogram configuration
-    N = 512  # FFT size
-    nperseg = N  # Number of samples per segment
-    overlap = 0.5  # Overlap ratio (0.0 to 1.0)
-    noverlap = int(nperseg * overlap)
+    nperseg = NPERSEG  # Number of samples per segment
+    noverlap = NOVERLAP
 
     if magn_weight > 0:
         # Estimate noise from the first 0.5 seconds (or adjust as needed)
@@ -65,7 +73,10 @@ def create_spectrogram_data(segment_data,
         frequencies, times, Sxx = spectrogram(segment_data, fs=fs, window='hann',
                                     nperseg=nperseg, noverlap=noverlap)
 
+    return fit_spectrogram_range(frequencies, times, Sxx, fs, segment_duration)
 
+""" Pads or crops spectrogram data to 0-120 kHz and pads it to the duration of a segment """
+def fit_spectrogram_range(frequencies, times, Sxx, fs, segment_duration):
     # Filter frequencies up to the desired limit
     max_freq = 120000  # Maximum frequency to display (120 kHz)
     nyquist_freq = fs / 2
@@ -100,6 +111,198 @@ def create_spectrogram_data(segment_data,
 
     return frequencies, times, Sxx
 
+""" Computes the spectrogram data of a whole recording once, so overlapping segments can share its frames """
+def recording_spectrogram_data(audio_data, fs):
+    frequencies, _, Sxx = spectrogram(audio_data, fs=fs, window='hann', nperseg=NPERSEG, noverlap=NOVERLAP)
+
+    return frequencies, Sxx
+
+""" Cuts the spectrogram data of a single segment out of the spectrogram data of the whole recording. 
+    Returns None when the segment doesn't start at a frame of the recording or isn't fully covered by its frames (e.g. short last segment) """
+def segment_spectrogram_data(recording_spectrogram, fs, start, end, segment_duration):
+    frequencies, Sxx_recording = recording_spectrogram
+
+    if start % FRAME_HOP or end - start < NPERSEG: return None
+
+    first_frame = start // FRAME_HOP
+    n_frames = (end - start - NPERSEG) // FRAME_HOP + 1 # Same number of frames as a spectrogram of only the segment
+
+    if first_frame + n_frames > Sxx_recording.shape[1]: return None
+
+    Sxx = Sxx_recording[:, first_frame:first_frame + n_frames]
+    times = (NPERSEG / 2 + np.arange(n_frames) * FRAME_HOP) / fs # Times relative to the start of the segment
+
+    return fit_spectrogram_range(frequencies, times, Sxx, fs, segment_duration)
+
+""" FFT size and the FFT bin of every image row (0-120 kHz in 'height' rows), chosen so the bins fall on (or within half a bin of) the row frequencies. Rows above the Nyquist frequency get bin -1 """
+@lru_cache(maxsize=None)
+def image_frequency_bins(fs, height):
+    row_spacing = 120_000 / height # Hz
+    bins_per_row = int(np.ceil(NPERSEG / (fs / row_spacing))) # FFT needs at least NPERSEG points, so use multiple bins per row for low sample rates
+    nfft = next_fast_len(int(round(bins_per_row * fs / row_spacing)), real=True)
+
+    bins = np.round(np.arange(height) * row_spacing * nfft / fs).astype(np.intp)
+    bins[bins > nfft // 2] = -1
+
+    return nfft, bins
+
+""" Converts (segment) audio data to spectogram data that already has the resolution of the image (size is width, height), so it doesn't need to be resized.
+    Frames are spread evenly over the segment duration and only the FFT bins at the frequencies of the image rows are kept, which also pads (zeros above the Nyquist frequency) or crops to 120 kHz """
+def create_spectrogram_image_data(segment_data,
+                                  fs,
+                                  magn_weight,
+                                  segment_duration,
+                                  size=IMG_SIZE):
+    width, height = size
+
+    if magn_weight > 0:
+        noise_estimation = np.mean(np.abs(segment_data[:int(0.5 * fs)]))
+        noise_estimation_array = np.full((NPERSEG // 2 + 1,), noise_estimation)
+        segment_data = spectral_subtraction(segment_data, noise_estimation_array, fs, magn_weight, NPERSEG)
+
+    # Pad short segments with silence up to the segment duration
+    segment_samples = int(round(segment_duration * fs))
+    data = np.zeros(max(len(segment_data), segment_samples, NPERSEG), dtype=np.float32)
+    data[:len(segment_data)] = segment_data
+
+    # One frame per image column (frames as columns), centred on the column where possible
+    centers = (np.arange(width) + 0.5) * segment_samples / width
+    starts = np.clip(np.round(centers - NPERSEG / 2).astype(np.intp), 0, len(data) - NPERSEG)
+    frames = data[np.arange(NPERSEG)[:, np.newaxis] + starts]
+    frames -= frames.mean(axis=0) # Same detrending and window as spectrogram()
+    window = get_window("hann", NPERSEG).astype(np.float32)
+    frames *= window[:, np.newaxis]
+
+    nfft, bins = image_frequency_bins(fs, height)
+    valid = bins >= 0
+    spectrum = rfft(frames, n=nfft, axis=0)[bins[valid]]
+
+    # Power spectral density, scaled like spectrogram()
+    scale = np.where((bins[valid] == 0) | ((bins[valid] == nfft // 2) & (nfft % 2 == 0)), 1.0, 2.0) / (fs * (window.astype(np.float64) ** 2).sum())
+    Sxx = np.zeros((height, width), dtype=np.float32)
+    Sxx[valid] = spectrum.real ** 2 + spectrum.imag ** 2
+    Sxx[valid] *= scale[:, np.newaxis].astype(np.float32)
+
+    frequencies = np.where(valid, bins * fs / nfft, np.arange(height) * 120_000 / height)
+    times = centers / fs
+
+    return frequencies, times, Sxx
+
+""" Shape of the images viz_audio_segment returns (for a layout: the model input) """
+def image_shape(colour_scale="jet", layout=None):
+    if layout is not None: return layout["shape"] + (3,)
+    return IMG_SIZE[::-1] if colour_scale == "gray" else IMG_SIZE[::-1] + (3,)
+
+""" Layout of the model input for images of 'size' (width, height): the same letterbox as ultralytics applies when predicting (scaled to fit imgsz, padded to a multiple of stride).
+    Returns the input shape (height, width), the size (width, height) of the image within the input, its top and left offset and the scale """
+def letterbox_layout(imgsz, stride, size=IMG_SIZE):
+    width, height = size
+    if isinstance(imgsz, int): imgsz = (imgsz, imgsz)
+    input_height, input_width = (int(np.ceil(x / stride) * stride) for x in imgsz)
+
+    scale = min(input_height / height, input_width / width)
+    new_width, new_height = round(width * scale), round(height * scale)
+
+    # Minimal padding (to a multiple of stride), split over both sides
+    pad_width = ((input_width - new_width) % stride) / 2
+    pad_height = ((input_height - new_height) % stride) / 2
+    top, bottom = round(pad_height - 0.1), round(pad_height + 0.1)
+    left, right = round(pad_width - 0.1), round(pad_width + 0.1)
+
+    return {"shape": (new_height + top + bottom, new_width + left + right),
+            "size": (new_width, new_height),
+            "top": top,
+            "left": left,
+            "scale": scale}
+
+""" Colour lookup table of a colormap as uint8 (N x 3 for colours, N for gray). Equal to the colours of cmap(values) * 255 """
+@lru_cache(maxsize=None)
+def colour_lut(colour_scale):
+    cmap = matplotlib.colormaps.get_cmap(colour_scale)
+    lut = (cmap(np.arange(cmap.N)) * 255).astype(np.uint8)
+    bad = (np.array(cmap.get_bad()) * 255).astype(np.uint8) # Colour of NaN values (image without any contrast)
+
+    if colour_scale == "gray": return lut[:, 0], bad[0]
+    return lut[:, :3], bad[:3]
+
+""" Lanczos resampling weights from in_size to out_size pixels as fixed point sparse matrix (out_size x in_size), calculated the same way as PIL """
+@lru_cache(maxsize=None)
+def lanczos_weights(in_size, out_size):
+    scale = in_size / out_size
+    filterscale = max(scale, 1.0)
+    support = 3.0 * filterscale
+
+    rows, cols, weights = [], [], []
+    for xx in range(out_size):
+        center = (xx + 0.5) * scale
+        xmin = max(int(center - support + 0.5), 0)
+        xmax = min(int(center + support + 0.5), in_size)
+
+        x = (np.arange(xmin, xmax) - center + 0.5) / filterscale
+        w = np.where(np.abs(x) < 3.0, np.sinc(x) * np.sinc(x / 3), 0.0)
+        if w.sum() != 0.0: w = w / w.sum()
+
+        rows.extend([xx] * len(w))
+        cols.extend(range(xmin, xmax))
+        weights.extend(np.where(w < 0, -0.5 + w * (1 << PRECISION_BITS), 0.5 + w * (1 << PRECISION_BITS)).astype(np.int64))
+
+    weights = csr_matrix((np.array(weights, dtype=np.int64), (rows, cols)), shape=(out_size, in_size))
+
+    # int32 is much faster, and large enough as long as a weighted sum of 8-bit values can't overflow
+    if abs(weights).sum(axis=1).max() * 255 + (1 << PRECISION_BITS) < np.iinfo(np.int32).max: weights = weights.astype(np.int32)
+
+    return weights
+
+""" Rounds fixed point values back to 0-255 """
+def _clip8(values):
+    values += 1 << (PRECISION_BITS - 1)
+    values >>= PRECISION_BITS
+    return np.clip(values, 0, 255, out=values)
+
+""" Renders spectrogram data straight to an image of 'size' (width, height), using a colour lookup table and cached resampling weights.
+    Gives the same image as the colormap + PIL LANCZOS steps in viz_audio_segment, and skips resampling when Sxx already has the image resolution. Writes into 'out' (uint8, height x width (x 3)) when given """
+def render_spectrogram(Sxx, colour_scale="jet", draw_freq_lines=True, size=IMG_SIZE, out=None):
+    width, height = size
+    lut, bad = colour_lut(colour_scale)
+    channels = 1 if lut.ndim == 1 else 3
+
+    if out is None: out = np.empty((height, width) if channels == 1 else (height, width, 3), dtype=np.uint8)
+
+    # Logarithmic scale and normalisation to colour indices (same operations as viz_audio_segment and matplotlib)
+    Sxx_idx = Sxx + 1e-10
+    np.log10(Sxx_idx, out=Sxx_idx)
+    Sxx_idx *= 10
+    min_value, max_value = Sxx_idx.min(), Sxx_idx.max()
+
+    if not (np.isfinite(min_value) and np.isfinite(max_value)) or max_value == min_value: # No contrast or NaN cells (e.g. a silent recording normalised by 0, min and max are NaN when any cell is): every cell is NaN after normalising, which the colormap gives the colour of NaN
+        out[...] = bad
+    else:
+        Sxx_idx -= min_value
+        Sxx_idx /= max_value - min_value
+        Sxx_idx *= len(lut)
+        idx = np.minimum(Sxx_idx.astype(np.intp), len(lut) - 1)
+
+        if idx.shape == (height, width): # Spectrogram already has the resolution of the image, only colour it
+            np.take(lut, idx[::-1], axis=0, out=out)
+        else:
+            # Colours of the flipped image, with time as first axis for the horizontal pass
+            img = np.take(lut.astype(np.int32), idx[::-1].T, axis=0).reshape(idx.shape[1], -1)
+
+            # Horizontal and vertical pass of the resampling, rounding to 8-bit in between (like PIL)
+            img = _clip8(lanczos_weights(idx.shape[1], width) @ img)
+            img = np.ascontiguousarray(np.swapaxes(img.reshape(width, idx.shape[0], channels), 0, 1)).reshape(idx.shape[0], -1)
+            img = _clip8(lanczos_weights(idx.shape[0], height) @ img)
+
+            np.copyto(out, img.reshape(out.shape), casting="unsafe")
+
+    # Now draw the white lines for frequency intervals
+    if draw_freq_lines:
+        for freq in np.arange(0, 120_000, 20_000):
+            y_pos = min(max(int(freq / 120_000 * height), 0), height - 1)
+            out[y_pos] = 255
+
+    return out
+
 """ Converts spectogram data to spectrogram with the right resolution and axis """
 def viz_audio_segment(segment_data,
                         fs,
@@ -111,56 +314,97 @@ def viz_audio_segment(segment_data,
                         colour_scale,
                         write_plot,
                         magn_weight,
-                        draw_freq_lines):
-
-    # Generate the spectrogram data
-    frequencies, times, Sxx = create_spectrogram_data(segment_data=segment_data,
+                        draw_freq_lines,
+                        spectrogram_data=None,
+                        renderer="lut", # "lut" (render_spectrogram) or "pil" (matplotlib colormap and PIL resize), which give the same image. "direct" computes the spectrogram at the image resolution (no resizing), which gives different pixels (mean difference ~10/45/5 of 255 per B/G/R channel) and taller call bands at high sample rates
+                        layout=None, # Model input layout (letterbox_layout) to render the image in, returns the RGB model input instead of the BGR image (lut and direct renderers)
+                        out=None): # Array to render the (RGB) image or model input in, with the shape of image_shape()
+
+    if layout is not None and renderer == "pil":
+        raise ValueError("Rendering the model input needs the lut or direct renderer")
+    size = IMG_SIZE if layout is None else layout["size"]
+
+    # Generate the spectrogram data (unless it's already cut from the spectrogram of the whole recording)
+    if renderer == "direct":
+        spectrogram_data = create_spectrogram_image_data(segment_data=segment_data,
+                                                         fs=fs,
+                                                         magn_weight=magn_weight,
+                                                         segment_duration=segment_duration,
+                                                         size=size)
+    elif spectrogram_data is None:
+        spectrogram_data = create_spectrogram_data(segment_data=segment_data,
                                                  fs=fs,
                                                  magn_weight=magn_weight,
                                                  segment_duration=segment_duration)
+    frequencies, times, Sxx = spectrogram_data
 
-    # Apply a logarithmic scale to the spectrogram
-    Sxx_log = 10 * np.log10(Sxx + 1e-10)  # Avoid log of zero
+    new_filename = f"IMG_{filename_original}_{segment_number:05d}_{time_img[0]}_{time_img[1]}.png"
 
-    # Normalize to 0-1 for color mapping
-    Sxx_norm = (Sxx_log - np.min(Sxx_log)) / (np.max(Sxx_log) - np.min(Sxx_log))
+    if layout is not None:
+        # Render straight into the padded model input, so it doesn't have to be resized and padded again before predicting
+        input_image = np.empty(layout["shape"] + (3,), dtype=np.uint8) if out is None else out
+        input_image.fill(PAD_VALUE)
+        image_view = input_image[layout["top"]:layout["top"] + size[1], layout["left"]:layout["left"] + size[0]]
 
-    # Apply the colormap
-    cmap = matplotlib.colormaps.get_cmap(colour_scale)  # E.g., 'jet' or 'gray'
-    image_array_rgba = cmap(Sxx_norm)  # Map to RGBA (4 channels)
+        if colour_scale == "gray": # Model input has 3 channels, gray is repeated
+            render_spectrogram(Sxx, colour_scale=colour_scale, draw_freq_lines=draw_freq_lines, size=size, out=image_view[..., 0])
+            image_view[..., 1:] = image_view[..., :1]
+        else:
+            render_spectrogram(Sxx, colour_scale=colour_scale, draw_freq_lines=draw_freq_lines, size=size, out=image_view)
+
+        return input_image, new_filename
+
+    if renderer in ("lut", "direct"):
+        # Colour lookup table and cached resampling weights, gives the same image as below
+        image_array_resized = render_spectrogram(Sxx, colour_scale=colour_scale, draw_freq_lines=draw_freq_lines, out=out)
 
-    # Convert colormap to grayscale or RGB
-    if colour_scale == "gray":
-        image_array = (image_array_rgba[..., 0] * 255).astype(np.uint8)  # Grayscale (mode L)
     else:
-        image_array = (image_array_rgba[..., :3] * 255).astype(np.uint8)  # RGB (mode RGB)
+        # Apply a logarithmic scale to the spectrogram
+        Sxx_log = 10 * np.log10(Sxx + 1e-10)  # Avoid log of zero
 
-    # Correct orientation
-    image_array = np.flipud(image_array)  # Flip vertically if necessary
+        # Normalize to 0-1 for color mapping
+        Sxx_norm = (Sxx_log - np.min(Sxx_log)) / (np.max(Sxx_log) - np.min(Sxx_log))
 
-    # Resize to 1200x400 pixels first
-    image_pil = Image.fromarray(image_array)
-    image_resized = image_pil.resize((1280, 400), Image.Resampling.LANCZOS)
-    image_array_resized = np.array(image_resized)
+        # Apply the colormap
+        cmap = matplotlib.colormaps.get_cmap(colour_scale)  # E.g., 'jet' or 'gray'
+        image_array_rgba = cmap(Sxx_norm)  # Map to RGBA (4 channels)
 
-    # Now draw the white lines for frequency intervals
-    if draw_freq_lines:
-        frequency_intervals = np.arange(0, 120_000, 20_000) 
-        for idx in frequency_intervals:
-            # Convert the frequency index to pixel index (scaled to resized image height)
-            y_pos = int(idx / 120_000 * image_resized.height)
+        # Convert colormap to grayscale or RGB
+        if colour_scale == "gray":
+            image_array = (image_array_rgba[..., 0] * 255).astype(np.uint8)  # Grayscale (mode L)
+        else:
+            image_array = (image_array_rgba[..., :3] * 255).astype(np.uint8)  # RGB (mode RGB)
+
+        # Correct orientation
+        image_array = np.flipud(image_array)  # Flip vertically if necessary
+
+        # Resize to 1200x400 pixels first
+        image_pil = Image.fromarray(image_array)
+        image_resized = image_pil.resize((1280, 400), Image.Resampling.LANCZOS)
+        image_array_resized = np.array(image_resized)
+
+        # Now draw the white lines for frequency intervals
+        if draw_freq_lines:
+            frequency_intervals = np.arange(0, 120_000, 20_000) 
+            for idx in frequency_intervals:
+                # Convert the frequency index to pixel index (scaled to resized image height)
+                y_pos = int(idx / 120_000 * image_resized.height)
             
-            # Ensure that y_pos is within bounds (between 0 and image height)
-            y_pos = min(max(y_pos, 0), image_resized.height - 1)
+                # Ensure that y_pos is within bounds (between 0 and image height)
+                y_pos = min(max(y_pos, 0), image_resized.height - 1)
                 
-            if colour_scale == "gray":
-                # For grayscale, modify only the single channel
-                image_array_resized[y_pos, :] = 255  # Set the entire row to white
-            else:
-                # For RGB, modify all three channels
-                image_array_resized[y_pos, :, 0] = 255  # Set Red channel
-                image_array_resized[y_pos, :, 1] = 255  # Set Green channel
-                image_array_resized[y_pos, :, 2] = 255  # Set Blue channel
+                if colour_scale == "gray":
+                    # For grayscale, modify only the single channel
+                    image_array_resized[y_pos, :] = 255  # Set the entire row to white
+                else:
+                    # For RGB, modify all three channels
+                    image_array_resized[y_pos, :, 0] = 255  # Set Red channel
+                    image_array_resized[y_pos, :, 1] = 255  # Set Green channel
+                    image_array_resized[y_pos, :, 2] = 255  # Set Blue channel
+
+        if out is not None:
+            np.copyto(out, image_array_resized)
+            image_array_resized = out
 
 
     if write_plot:
@@ -176,8 +420,6 @@ def viz_audio_segment(segment_data,
             Image.fromarray(image_array_resized).save(new_filepath)
 
     # Return the image array and filename
-    new_filename = f"IMG_{filename_original}_{segment_number:05d}_{time_img[0]}_{time_img[1]}.png"
-
     image_array_resized_bgr = image_array_resized[..., ::-1]
 
     return image_array_resized_bgr, new_filename
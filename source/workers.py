@@ -0,0 +1,60 @@
+import psutil
+from concurrent.futures import wait, FIRST_COMPLETED
+from ultralytics import YOLO
+from source.onnx_backend import load_onnx
+from source.scheduler import setup_worker
+
+_models = {} # Models loaded in this process, by model path
+
+""" Returns the model stored at model_path. Loads it only the first time it is requested in this process. Exported ONNX models (.onnx) are loaded in ONNX Runtime (see onnx_backend.load_onnx) """
+def get_model(model_path):
+    key = str(model_path)
+
+    if key not in _models:
+        _models[key] = load_onnx(model_path) if key.endswith(".onnx") else YOLO(model_path)
+
+    return _models[key]
+
+""" Loads the model in the main process and moves its weights to shared memory, so all worker processes read the same copy """
+def load_shared_model(model_path):
+    model = get_model(model_path)
+
+    model.model.eval()
+    if hasattr(model.model, "fuse"): model.model.fuse() # ultralytics fuses layers before predicting, which would create a private copy of the weights in every worker
+    model.model.share_memory() # Weights are passed as handles to shared memory instead of copies when sent to a (spawned) process
+
+    return model
+
+""" Initialiser of the worker processes: loads the model once per worker, so it doesn't have to be sent with every task. Uses the model of the main process when it is given.
+    threads and cores limit the threads of the worker and pin it to CPUs (see scheduler.setup_worker) """
+def init_worker(model_path, model=None, threads=None, cores=None):
+    setup_worker(threads, cores)
+    if model is not None:
+        _models[str(model_path)] = model
+    else:
+        get_model(model_path)
+
+""" Unique memory (USS, memory that is freed when the process stops) in MB of every child process of the current process """
+def worker_memory():
+    memory = {}
+    for child in psutil.Process().children(recursive=True):
+        try:
+            memory[child.pid] = child.memory_full_info().uss / 1024**2
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            continue
+
+    return memory
+
+""" Runs func on every item on the executor and yields (item, result) as soon as it's done, so a slow item doesn't hold up the others. Only max_pending items are submitted at once, items are taken from the iterable as the workers need them """
+def submit_as_completed(executor, func, items, max_pending):
+    items = iter(items)
+    pending = {} # Submitted items by their future
+    while True:
+        while len(pending) < max_pending and (item := next(items, None)) is not None:
+            pending[executor.submit(func, item)] = item
+
+        if not pending: return
+
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in sorted(done, key=list(pending).index): # In the order they were submitted when several are done
+            yield pending.pop(future), future.result()
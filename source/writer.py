@@ -0,0 +1,136 @@
+import os
+import queue
+import threading
+from contextlib import contextmanager
+import pandas as pd
+import source.log as log
+from source.predict import COLUMNS, blocks_to_frame
+from source.postprocess import overlap_tidy
+
+""" Starts a thread that writes the blocks of detections (see predict.results_to_block) of finished recordings to the output file at path while the analysis continues.
+    Blocks are put on writer["queue"]. Every write_every recordings their detections are tidied (see overlap_tidy) and appended to path + ".part" at once, which stop_writer moves to path.
+    Only the detections of the recordings that are not written yet are kept in memory. output_format is "csv", "parquet" or "arrow" (see resolve_output_format).
+    With a log_path the written recordings are logged after every chunk (see log.log_files), so they are skipped when the analysis is continued after a crash.
+    write_every None writes every recording on its own when logging (a crash only loses the recordings that aren't done), and chunks of 100 recordings otherwise """
+def start_writer(path, write_every=None, threshold=5, output_format="csv", log_path=False):
+    if write_every is None: write_every = 1 if log_path is not False else 100
+    writer = {"path": path, "part_path": path + ".part", "queue": queue.Queue(), "error": None, "log_path": log_path}
+    writer["thread"] = threading.Thread(target=writer_loop, args=(writer, write_every, threshold, output_format), daemon=True)
+    writer["thread"].start()
+
+    return writer
+
+""" Writes the blocks on the queue of the writer until None arrives. Errors are kept in writer["error"] and raised by stop_writer """
+def writer_loop(writer, write_every=100, threshold=5, output_format="csv"):
+    connection = None
+    try:
+        if writer["log_path"] is not False:
+            connection = log.open_log(writer["log_path"])
+            log.start_output(connection, writer["path"], writer["part_path"], output_format)
+
+        with open_output(writer["part_path"], output_format) as write:
+            blocks = []
+            headers = [] # Recordings in the chunk as (header, number of detections before tidying)
+            while (block := writer["queue"].get()) is not None:
+                headers.append((block[0], len(block[1])))
+                if len(block[1]): blocks.append(block)
+
+                if len(headers) == write_every:
+                    write_chunk(write, blocks, headers, threshold, writer["path"], connection)
+                    blocks, headers = [], []
+
+            if headers: write_chunk(write, blocks, headers, threshold, writer["path"], connection)
+
+    except Exception as e:
+        writer["error"] = e
+
+    finally:
+        if connection is not None: connection.close()
+
+""" Writes the tidied detections of a chunk of recordings and logs the recordings afterwards (when logging) """
+def write_chunk(write, blocks, headers, threshold, path, connection=None):
+    committed_size = write(tidy_blocks(blocks, threshold)) if blocks else None
+    if connection is not None: log.log_files(connection, headers, path, committed_size)
+
+""" Table of the tidied detections of whole recordings. Detections of different recordings are never merged by overlap_tidy, so tidying them per chunk is the same as tidying them per recording """
+def tidy_blocks(blocks, threshold=5):
+    return overlap_tidy(blocks_to_frame(blocks), threshold=threshold)
+
+""" Format that is written for output_format: parquet needs pyarrow, and becomes "arrow" (Arrow IPC stream) when pyarrow is installed without parquet support """
+def resolve_output_format(output_format="csv"):
+    if output_format not in ("csv", "parquet", "arrow"):
+        raise ValueError(f"Unknown output format: {output_format}")
+
+    if output_format != "csv":
+        try:
+            import pyarrow
+        except ImportError as e:
+            raise ImportError(f"Writing {output_format} files needs pyarrow (pip install pyarrow)") from e
+
+    if output_format == "parquet":
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            print("pyarrow is installed without parquet support, output is written as Arrow IPC (.arrow) files instead")
+            return "arrow"
+
+    return output_format
+
+""" Opens the output file at path and yields the function that appends a table of detections to it and returns the size of the file after writing it (None for parquet). The header/schema is always written, also without detections.
+    csv chunks are appended in a single write and synced to disk. parquet files get a row group per chunk and arrow files (Arrow IPC stream, read with pyarrow.ipc.open_stream) a record batch, with filename, filepath and category dictionary encoded """
+@contextmanager
+def open_output(path, output_format="csv"):
+    if output_format == "csv":
+        with open(path, mode="w", newline="", encoding="utf-8") as file:
+            file.write(pd.DataFrame(columns=list(COLUMNS)).to_csv(index=False)) # Header
+
+            def write(df):
+                file.write(df.to_csv(index=False, header=False))
+                file.flush()
+                os.fsync(file.fileno()) # The chunk is on disk before the next one is written (and logged)
+                return file.tell()
+
+            yield write
+        return
+
+    import pyarrow as pa
+
+    strings = pa.dictionary(pa.int32(), pa.string())
+    schema = pa.schema([("filename", strings), ("filepath", strings), ("category", strings), ("confidence", pa.float32()),
+                        ("start_time_ms", pa.int32()), ("end_time_ms", pa.int32()), ("freq_min", pa.int16()), ("freq_max", pa.int16())])
+
+    sink = None
+    if output_format == "parquet":
+        import pyarrow.parquet as pq
+        table_writer = pq.ParquetWriter(path, schema, compression="zstd")
+    else:
+        sink = pa.OSFile(path, "wb")
+        table_writer = pa.ipc.new_stream(sink, schema) # The file format can't change the dictionaries between record batches
+
+    def write(df):
+        table_writer.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False))
+        if sink is None: return None
+
+        sink.flush()
+        return sink.tell()
+
+    try:
+        yield write
+    finally:
+        table_writer.close()
+        if sink is not None: sink.close()
+
+""" Writes the remaining detections and waits until the writer is done. With commit the output is moved to its path, otherwise (when cancelled) it is removed """
+def stop_writer(writer, commit=True):
+    writer["queue"].put(None)
+    writer["thread"].join()
+
+    if writer["error"] is not None:
+        raise writer["error"]
+
+    if commit:
+        os.replace(writer["part_path"], writer["path"])
+    else:
+        os.remove(writer["part_path"])
+
+    if writer["log_path"] is not False: log.finish_output(writer["log_path"], writer["path"], keep=commit)
@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import source.accuracy as accuracy
+from source.predict import DETECTION_DTYPE
+
+""" Helper: table of detections of a recording """
+def frame(rows, filepath="/data/rec.wav"):
+    df = pd.DataFrame(rows, columns=["category", "confidence", "start_time_ms", "end_time_ms", "freq_min", "freq_max"])
+    df.insert(0, "filepath", filepath)
+    return df
+
+""" Detections match the reference detection of the same category they overlap most, every reference detection only once """
+def test_match_detections():
+    reference = frame([("Feeding buzz", 0.9, 0, 100, 20, 60), ("Feeding buzz", 0.8, 500, 600, 20, 60), ("Social call", 0.7, 0, 100, 20, 60)])
+    detections = frame([("Feeding buzz", 0.5, 5, 100, 20, 60), # overlap the first, which is taken by a detection with higher confidence...
+                        ("Feeding buzz", 0.4, 0, 100, 20, 60),
+                        ("Feeding buzz", 0.95, 0, 95, 20, 60), # ...this one
+                        ("Social call", 0.6, 0, 40, 20, 60), # overlaps too little
+                        ("Feeding buzz", 0.9, 500, 600, 20, 60)])
+    detections.loc[4, "filepath"] = "/data/other.wav" # other recording
+
+    matched_reference, matched = accuracy.match_detections(reference, detections)
+
+    assert matched_reference.tolist() == [True, False, False]
+    assert matched.tolist() == [False, False, True, False, False]
+
+""" Recall and precision per category, against the full precision detections or annotations """
+def test_compare_precisions(monkeypatch):
+    full = frame([("Feeding buzz", 0.9, 0, 100, 20, 60), ("Feeding buzz", 0.8, 500, 600, 20, 60), ("Social call", 0.7, 1000, 1100, 20, 60)])
+    reduced = frame([("Feeding buzz", 0.85, 0, 100, 20, 60), ("Social call", 0.7, 1000, 1100, 20, 60), ("Social call", 0.3, 2000, 2100, 20, 60)])
+    monkeypatch.setattr(accuracy, "analyse_precisions", lambda wav_files, model_path, precisions, **kwargs: ({"fp32": full, "int8": reduced}, {"fp32": 2.0, "int8": 1.0}))
+
+    report = accuracy.compare_precisions(["/data/rec.wav"], "model.pt", precisions=("int8",)).set_index("category")
+    assert report.loc["Feeding buzz", ["recall", "precision"]].tolist() == [0.5, 1.0]
+    assert report.loc["Social call", ["recall", "precision"]].tolist() == [1.0, 0.5]
+    assert report.loc["Feeding buzz", "recall_diff"] == -0.5 and (report["speedup"] == 2).all()
+    assert (report["precision_mode"] == "int8").all()
+
+    truth = frame([("Feeding buzz", 1, 0, 100, 20, 60), ("Social call", 1, 2000, 2100, 20, 60)])
+    report = accuracy.compare_precisions(["/data/rec.wav"], "model.pt", precisions=("int8",), truth=truth).set_index(["precision_mode", "category"])
+    assert report.loc[("fp32", "Social call"), ["recall", "precision"]].tolist() == [0.0, 0.0]
+    assert report.loc[("int8", "Social call"), ["recall", "precision", "recall_diff", "precision_diff"]].tolist() == [1.0, 0.5, 1.0, 0.5]
+    assert report.loc[("int8", "Feeding buzz"), "precision_diff"] == 0.5
+
+""" Every precision analyses the recordings with its own model, and the detections are tidied """
+def test_analyse_precisions(monkeypatch):
+    models = []
+    monkeypatch.setattr(accuracy, "model_for_precision", lambda model_path, backend, precision, calibration_files: f"{model_path}.{backend}.{precision}")
+    monkeypatch.setattr(accuracy, "get_model", lambda path: models.append(path) or path)
+
+    def predict(wav_file, model, precision, **kwargs):
+        detections = np.zeros(2, dtype=DETECTION_DTYPE)
+        detections["start_time_ms"], detections["end_time_ms"], detections["confidence"] = [0, 2], [100, 100], [0.5, 0.6] # Ends at the same time, merged by overlap_tidy
+        return {"filename": "rec.wav", "filepath": wav_file, "names": ("buzz",)}, detections
+
+    monkeypatch.setattr(accuracy, "recording_to_predict", predict)
+    detections, seconds = accuracy.analyse_precisions(["/data/rec.wav"], "model.pt", precisions=("bf16", "int8"))
+
+    assert models == ["model.pt.torch.fp32", "model.pt.torch.bf16", "model.pt.onnx.int8"]
+    assert list(detections) == list(seconds) == ["fp32", "bf16", "int8"]
+    assert len(detections["int8"]) == 1 and detections["int8"]["confidence"].iloc[0] == np.float32(0.6)
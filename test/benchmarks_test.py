@@ -0,0 +1,74 @@
+import time
+import numpy as np
+import pandas as pd
+from scipy.io import wavfile
+from scipy.signal import spectrogram
+from benchmarks.synthetic import synthetic_audio, write_synthetic_wav, synthetic_detections
+import benchmarks.micro as micro
+import benchmarks.throughput as throughput
+from source.predict import COLUMNS, iter_recording_images
+from source.postprocess import overlap_tidy
+
+""" Synthetic recordings are the same for the same seed, with the requested channels, and have their energy in the ultrasonic calls """
+def test_synthetic_audio(tmp_path):
+    for fs in micro.SAMPLE_RATES:
+        audio = synthetic_audio(fs=fs, duration=0.5, channels=2, seed=1)
+        assert audio.shape == (fs // 2, 2) and audio.dtype == np.int16
+        assert np.array_equal(audio, synthetic_audio(fs=fs, duration=0.5, channels=2, seed=1))
+        assert not np.array_equal(audio, synthetic_audio(fs=fs, duration=0.5, channels=2, seed=2))
+
+    audio = synthetic_audio(fs=250_000, duration=1, seed=3)
+    frequencies, _, Sxx = spectrogram(audio.astype(float), fs=250_000)
+    power = Sxx.sum(axis=1)
+    assert power[(frequencies >= 25_000) & (frequencies <= 85_000)].sum() > 0.5 * power.sum()
+
+    path = write_synthetic_wav(str(tmp_path / "rec.wav"), fs=384_000, duration=0.25, seed=3)
+    fs, data = wavfile.read(path)
+    assert fs == 384_000 and np.array_equal(data, synthetic_audio(fs=384_000, duration=0.25, seed=3))
+
+""" Synthetic detection tables have the output columns and calls that overlap_tidy merges """
+def test_synthetic_detections():
+    df = synthetic_detections(5000, seed=4)
+    assert list(df.columns) == list(COLUMNS) and len(df) == 5000
+    pd.testing.assert_frame_equal(df, synthetic_detections(5000, seed=4))
+    assert len(overlap_tidy(df)) < len(df[df["category"] != "Other"])
+
+""" Benchmarks are selected by name and timed per call, and compared by the fastest time """
+def test_run_and_compare():
+    results = micro.run(select=["overlap_tidy[rows=1000]"], quick=True, repeat=1, verbose=False)
+    assert list(results["results"]) == ["overlap_tidy[rows=1000]"]
+    assert results["results"]["overlap_tidy[rows=1000]"]["min"] > 0 and "numpy" in results["environment"]
+
+    baseline = {"results": {"a": {"min": 1.0}, "b": {"min": 1.0}, "c": {"min": 1.0}}}
+    current = {"results": {"a": {"min": 1.05}, "b": {"min": 1.5}, "c": {"min": 0.5}, "d": {"min": 1.0}}}
+    assert [(row["name"], row["flag"]) for row in micro.compare(baseline, current)] == [("a", ""), ("b", "slower"), ("c", "faster")]
+
+""" The memory monitor finds the memory of this process, segments are counted like iter_recording_images makes them, and compare flags slower configurations and more memory """
+def test_throughput_helpers(tmp_path):
+    monitor = throughput.start_memory_monitor(interval=0.01)
+    time.sleep(0.05)
+    assert throughput.stop_memory_monitor(monitor) > 10
+
+    path = write_synthetic_wav(str(tmp_path / "rec.wav"), fs=250_000, duration=2.5)
+    for overlap in (0, 0.3):
+        assert throughput.count_segments([path], overlap) == len(list(iter_recording_images(path, overlap=overlap)))
+
+    result = lambda files_per_s, peak_rss_mb: {"files_per_s": files_per_s, "peak_rss_mb": peak_rss_mb}
+    baseline = {"results": {"a": result(10, 100), "b": result(10, 100), "c": result(10, 100)}}
+    current = {"results": {"a": result(9, 110), "b": result(5, 150), "c": result(20, 100), "d": result(1, 1)}}
+    assert [(row["name"], row["flag"]) for row in throughput.compare(baseline, current)] == [("a", ""), ("b", "slower more memory"), ("c", "faster")]
+
+    baseline = {"environment": {"cpus": 8}, "corpus": throughput.CORPUS, "model": "stub"}
+    assert throughput.not_comparable(baseline, {**baseline, "environment": {"cpus": 8}}) is None
+    assert "1 CPUs" in throughput.not_comparable({**baseline, "environment": {"cpus": 1}}, baseline) # baselines of other computers aren't compared
+    assert "corpus" in throughput.not_comparable(baseline, {**baseline, "corpus": {}})
+
+""" The throughput benchmark runs main.main on a synthetic corpus for every configuration in the grid and removes the output between runs """
+def test_throughput_run():
+    results = throughput.run(grid={"proc": (1,), "overlap": (0,), "files_per_batch": (1, 5)}, corpus={"n_dirs": 2, "n_files": 1, "fs": 250_000, "duration": 1}, repeat=1, verbose=False)
+
+    assert list(results["results"]) == ["proc=1,overlap=0,files_per_batch=1", "proc=1,overlap=0,files_per_batch=5"]
+    for result in results["results"].values():
+        assert result["files"] == 2 and result["segments"] == 2
+        assert result["files_per_s"] > 0 and result["peak_rss_mb"] > 0
+    assert set(results["stages"]["overlap=0"]) == {"read", "render", "predict", "tidy"}
@@ -0,0 +1,241 @@
+import os
+import shutil
+import threading
+import numpy as np
+import pytest
+from types import SimpleNamespace
+from scipy.io.wavfile import write
+import source.cache as cache
+import source.predict as predict
+from source.predict import DETECTION_DTYPE, recording_to_predict, result_parameters
+
+""" Helpers: one box per image, and a model that counts the images it predicts """
+class DummyBoxes:
+    xyxy = np.array([[10, 20, 110, 220]], dtype=np.float32)
+    cls = np.zeros(1, dtype=np.float32)
+    conf = np.full(1, 0.5, dtype=np.float32)
+    def __len__(self):
+        return 1
+
+class CountingModel:
+    def __init__(self):
+        self.predicted = 0
+    def to(self, device):
+        pass
+    def predict(self, *, source, save, verbose, device, conf, iou):
+        self.predicted += len(source)
+        return [SimpleNamespace(boxes=DummyBoxes(), orig_shape=(400, 1280), names={0: "buzz"}) for _ in source]
+
+@pytest.fixture
+def setup(tmp_path, monkeypatch):
+    monkeypatch.setattr("source.predict.read_clean_wav", lambda wav_file: (1000, np.zeros(2500, dtype=np.float32)))
+    monkeypatch.setattr("source.visualise.viz_audio_segment", lambda *args, **kwargs: (np.zeros((4, 4, 3)), f"x_{kwargs['time_img'][0]}_{kwargs['time_img'][1]}.png"))
+    (tmp_path / "model.pt").write_bytes(b"weights")
+    wav = tmp_path / "rec.wav"
+    write(wav, 1000, np.zeros(2500, dtype=np.int16)) # the cache reads its size and modification time, the audio comes from read_clean_wav
+    return tmp_path, str(wav)
+
+""" A recording is only analysed the first time, after that its detections come from the cache """
+def test_recording_to_predict_uses_cache(setup):
+    tmp_path, wav = setup
+    result_cache = cache.open_cache(str(tmp_path / "cache"), tmp_path / "model.pt")
+    model = CountingModel()
+
+    first = recording_to_predict(wav, model, overlap=0.5, cache=result_cache)
+    second = recording_to_predict(wav, model, overlap=0.5, cache=result_cache)
+
+    analysed = model.predicted
+    assert analysed == 4 # only the first call
+    assert first[0]["names"] == second[0]["names"] and second[0]["status"] == "ok"
+    assert np.array_equal(first[1], second[1])
+
+    recording_to_predict(wav, model, overlap=0.3, cache=result_cache) # other parameters
+    assert model.predicted > analysed
+    analysed = model.predicted
+
+    os.utime(wav, ns=(0, 0)) # changed recording
+    recording_to_predict(wav, model, overlap=0.5, cache=result_cache)
+    assert model.predicted == analysed + 4
+
+""" Other weights of the model don't use the detections of the old model """
+def test_cache_key_depends_on_model(setup):
+    tmp_path, wav = setup
+    params = result_parameters()
+    key = cache.result_key(cache.open_cache(str(tmp_path / "cache"), tmp_path / "model.pt"), wav, params)
+    (tmp_path / "model.pt").write_bytes(b"retrained weights")
+
+    assert cache.result_key(cache.open_cache(str(tmp_path / "cache"), tmp_path / "model.pt"), wav, params) != key
+
+""" With fast_hash copies of a recording are found in the cache, with their own path in the header """
+def test_cache_fast_hash_finds_copies(setup):
+    tmp_path, wav = setup
+    result_cache = cache.open_cache(str(tmp_path / "cache"), tmp_path / "model.pt", fast_hash=True)
+    model = CountingModel()
+    recording_to_predict(wav, model, cache=result_cache)
+
+    copy = str(tmp_path / "copy.wav")
+    shutil.copy(wav, copy)
+    header, detections = recording_to_predict(copy, model, cache=result_cache)
+
+    assert model.predicted == 3
+    assert header["filepath"] == copy and len(detections) == 3
+
+""" Unreadable recordings are cached as corrupt, recordings without detections as empty """
+def test_cache_records_corrupt_and_empty_recordings(setup, monkeypatch):
+    tmp_path, wav = setup
+    result_cache = cache.open_cache(str(tmp_path / "cache"), tmp_path / "model.pt")
+    monkeypatch.setattr("source.predict.read_clean_wav", lambda wav_file: (None, None))
+    recording_to_predict(wav, CountingModel(), cache=result_cache)
+
+    empty = str(tmp_path / "empty.wav")
+    shutil.copy(wav, empty)
+    cache.put_result(result_cache, empty, result_parameters(), ({"filepath": empty, "names": ()}, np.empty(0, dtype=DETECTION_DTYPE)))
+
+    assert cache.get_result(result_cache, wav, result_parameters())[0]["status"] == "corrupt"
+    assert cache.get_result(result_cache, empty, result_parameters())[0]["status"] == "empty"
+
+""" The least recently used recordings are removed when the cache is too large """
+def test_cache_evicts_least_recently_used(setup):
+    tmp_path, wav = setup
+    result_cache = cache.open_cache(str(tmp_path / "cache"), tmp_path / "model.pt", max_size=5000 / 1024**2) # room for 2 recordings with 100 detections
+    params = result_parameters()
+    files = []
+    for i in range(3):
+        files.append(str(tmp_path / f"{i}.wav"))
+        shutil.copy(wav, files[-1])
+
+    cache.put_result(result_cache, files[0], params, ({"names": ("buzz",)}, np.zeros(100, dtype=DETECTION_DTYPE)))
+    cache.put_result(result_cache, files[1], params, ({"names": ("buzz",)}, np.zeros(100, dtype=DETECTION_DTYPE)))
+    assert cache.get_result(result_cache, files[0], params) is not None # 0 is used more recently than 1
+    cache.put_result(result_cache, files[2], params, ({"names": ("buzz",)}, np.zeros(100, dtype=DETECTION_DTYPE)))
+
+    assert [cache.get_result(result_cache, f, params) is not None for f in files] == [True, False, True]
+
+""" Helper: stores the results of the recordings in the cache again and again (in a worker process) """
+def put_results_repeatedly(result_cache, files, params, repeat):
+    for i in range(repeat):
+        for n, wav_file in enumerate(files):
+            cache.put_result(result_cache, wav_file, params, ({"names": ("buzz",)}, np.zeros(n + i % 3, dtype=DETECTION_DTYPE)))
+
+""" Processes replacing the same results at the same time keep the total size of the cache equal to the size of its results """
+def test_cache_total_with_concurrent_writers(setup):
+    import multiprocessing as mp
+    tmp_path, wav = setup
+    result_cache = cache.open_cache(str(tmp_path / "cache"), tmp_path / "model.pt")
+    params = result_parameters()
+    files = []
+    for i in range(3):
+        files.append(str(tmp_path / f"{i}.wav"))
+        shutil.copy(wav, files[-1])
+
+    processes = [mp.get_context("fork").Process(target=put_results_repeatedly, args=(result_cache, files, params, 100)) for _ in range(4)]
+    for p in processes: p.start()
+    for p in processes: p.join()
+
+    connection = cache._connection(result_cache)
+    total, = connection.execute("SELECT size FROM total WHERE id = 0").fetchone()
+    assert [p.exitcode for p in processes] == [0] * 4
+    assert total == connection.execute("SELECT SUM(size) FROM results").fetchone()[0]
+
+""" Only recordings that are not cached are analysed by cached_results, and their results are cached """
+def test_cached_results_analyses_missing_recordings(setup):
+    tmp_path, wav = setup
+    result_cache = cache.open_cache(str(tmp_path / "cache"), tmp_path / "model.pt")
+    params = result_parameters()
+    other = str(tmp_path / "other.wav")
+    shutil.copy(wav, other)
+    cache.put_result(result_cache, wav, params, ({"names": ("buzz",)}, np.zeros(2, dtype=DETECTION_DTYPE)))
+
+    analysed = []
+    def analyse(file_paths):
+        analysed.extend(file_paths)
+        return ((f, ({"filepath": f, "names": ("buzz",)}, np.zeros(1, dtype=DETECTION_DTYPE))) for f in file_paths)
+
+    out = list(cache.cached_results(result_cache, [wav, other], params, analyse))
+
+    assert analysed == [other]
+    assert [(f, len(block[1])) for f, block in out] == [(wav, 2), (other, 1)]
+    assert cache.get_result(result_cache, other, params) is not None
+
+""" Images are rendered once per set of render parameters and then read from the shards, with the same images, filenames and start times """
+def test_image_cache_renders_once(setup, monkeypatch):
+    tmp_path, wav = setup
+    image_cache = cache.open_image_cache(str(tmp_path / "images"))
+    rendered = []
+    def fake_viz(*args, time_img, **kwargs):
+        rendered.append(time_img[0])
+        return np.full((4, 4, 3), time_img[0] // 100, dtype=np.uint8), f"x_{time_img[0]}_{time_img[1]}.png"
+    monkeypatch.setattr("source.visualise.viz_audio_segment", fake_viz)
+
+    first = recording_to_predict(wav, CountingModel(), overlap=0.5, image_cache=image_cache)
+    second = recording_to_predict(wav, CountingModel(), overlap=0.5, image_cache=image_cache)
+    assert len(rendered) == 4 # only the first call
+    assert np.array_equal(first[1], second[1])
+
+    params = predict.render_parameters(overlap=0.5)
+    images = list(cache.cached_images(image_cache, wav, params, render=lambda: 1 / 0))
+    assert [(int(img[0, 0, 0]), filename, start) for img, filename, start in images] == [(0, "x_0_1000.png", 0), (5, "x_500_1500.png", 500), (10, "x_1000_2000.png", 1000), (15, "x_1500_2500.png", 1500)]
+
+    recording_to_predict(wav, CountingModel(), overlap=0.3, image_cache=image_cache) # other parameters
+    assert len(rendered) > 4
+
+""" Unreadable recordings are remembered, cancelled recordings are not cached """
+def test_image_cache_unreadable_and_cancelled(setup):
+    tmp_path, wav = setup
+    image_cache = cache.open_image_cache(str(tmp_path / "images"))
+    params = predict.render_parameters()
+
+    assert cache.cached_images(image_cache, wav, params, render=lambda: None) is None
+    assert cache.cached_images(image_cache, wav, params, render=lambda: 1 / 0) is None
+
+    cancel_event = threading.Event()
+    images = cache.cached_images(image_cache, wav, {"other": 1}, render=lambda: iter([(np.zeros((4, 4, 3), dtype=np.uint8), "x_0_1000.png", 0)]), cancel_event=cancel_event)
+    cancel_event.set()
+    assert len(list(images)) == 1
+    rendered = []
+    list(cache.cached_images(image_cache, wav, {"other": 1}, render=lambda: rendered.append(True) or iter([])))
+    assert rendered == [True] # rendered again
+
+""" Helper: render function of n images of 4 x 4 pixels filled with value """
+def render_images(value, n=4):
+    return lambda: iter([(np.full((4, 4, 3), value, dtype=np.uint8), f"x_{i}.png", i * 1000) for i in range(n)])
+
+""" Images of a recording that isn't rendered completely (error, cancelled or not read to the end) are cut off the shard again """
+def test_image_cache_truncates_incomplete_recordings(setup):
+    tmp_path, wav = setup
+    image_cache = cache.open_image_cache(str(tmp_path / "images"))
+    list(cache.cached_images(image_cache, wav, {"n": 0}, render=render_images(0)))
+    shard = next((tmp_path / "images").glob("shard_*.bin"))
+    assert shard.stat().st_size == 4 * 48
+
+    def failing():
+        yield from render_images(1, n=2)()
+        raise MemoryError
+    with pytest.raises(MemoryError):
+        list(cache.cached_images(image_cache, wav, {"n": 1}, render=failing))
+    assert shard.stat().st_size == 4 * 48
+
+    images = cache.cached_images(image_cache, wav, {"n": 2}, render=render_images(2))
+    next(images)
+    images.close() # not read to the end
+    assert shard.stat().st_size == 4 * 48
+
+    list(cache.cached_images(image_cache, wav, {"n": 3}, render=render_images(3)))
+    assert shard.stat().st_size == 8 * 48
+    assert [int(img[0, 0, 0]) for img, _, _ in cache.cached_images(image_cache, wav, {"n": 3}, render=lambda: 1 / 0)] == [3] * 4
+
+""" The shards of the least recently used images are removed when the image cache is larger than its maximum size """
+def test_image_cache_evicts_least_recently_used(setup):
+    tmp_path, wav = setup
+    image_cache = cache.open_image_cache(str(tmp_path / "images"), max_size=1000 / 1024**2) # 1000 bytes: 5 recordings of 192 bytes, a shard per recording
+    for i in range(5):
+        list(cache.cached_images(image_cache, wav, {"n": i}, render=render_images(i)))
+    list(cache.cached_images(image_cache, wav, {"n": 0}, render=lambda: 1 / 0)) # 0 is used more recently than 1
+    for i in range(5, 7):
+        list(cache.cached_images(image_cache, wav, {"n": i}, render=render_images(i)))
+
+    rendered = []
+    for i in range(7):
+        list(cache.cached_images(image_cache, wav, {"n": i}, render=lambda i=i: rendered.append(i) or iter([])))
+    assert sum(f.stat().st_size for f in (tmp_path / "images").glob("shard_*.bin")) <= 1000
+    assert rendered == [1, 2] # least recently used
@@ -0,0 +1,27 @@
+import pytest
+
+""" Helper: returns a function that builds an untrained YOLOv8n model that finds boxes in every image (the class biases are raised, so confidences are above predict.CONF).
+    With a path the model is saved there and loaded again, like a trained model file """
+@pytest.fixture(scope="session")
+def yolo_stub_factory():
+    torch = pytest.importorskip("torch")
+    YOLO = pytest.importorskip("ultralytics").YOLO
+
+    def yolo_stub(path=None):
+        torch.manual_seed(0)
+        model = YOLO("yolov8n.yaml", verbose=False)
+        for head in model.model.model[-1].cv3: # untrained model, make sure it finds boxes
+            torch.nn.init.constant_(head[-1].bias, -0.5)
+
+        if path is not None:
+            model.save(str(path))
+            model = YOLO(str(path), verbose=False)
+
+        return model
+
+    return yolo_stub
+
+""" Helper: untrained YOLOv8n model that finds boxes (see yolo_stub_factory), a new one per test """
+@pytest.fixture
+def yolo_stub(yolo_stub_factory):
+    return yolo_stub_factory()
@@ -1,10 +1,12 @@
 
 import os
+import sqlite3
+from contextlib import closing
 import pandas as pd
 import pytest
 from pathlib import Path
 
-from source.log import read_log_file, log_file_correctness_check, logging
+from source.log import read_log_file, log_file_correctness_check, logging, open_log, start_output, log_files, finish_output, done_files, dir_done
 
 """ Tests on reading df """
 def test_read_log_file_success(tmp_path):
@@ -75,10 +77,9 @@ def test_logging_create_log_file(tmp_path, capsys):
     out = logging(str(path), dirs)
     captured = capsys.readouterr().out
     assert out == dirs
-    assert log_path.exists()
-    df = pd.read_csv(log_path)
-    assert list(df.columns) == ["dir", "done"]
-    assert (df["done"] == "no").all()
+    assert not log_path.exists()
+    with closing(sqlite3.connect(path / "log.sqlite")) as connection:
+        assert connection.execute("SELECT dir, done FROM dirs ORDER BY dir").fetchall() == [("/a", 0), ("/b", 0)]
     assert "Initialising log file" in captured
 
 """ Checks if existence of log file is handled correctly """
@@ -113,3 +114,38 @@ def test_logging_existing_log_mismatch_raises_systemexit(tmp_path, capsys):
     with pytest.raises(SystemExit):
         logging(str(path), dirs)
 
+
+""" Continuing uses the log of the earlier run: dirs that are done are skipped, and so are the recordings of the other dirs that are written already (whatever their status) """
+def test_logging_continues_with_logged_files(tmp_path):
+    logging(str(tmp_path), ["/a", "/b"])
+    with closing(open_log(str(tmp_path))) as connection:
+        start_output(connection, "/b/output_1-3.csv", "/b/output_1-3.csv.part", "csv")
+        log_files(connection, [({"filepath": "/b/1.wav", "duration": 1.5}, 3), ({"filepath": "/b/2.wav"}, 0), ({"filepath": "/b/3.wav", "status": "corrupt"}, 0)], "/b/output_1-3.csv", 100)
+        assert connection.execute("SELECT filepath, status FROM files ORDER BY filepath").fetchall() == [("/b/1.wav", "ok"), ("/b/2.wav", "empty"), ("/b/3.wav", "corrupt")]
+    finish_output(str(tmp_path), "/b/output_1-3.csv")
+    dir_done(str(tmp_path), "/a")
+
+    assert logging(str(tmp_path), ["/a", "/b"]) == ["/b"]
+    assert done_files(str(tmp_path), "/b") == done_files(str(tmp_path), "/b/") == {"/b/1.wav", "/b/2.wav", "/b/3.wav"}
+    assert done_files(str(tmp_path), "/a") == set()
+
+""" Output of an interrupted analysis is cut off after the last logged chunk and kept (csv), or analysed again (parquet) """
+def test_logging_recovers_interrupted_output(tmp_path):
+    data = tmp_path / "data"
+    data.mkdir()
+    logging(str(tmp_path), [str(data)])
+
+    committed = "filename,filepath\n1.wav,/data/1.wav\n"
+    (data / "output_1-3.csv.part").write_text(committed + "2.wav,/da") # interrupted while writing the second chunk
+    (data / "output_4-6.parquet.part").write_bytes(b"PAR1...")
+    with closing(open_log(str(tmp_path))) as connection:
+        start_output(connection, str(data / "output_1-3.csv"), str(data / "output_1-3.csv.part"), "csv")
+        log_files(connection, [({"filepath": str(data / "1.wav")}, 1)], str(data / "output_1-3.csv"), len(committed))
+        start_output(connection, str(data / "output_4-6.parquet"), str(data / "output_4-6.parquet.part"), "parquet")
+        log_files(connection, [({"filepath": str(data / "4.wav")}, 1)], str(data / "output_4-6.parquet"))
+
+    assert logging(str(tmp_path), [str(data)]) == [str(data)]
+
+    assert sorted(p.name for p in data.iterdir()) == ["output_1-3.csv"]
+    assert (data / "output_1-3.csv").read_text() == committed
+    assert done_files(str(tmp_path), str(data)) == {str(data / "1.wav")}
@@ -1,18 +1,19 @@
 import os
+import sqlite3
+import numpy as np
 import pandas as pd
 import builtins
+import threading
+import time
 import types
 import pytest
 import main
+from concurrent.futures import Future
+from source.predict import DETECTION_DTYPE
 
 from pathlib import Path
 
 
-""" Helper YOLO object for testing """
-class DummyYOLO:
-    def __init__(self, model_path):
-        self.model_path = model_path
-
 """ Helper: Context manager that mimics ProcessPoolExecutor but runs jobs synchronously """
 class DummyExecutor:
     def __init__(self, *args, **kwargs):
@@ -28,6 +29,24 @@ class DummyExecutor:
         # return generator that calls func synchronously for each arg
         return (func(i) for i in iterable)
 
+    def submit(self, func, *args, **kwargs):
+        # return a future that is already done
+        future = Future()
+        try:
+            future.set_result(func(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self, *args, **kwargs):
+        pass
+
+""" Helper: block of detections (see results_to_block) with a single detection """
+def make_block(filepath, category="buzz"):
+    detections = np.zeros(1, dtype=DETECTION_DTYPE)
+    detections[["confidence", "end_time_ms", "freq_min", "freq_max"]] = (0.9, 100, 20, 50)
+    return {"filename": os.path.basename(filepath), "filepath": filepath, "names": (category,)}, detections
+
 """ Helper: Returns a fake recording_to_predict function that ignores extra kwargs (partial will add them) """
 def make_fake_recording_to_predict(return_per_file):
     if callable(return_per_file):
@@ -40,9 +59,9 @@ def make_fake_recording_to_predict(return_per_file):
 
 """ Test if correctly handled where no dirs are found in the log file """
 def test_no_dirs_found(monkeypatch, capsys):
-    monkeypatch.setattr(main, "YOLO", DummyYOLO)
-    monkeypatch.setattr(main, "get_dirs_wav", lambda head_dir_list: head_dir_list)
+    monkeypatch.setattr(main, "find_wav_files", lambda head_dir_list, **kwargs: {})
     monkeypatch.setattr(main.log, "logging", lambda path, dirs: [])
+    monkeypatch.setattr(main, "ProcessPoolExecutor", DummyExecutor)
     result = main.main(dir_list=["/does/not/matter"], log_path=False, recursive=True, proc=1)
 
     captured = capsys.readouterr()
@@ -52,11 +71,9 @@ def test_no_dirs_found(monkeypatch, capsys):
 
 """ When dir exists but no wav files are found, main prints and (with app=True) posts msg_queue progress """
 def test_no_wav_files_in_dir(monkeypatch, capsys):
-    monkeypatch.setattr(main, "YOLO", DummyYOLO)
-    monkeypatch.setattr(main, "get_dirs_wav", lambda head_dir_list: ["/fake/dir"])
+    monkeypatch.setattr(main, "find_wav_files", lambda head_dir_list, **kwargs: {})
     monkeypatch.setattr(main.log, "logging", lambda path, dirs: ["/fake/dir"])
-    monkeypatch.setattr(main, "glob", types.SimpleNamespace(glob=lambda pattern: []))
-    monkeypatch.setattr(main, "time", types.SimpleNamespace(sleep=lambda s: None))
+    monkeypatch.setattr(main, "ProcessPoolExecutor", DummyExecutor)
 
     # msg_queue stub
     class MQ:
@@ -82,35 +99,171 @@ def test_process_single_dir_writes_output_and_updates_log(tmp_path, monkeypatch)
 
     log_path = tmp_path / "logs"
     log_path.mkdir()
-    log_csv = log_path / "log.csv"
-    pd.DataFrame([{"dir": str(proc_dir), "done": ""}]).to_csv(log_csv, index=False)
 
-    monkeypatch.setattr(main, "YOLO", DummyYOLO)
-    monkeypatch.setattr(main, "get_dirs_wav", lambda head_dir_list: [str(proc_dir)])
-    monkeypatch.setattr(main.log, "logging", lambda path, dirs: [str(proc_dir)])
-    monkeypatch.setattr(main, "glob", types.SimpleNamespace(glob=lambda pattern: fake_files))
+    monkeypatch.setattr(main, "find_wav_files", lambda head_dir_list, **kwargs: {str(proc_dir): [(f, 0) for f in fake_files]})
     monkeypatch.setattr(main, "ProcessPoolExecutor", DummyExecutor)
 
     def fake_recording_to_predict(filepath, *args, **kwargs):
-        return [{
-            "filename": os.path.basename(filepath),
-            "filepath": filepath,
-            "category": "buzz",
-            "confidence": 0.9,
-            "start_time_ms": 0,
-            "end_time_ms": 100,
-            "freq_min": 20000,
-            "freq_max": 50000
-        }]
+        return make_block(filepath)
 
     monkeypatch.setattr(main, "recording_to_predict", fake_recording_to_predict)
-    monkeypatch.setattr(main, "overlap_tidy", lambda df, threshold: df)
 
     main.main(dir_list=str(proc_dir), log_path=str(log_path), recursive=True, proc=2, files_per_batch=1000)
 
     expected_output = proc_dir / "output_1-2.csv"
     assert expected_output.exists()
-    df_log = pd.read_csv(str(log_csv))
-    row = df_log.loc[df_log["dir"] == str(proc_dir)]
-    assert not row.empty
-    assert row.iloc[0]["done"] == "yes"
+    with sqlite3.connect(log_path / "log.sqlite") as connection:
+        assert connection.execute("SELECT done FROM dirs WHERE dir = ?", (str(proc_dir),)).fetchone() == (1,)
+        files = connection.execute("SELECT filepath, status, detections, output FROM files ORDER BY filepath").fetchall()
+    assert files == [(f, "ok", 1, str(expected_output)) for f in fake_files]
+
+""" An interrupted analysis continues with the recordings that aren't written yet, and keeps the output that was written """
+def test_interrupted_dir_continues_with_remaining_files(tmp_path, monkeypatch):
+    proc_dir = tmp_path / "proc_dir"
+    proc_dir.mkdir()
+    fake_files = [str(proc_dir / f"{i}.wav") for i in range(4)]
+    log_path = tmp_path / "logs"
+    log_path.mkdir()
+
+    monkeypatch.setattr(main, "find_wav_files", lambda head_dir_list, **kwargs: {str(proc_dir): [(f, 0) for f in fake_files]})
+    monkeypatch.setattr(main, "ProcessPoolExecutor", DummyExecutor)
+    analysed = []
+
+    def crashing_recording_to_predict(filepath, *args, **kwargs):
+        if filepath.endswith("2.wav") and not analysed.count(filepath): # crashes the first time
+            analysed.append(filepath)
+            raise MemoryError("out of memory")
+        analysed.append(filepath)
+        return make_block(filepath)
+    monkeypatch.setattr(main, "recording_to_predict", crashing_recording_to_predict)
+
+    with pytest.raises(MemoryError):
+        main.main(dir_list=str(proc_dir), log_path=str(log_path), recursive=True, proc=1, write_every=1, max_pending=1) # one recording at a time
+    main.main(dir_list=str(proc_dir), log_path=str(log_path), recursive=True, proc=1, write_every=1, max_pending=1)
+
+    assert analysed == fake_files[:3] + fake_files[2:] # written recordings are not analysed again
+    assert pd.read_csv(proc_dir / "output_1-4.csv")["filepath"].tolist() == fake_files[:2] # written when the analysis stopped
+    assert pd.read_csv(proc_dir / "output_1-2.csv")["filepath"].tolist() == fake_files[2:] # the remaining files
+    assert not list(proc_dir.glob("*.part"))
+
+""" Without a log the output of an interrupted batch is removed, nothing would tell it is incomplete """
+def test_interrupted_without_log_removes_output(tmp_path, monkeypatch):
+    proc_dir = tmp_path / "proc_dir"
+    proc_dir.mkdir()
+    fake_files = [str(proc_dir / f"{i}.wav") for i in range(4)]
+
+    monkeypatch.setattr(main, "find_wav_files", lambda head_dir_list, **kwargs: {str(proc_dir): [(f, 0) for f in fake_files]})
+    monkeypatch.setattr(main, "ProcessPoolExecutor", DummyExecutor)
+
+    def crashing_recording_to_predict(filepath, *args, **kwargs):
+        if filepath.endswith("2.wav"): raise MemoryError("out of memory")
+        return make_block(filepath)
+    monkeypatch.setattr(main, "recording_to_predict", crashing_recording_to_predict)
+
+    with pytest.raises(MemoryError):
+        main.main(dir_list=str(proc_dir), log_path=False, recursive=True, proc=1, write_every=1, max_pending=1)
+
+    assert list(proc_dir.iterdir()) == []
+
+""" In pipeline_mode the inference processes are stopped (without waiting) and the image slots are freed when the analysis fails """
+def test_pipeline_mode_stops_inference_after_error(tmp_path, monkeypatch):
+    proc_dir = tmp_path / "proc_dir"
+    proc_dir.mkdir()
+    stopped = []
+
+    monkeypatch.setattr(main, "find_wav_files", lambda head_dir_list, **kwargs: {str(proc_dir): [(str(proc_dir / "a.wav"), 0)]})
+    monkeypatch.setattr(main, "ProcessPoolExecutor", DummyExecutor)
+    monkeypatch.setattr(main.pipeline, "create_image_slots", lambda n_slots, shape: ("shm", "slots"))
+    monkeypatch.setattr(main.pipeline, "start_inference", lambda *args, **kwargs: ("image_queue", "result_queue", ["process"]))
+    monkeypatch.setattr(main.pipeline, "stop_inference", lambda image_queue, processes, shm, wait=True: stopped.append((image_queue, processes, shm, wait)))
+
+    def failing_predict_files(*args, **kwargs):
+        raise RuntimeError("Inference processes stopped unexpectedly")
+        yield
+    monkeypatch.setattr(main.pipeline, "predict_files", failing_predict_files)
+
+    with pytest.raises(RuntimeError):
+        main.main(dir_list=str(proc_dir), log_path=False, recursive=True, proc=1, pipeline_mode=True)
+
+    assert stopped == [("image_queue", ["process"], "shm", False)]
+
+""" The worker pool is created once (with the model path for the initialiser) and reused for all dirs and batches """
+def test_single_pool_reused_across_dirs_and_batches(tmp_path, monkeypatch):
+    dirs = [tmp_path / "d1", tmp_path / "d2"]
+    for d in dirs: d.mkdir()
+    pools = []
+
+    class RecordingExecutor(DummyExecutor):
+        def __init__(self, *args, **kwargs):
+            self.kwargs = kwargs
+            self.submitted = 0
+            pools.append(self)
+        def submit(self, func, *args, **kwargs):
+            self.submitted += 1
+            return super().submit(func, *args, **kwargs)
+
+    monkeypatch.setattr(main, "find_wav_files", lambda head_dir_list, **kwargs: {str(d): [(os.path.join(d, f"{i}.wav"), 0) for i in range(3)] for d in dirs})
+    monkeypatch.setattr(main.log, "logging", lambda path, dirs: dirs)
+    monkeypatch.setattr(main, "ProcessPoolExecutor", RecordingExecutor)
+    monkeypatch.setattr(main, "recording_to_predict", lambda filepath, model, **kwargs: make_block(filepath, category=str(model)))
+
+    main.main(dir_list=[str(d) for d in dirs], log_path=False, model_path="some_model.pt", proc=2, files_per_batch=2)
+
+    assert len(pools) == 1
+    assert pools[0].kwargs["initializer"] is main.init_worker
+    assert str(pools[0].kwargs["initargs"][0]).endswith("some_model.pt")
+    assert pools[0].submitted == 6 # all recordings of both dirs
+    assert {f.name for d in dirs for f in d.iterdir()} == {"output_1-2.csv", "output_3-3.csv"} # two batches in each of the two dirs
+    df = pd.read_csv(dirs[0] / "output_1-2.csv")
+    assert df["category"].str.endswith("some_model.pt").all() # only the model path is sent with the tasks
+
+""" Recordings of all dirs share one queue: a dir is finished (output written and logged) while a slow recording of another dir is still analysed """
+def test_dirs_finish_independently(tmp_path, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    dirs = [tmp_path / "slow", tmp_path / "fast"]
+    for d in dirs: d.mkdir()
+    log_path = tmp_path / "logs"
+    log_path.mkdir()
+    seen = []
+
+    def fake_recording_to_predict(filepath, *args, **kwargs):
+        if "slow" in filepath:
+            for _ in range(500): # until the other dir is done
+                if (dirs[1] / "output_1-3.csv").exists(): break
+                time.sleep(0.01)
+            seen.append((dirs[1] / "output_1-3.csv").exists())
+        return make_block(filepath)
+
+    monkeypatch.setattr(main, "find_wav_files", lambda head_dir_list, **kwargs: {str(dirs[0]): [(str(dirs[0] / "0.wav"), 0)], str(dirs[1]): [(str(dirs[1] / f"{i}.wav"), 0) for i in range(3)]})
+    monkeypatch.setattr(main, "ProcessPoolExecutor", ThreadPoolExecutor)
+    monkeypatch.setattr(main, "init_worker", lambda *args: None)
+    monkeypatch.setattr(main, "recording_to_predict", fake_recording_to_predict)
+
+    main.main(dir_list=[str(d) for d in dirs], log_path=str(log_path), proc=2)
+
+    assert seen == [True]
+    assert pd.read_csv(dirs[0] / "output_1-1.csv")["filepath"].tolist() == [str(dirs[0] / "0.wav")]
+    with sqlite3.connect(log_path / "log.sqlite") as connection:
+        assert connection.execute("SELECT COUNT(*) FROM dirs WHERE done = 1").fetchone() == (2,)
+
+""" Cancelling in pipeline mode stops the inference processes without waiting on the images that are still queued (nobody reads their results anymore) """
+def test_pipeline_mode_cancel_stops_inference_without_waiting(tmp_path, monkeypatch):
+    proc_dir = tmp_path / "proc_dir"
+    proc_dir.mkdir()
+    cancel_event = threading.Event()
+    stopped = []
+
+    monkeypatch.setattr(main, "find_wav_files", lambda head_dir_list, **kwargs: {str(proc_dir): [(str(proc_dir / f"{i}.wav"), 0) for i in range(3)]})
+    monkeypatch.setattr(main, "ProcessPoolExecutor", DummyExecutor)
+    monkeypatch.setattr(main.pipeline, "create_image_slots", lambda n_slots, shape: ("shm", "slots"))
+    monkeypatch.setattr(main.pipeline, "start_inference", lambda *args, **kwargs: ("image_queue", "result_queue", ["process"]))
+    monkeypatch.setattr(main.pipeline, "stop_inference", lambda image_queue, processes, shm, wait=True: stopped.append((image_queue, processes, shm, wait)))
+
+    def cancelled_predict_files(executor, wav_files, result_queue, processes, **kwargs): # First result arrives, the other images are still queued when the analysis is cancelled
+        cancel_event.set()
+        yield wav_files[0], make_block(wav_files[0])
+    monkeypatch.setattr(main.pipeline, "predict_files", cancelled_predict_files)
+
+    main.main(dir_list=str(proc_dir), log_path=False, recursive=True, proc=1, pipeline_mode=True, cancel_event=cancel_event)
+
+    assert stopped == [("image_queue", ["process"], "shm", False)]
@@ -3,7 +3,8 @@ import numpy as np
 import pytest
 from scipy.io.wavfile import write
 import os
-from source.misc import read_clean_wav, get_dirs_wav
+from scipy.signal import butter, lfilter
+from source.misc import read_clean_wav, get_dirs_wav, find_wav_files, highpass_sos, stream_clean_wav
 
 """ read_clean_wav tests """ 
 def make_wav(path, fs=192000, duration=0.01): # make mock wav file
@@ -59,6 +60,75 @@ def test_highpass_removes_low_freq(tmp_path): # check high pass filtering
 
     assert np.std(audio) > 0
 
+""" Filtering in float32 second-order sections (per chunk) gives the same result as the float64 transfer function filter """
+@pytest.mark.parametrize("channels", [1, 2])
+@pytest.mark.parametrize("keep_int", [True, False])
+def test_filter_matches_float64_reference(tmp_path, channels, keep_int):
+    fs = 250000
+    sig = (np.random.default_rng(0).standard_normal((fs, channels)) * 3000).astype(np.int16).squeeze()
+    wav = tmp_path / "noise.wav"
+    write(wav, fs, sig)
+
+    b, a = butter(5, 15_000 / (0.5 * fs), btype='high', analog=False)
+    expected = lfilter(b, a, sig.mean(axis=1) if channels == 2 else sig)
+    expected = expected / np.max(np.abs(expected))
+
+    _, audio = read_clean_wav(wav, keep_int=keep_int)
+
+    assert audio.dtype == np.float32
+    assert np.max(np.abs(audio - expected)) < 1e-5
+    assert np.isclose(np.max(np.abs(audio)), 1.0)
+
+""" Filter is designed once per sample rate """
+def test_highpass_sos_cached():
+    assert highpass_sos(192000) is highpass_sos(192000)
+    assert highpass_sos(192000) is not highpass_sos(250000)
+    assert highpass_sos(192000).shape == (3, 6) # 5th order: 3 second-order sections
+
+""" Streamed chunks with two-pass normalisation are the same as the whole recording, the running normalisation only differs in scale """
+@pytest.mark.parametrize("channels", [1, 2])
+def test_stream_clean_wav_matches_read_clean_wav(tmp_path, channels):
+    fs = 192000
+    sig = (np.random.default_rng(1).standard_normal((fs * 2, channels)) * 3000).astype(np.int16).squeeze()
+    sig[fs:] //= 4 # peak in the first half
+    wav = tmp_path / "noise.wav"
+    write(wav, fs, sig)
+
+    _, expected = read_clean_wav(wav)
+    fs_stream, total_samples, chunks = stream_clean_wav(wav, chunk_size=10_000)
+    audio = np.concatenate(list(chunks))
+
+    assert fs_stream == fs and total_samples == len(expected)
+    assert np.allclose(audio, expected, atol=1e-6)
+
+    _, _, chunks = stream_clean_wav(wav, normalise="running", chunk_size=10_000)
+    chunks = list(chunks)
+    assert np.max(np.abs(chunks[0])) == 1 # normalised by its own peak
+    assert np.allclose(np.concatenate(chunks)[fs:], expected[fs:], atol=1e-6) # after the peak the same as two-pass
+
+""" Leading silence stays silent with the running normalisation instead of becoming NaN (0 / 0), and the recording can be rendered """
+def test_stream_clean_wav_running_leading_silence(tmp_path):
+    fs = 192000
+    sig = np.zeros(fs * 2, dtype=np.int16)
+    sig[int(fs * 0.8):] = (np.random.default_rng(2).standard_normal(len(sig) - int(fs * 0.8)) * 3000).astype(np.int16)
+    wav = tmp_path / "silence.wav"
+    write(wav, fs, sig)
+
+    _, _, chunks = stream_clean_wav(wav, normalise="running", chunk_size=10_000)
+    audio = np.concatenate(list(chunks))
+
+    assert not np.isnan(audio).any()
+    assert (audio[:int(fs * 0.8)] == 0).all() and np.max(np.abs(audio)) == 1
+
+    from source.predict import recording_to_images
+    images, _, _ = recording_to_images(str(wav), stream=True, normalise="running")
+    assert len(images) == 2
+
+""" Streaming an unreadable file logs it like read_clean_wav """
+def test_stream_clean_wav_unreadable(tmp_path):
+    assert stream_clean_wav(tmp_path / "nope.wav") == (None, None, None)
+    assert (tmp_path / "corrupted_files_log.txt").exists()
+
 """ get_dirs_wav tests """
 def test_single_dir_with_wav(tmp_path):
     d = tmp_path / "a"
@@ -100,3 +170,30 @@ def test_no_wavs(tmp_path):
     out = get_dirs_wav(d)
 
     assert out == []
+
+""" find_wav_files tests """
+def test_find_wav_files_paths_and_sizes(tmp_path):
+    d1 = tmp_path / "a"
+    d2 = d1 / "b" / "c"
+    d2.mkdir(parents=True)
+    (d1 / "y.wav").write_bytes(b"12345")
+    (d1 / "x.WAV").write_bytes(b"123")
+    (d1 / "z.txt").touch()
+    (d2 / "w.wav").touch()
+
+    out = find_wav_files(tmp_path, workers=2)
+
+    assert out == {str(d1): [(str(d1 / "x.WAV"), 3), (str(d1 / "y.wav"), 5)], str(d2): [(str(d2 / "w.wav"), 0)]}
+    assert find_wav_files([d1, d2], recursive=False) == {str(d1): out[str(d1)], str(d2): out[str(d2)]}
+
+def test_find_wav_files_include_exclude(tmp_path):
+    for name in ["rec_Chan01_1.wav", "rec_Chan08_1.wav", "rec_Chan08_2.wav", "other.wav"]:
+        (tmp_path / name).touch()
+
+    def names(**kwargs):
+        return [os.path.basename(path) for path, size in find_wav_files(tmp_path, **kwargs).get(str(tmp_path), [])]
+
+    assert names(include="*Chan08*") == ["rec_Chan08_1.wav", "rec_Chan08_2.wav"]
+    assert names(include=["*Chan01*", "other*"], exclude="*_2.wav") == ["other.wav", "rec_Chan01_1.wav"]
+    assert names(exclude=["rec_*"]) == ["other.wav"]
+    assert find_wav_files(tmp_path / "missing") == {}
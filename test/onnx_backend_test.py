@@ -0,0 +1,115 @@
+import os
+import numpy as np
+import pytest
+import torch
+from ultralytics.utils.nms import non_max_suppression
+import source.onnx_backend as onnx_backend
+import source.visualise as vis
+from source.predict import predict_images, model_input_layout, backend_model, model_for_precision
+
+""" Helper: untrained model (saved at tmp_path) that finds boxes, exported to ONNX and loaded in ONNX Runtime """
+@pytest.fixture(scope="module")
+def models(tmp_path_factory, yolo_stub_factory):
+    pytest.importorskip("onnxruntime")
+    pytest.importorskip("onnx")
+    model = yolo_stub_factory(tmp_path_factory.mktemp("model") / "model.pt") # Predicts at 640 x 640, so images are resized too
+
+    return model, backend_model(model, "onnx")
+
+""" The non maximum suppression gives the same boxes as the one of ultralytics """
+def test_non_max_suppression_matches_ultralytics():
+    rng = np.random.default_rng(0)
+    predictions = np.concatenate((rng.uniform(0, 600, (2, 2, 3000)), rng.uniform(5, 80, (2, 2, 3000)), rng.uniform(0, 0.5, (2, 3, 3000))), axis=1).astype(np.float32)
+
+    expected = non_max_suppression(torch.from_numpy(predictions.copy()), conf_thres=0.1, iou_thres=0.4)
+    results = onnx_backend.non_max_suppression(predictions, conf=0.1, iou=0.4)
+
+    for a, b in zip(expected, results):
+        assert len(b) == len(a) > 0
+        assert np.allclose(b, a.numpy(), atol=1e-4)
+
+""" The ONNX model gives the same raw output as the PyTorch model, and predictions are boxes on the spectrogram image like those of the PyTorch model.
+    (Boxes of untrained models are not compared: their confidences are nearly all the same, so which boxes the suppression keeps depends on the order of equal confidences) """
+def test_onnx_predictions_match_torch(models):
+    model, onnx_model = models
+    layout = model_input_layout(onnx_model)
+    assert layout == model_input_layout(model)
+
+    inputs = list(np.random.default_rng(2).integers(0, 256, (2,) + layout["shape"] + (3,), dtype=np.uint8))
+    batch = np.ascontiguousarray(np.stack(inputs).transpose(0, 3, 1, 2), dtype=np.float32) / 255
+    with torch.no_grad():
+        expected = model.model.eval()(torch.from_numpy(batch))[0].numpy()
+    raw = onnx_model["session"].run(None, {onnx_model["input"]: batch})[0]
+    assert raw.shape == expected.shape
+    assert np.allclose(raw, expected, rtol=1e-3, atol=1e-2)
+
+    results = predict_images(onnx_model, inputs, tensor_input=True)
+    expected = predict_images(model, inputs, tensor_input=True)
+    assert len(results) == len(expected)
+    for a, b in zip(expected, results):
+        assert b.orig_shape == a.orig_shape and b.names == a.names
+        assert len(b.boxes) > 0
+        xyxy = np.asarray(b.boxes.xyxy)
+        assert (xyxy >= 0).all() and (xyxy[:, [0, 2]] <= a.orig_shape[1]).all() and (xyxy[:, [1, 3]] <= a.orig_shape[0]).all()
+        assert np.isclose(np.asarray(b.boxes.conf).max(), np.asarray(a.boxes.conf).max(), atol=1e-4)
+
+""" Spectrogram images are resized and padded like the letterbox of ultralytics """
+@pytest.mark.parametrize("imgsz", [640, 1280])
+def test_letterbox_matches_ultralytics(imgsz):
+    LetterBox = pytest.importorskip("ultralytics.data.augment").LetterBox
+    image = np.random.default_rng(3).integers(0, 256, (400, 1280, 3), dtype=np.uint8)
+
+    expected = LetterBox((imgsz, imgsz), auto=True, stride=32)(image=image)[..., ::-1] # ultralytics converts BGR to RGB
+    assert np.array_equal(onnx_backend.letterbox(image, vis.letterbox_layout(imgsz, 32)), expected)
+
+""" The model is exported once, and again when the weights change """
+def test_export_onnx_reuses_export(models, monkeypatch):
+    model, _ = models
+    onnx_path = onnx_backend.export_onnx(model.ckpt_path)
+    assert onnx_path.exists() and onnx_path.suffix == ".onnx"
+
+    exports = []
+    monkeypatch.setattr("ultralytics.YOLO.export", lambda self, **kwargs: exports.append(kwargs) or str(onnx_path))
+    assert onnx_backend.export_onnx(model.ckpt_path) == onnx_path
+    assert exports == []
+
+    mtime = os.stat(onnx_path).st_mtime
+    os.utime(model.ckpt_path, (mtime + 10, mtime + 10))
+    onnx_backend.export_onnx(model.ckpt_path)
+    assert exports and exports[0]["format"] == "onnx"
+
+""" Unknown backends are refused """
+def test_backend_model_unknown():
+    with pytest.raises(ValueError):
+        backend_model(object(), "tensorrt")
+
+""" The int8 model is quantised once, calibrated on the given model input images, and gives about the same output as the full precision model """
+def test_quantize_onnx(models):
+    model, onnx_model = models
+    onnx_path = onnx_backend.export_onnx(model.ckpt_path)
+    layout = onnx_model["layout"]
+    images = list(np.random.default_rng(4).integers(0, 256, (4,) + layout["shape"] + (3,), dtype=np.uint8))
+    calibrations = []
+    calibration = lambda: calibrations.append(len(images)) or images
+
+    int8_path = onnx_backend.quantize_onnx(onnx_path, calibration)
+    assert int8_path.name == "model.int8.onnx" and calibrations == [4]
+    assert onnx_backend.quantize_onnx(onnx_path, calibration) == int8_path and calibrations == [4]
+    assert not any(path.name.endswith((".part", ".pre")) for path in int8_path.parent.iterdir())
+
+    int8_model = onnx_backend.load_onnx(int8_path)
+    assert int8_model["names"] == onnx_model["names"] and int8_model["layout"] == layout
+
+    batch = onnx_backend.model_inputs(images[:2])
+    expected = onnx_model["session"].run(None, {onnx_model["input"]: batch})[0]
+    raw = int8_model["session"].run(None, {int8_model["input"]: batch})[0]
+    assert np.abs(raw[:, 4:] - expected[:, 4:]).max() < 0.05 # Confidences
+    assert np.abs(raw[:, :4] - expected[:, :4]).max() < 8 # Boxes (pixels)
+
+""" Precisions only run on the backend that supports them """
+def test_model_for_precision():
+    assert model_for_precision("model.pt") == "model.pt"
+    assert model_for_precision("model.pt", precision="bf16") == "model.pt"
+    for backend, precision in [("onnx", "bf16"), ("torch", "int8"), ("torch", "fp16"), ("tensorrt", "fp32")]:
+        with pytest.raises(ValueError):
+            model_for_precision("model.pt", backend=backend, precision=precision)
@@ -0,0 +1,217 @@
+import queue
+import threading
+import numpy as np
+import pytest
+from concurrent.futures import Future
+from types import SimpleNamespace
+import source.pipeline as pipeline
+from source.predict import blocks_to_frame
+
+""" Helpers that mimic the YOLO-like objects. The model returns one result per image and remembers the batch sizes """
+class DummyBoxes:
+    def __init__(self, xyxy, cls=0, conf=0.85):
+        self.xyxy = np.array([xyxy], dtype=np.float32)
+        self.cls = np.array([cls], dtype=np.float32)
+        self.conf = np.array([conf], dtype=np.float32)
+    def __len__(self):
+        return len(self.xyxy)
+
+class BatchModel:
+    def __init__(self):
+        self.batch_sizes = []
+    def to(self, device):
+        pass
+    def predict(self, *, source, save, verbose, device, conf, iou):
+        self.batch_sizes.append(len(source))
+        return [SimpleNamespace(boxes=DummyBoxes([0, 0, 10, 10]), orig_shape=(100, 100), names={0: "buzz"}) for _ in source]
+
+""" Helper: executor that runs submitted jobs synchronously """
+class SyncExecutor:
+    def submit(self, func, *args, **kwargs):
+        f = Future()
+        try:
+            f.set_result(func(*args, **kwargs))
+        except Exception as e:
+            f.set_exception(e)
+        return f
+
+def run_loop(model, items, batch_size, max_wait=0.5):
+    image_queue, result_queue = queue.Queue(), queue.Queue()
+    for item in items + [None]:
+        image_queue.put(item)
+    pipeline.inference_loop(model, image_queue, result_queue, batch_size=batch_size, max_wait=max_wait)
+    out = []
+    while not result_queue.empty():
+        out.append(result_queue.get())
+    return out
+
+def make_item(wav_file, n):
+    return (wav_file, [np.zeros((4, 4, 3))] * n, [f"IMG_x_{i:05d}_{i*1000}_{i*1000+1000}.png" for i in range(n)], [i * 1000 for i in range(n)], [])
+
+""" Images of multiple recordings are combined in fixed size batches and routed back per recording """
+def test_inference_loop_batches_across_files():
+    model = BatchModel()
+    out = run_loop(model, [make_item("a.wav", 3), make_item("b.wav", 2), make_item("c.wav", 4)], batch_size=4)
+
+    assert model.batch_sizes == [4, 4, 1]
+    results = {wav_file: blocks_to_frame([block]) for wav_file, block in out}
+    assert set(results) == {"a.wav", "b.wav", "c.wav"}
+    assert [len(results[f]) for f in ["a.wav", "b.wav", "c.wav"]] == [3, 2, 4]
+    assert (results["b.wav"]["filepath"] == "b.wav").all()
+    assert results["c.wav"]["start_time_ms"].tolist() == [0, 1000, 2000, 3000]
+
+""" Empty recordings get an empty result without reaching the model """
+def test_inference_loop_empty_recording():
+    model = BatchModel()
+    out = run_loop(model, [("empty.wav", [], [], [], [])], batch_size=4)
+
+    assert [(wav_file, header["filepath"], len(detections)) for wav_file, (header, detections) in out] == [("empty.wav", "empty.wav", 0)]
+    assert model.batch_sizes == []
+
+""" A smaller batch is predicted when no new images arrive before the deadline """
+def test_inference_loop_predicts_partial_batch_after_deadline():
+    model = BatchModel()
+    image_queue, result_queue = queue.Queue(), queue.Queue()
+    t = threading.Thread(target=pipeline.inference_loop, args=(model, image_queue, result_queue), kwargs={"batch_size": 64, "max_wait": 0.05})
+    t.start()
+    image_queue.put(make_item("a.wav", 2))
+
+    wav_file, (_, detections) = result_queue.get(timeout=5) # arrives before the loop is stopped
+    image_queue.put(None)
+    t.join()
+
+    assert wav_file == "a.wav"
+    assert len(detections) == 2
+    assert model.batch_sizes == [2]
+
+""" Render worker puts an empty item on the queue for unreadable recordings """
+def test_render_to_queue_unreadable_file(monkeypatch):
+    monkeypatch.setattr(pipeline, "recording_to_images", lambda wav_file, **kwargs: None)
+    q = queue.Queue()
+    pipeline.init_render_worker(q)
+
+    assert pipeline.render_to_queue("bad.wav") == "bad.wav"
+    assert q.get_nowait() == ("bad.wav", [], [], [], [])
+
+""" Results are yielded per file, and errors in render workers are raised instead of waiting forever """
+def test_predict_files_yields_results_and_raises_render_errors(monkeypatch):
+    result_queue = queue.Queue()
+    alive = [SimpleNamespace(is_alive=lambda: True)]
+
+    def fake_render(wav_file, **kwargs):
+        result_queue.put((wav_file, [{"filepath": wav_file}]))
+        return wav_file
+    monkeypatch.setattr(pipeline, "render_to_queue", fake_render)
+
+    out = dict(pipeline.predict_files(SyncExecutor(), ["a.wav", "b.wav"], result_queue, alive))
+    assert set(out) == {"a.wav", "b.wav"}
+
+    def failing_render(wav_file, **kwargs):
+        raise OSError("disk gone")
+    monkeypatch.setattr(pipeline, "render_to_queue", failing_render)
+
+    with pytest.raises(OSError):
+        list(pipeline.predict_files(SyncExecutor(), ["a.wav"], result_queue, alive))
+
+""" Helper: recording_to_images that renders n images (filled with their number) into the buffers it gets """
+def fake_recording_to_images(n):
+    def fake(wav_file, buffers=None, **kwargs):
+        out = buffers(n) if buffers is not None else None
+        images = []
+        for i in range(n):
+            image = out[i] if out is not None else np.empty((4, 4, 3), dtype=np.uint8)
+            image[...] = i
+            images.append(image[..., ::-1])
+        return images, [f"IMG_x_{i:05d}_{i*1000}_{i*1000+1000}.png" for i in range(n)], [i * 1000 for i in range(n)]
+    return fake
+
+""" Images rendered in shared memory slots are sent as slot numbers, read as views by the inference loop and released after predicting """
+def test_image_slots_roundtrip(monkeypatch):
+    shm, slots = pipeline.create_image_slots(4, (4, 4, 3))
+    try:
+        monkeypatch.setattr(pipeline, "_image_slots", None)
+        monkeypatch.setattr(pipeline, "recording_to_images", fake_recording_to_images(3))
+        image_queue, result_queue = queue.Queue(), queue.Queue()
+        pipeline.init_render_worker(image_queue, slots)
+
+        pipeline.render_to_queue("a.wav")
+        wav_file, img_array, filenames, offsets, taken = image_queue.get_nowait()
+        assert (wav_file, img_array, len(filenames), offsets, len(taken)) == ("a.wav", [], 3, [0, 1000, 2000], 3)
+
+        seen = []
+        model = BatchModel()
+        model.predict = lambda *, source, **kwargs: [seen.append(int(img[0, 0, 0])) or SimpleNamespace(boxes=[], orig_shape=(4, 4), names={}) for img in source]
+        image_queue.put((wav_file, img_array, filenames, offsets, taken))
+        image_queue.put(None)
+        pipeline.inference_loop(model, image_queue, result_queue, batch_size=2)
+
+        assert seen == [0, 1, 2] # images of the slots, in order
+        wav_file, (_, detections) = result_queue.get_nowait()
+        assert (wav_file, len(detections)) == ("a.wav", 0)
+        assert sorted(slots["free"].get(timeout=1) for _ in range(4)) == [0, 1, 2, 3] # all slots released
+    finally:
+        pipeline._image_slots[1].close()
+        shm.close()
+        shm.unlink()
+
+""" Recordings with more images than there are slots are sent as copies """
+def test_image_slots_too_many_images(monkeypatch):
+    shm, slots = pipeline.create_image_slots(2, (4, 4, 3))
+    try:
+        monkeypatch.setattr(pipeline, "_image_slots", None)
+        monkeypatch.setattr(pipeline, "recording_to_images", fake_recording_to_images(3))
+        image_queue = queue.Queue()
+        pipeline.init_render_worker(image_queue, slots)
+
+        pipeline.render_to_queue("long.wav")
+        wav_file, img_array, filenames, offsets, taken = image_queue.get_nowait()
+
+        assert taken == []
+        assert [int(img[0, 0, 0]) for img in img_array] == [0, 1, 2]
+    finally:
+        pipeline._image_slots[1].close()
+        shm.close()
+        shm.unlink()
+
+""" Slots of a recording that isn't queued (cancelled or an error while rendering) are released, so other render workers don't wait for them forever """
+def test_image_slots_released_when_not_queued(monkeypatch):
+    shm, slots = pipeline.create_image_slots(4, (4, 4, 3))
+    try:
+        monkeypatch.setattr(pipeline, "_image_slots", None)
+        cancel_event = threading.Event()
+        cancel_event.set()
+        monkeypatch.setattr(pipeline, "recording_to_images", fake_recording_to_images(3))
+        image_queue = queue.Queue()
+        pipeline.init_render_worker(image_queue, slots)
+
+        assert pipeline.render_to_queue("a.wav", cancel_event=cancel_event) == "a.wav"
+        assert image_queue.empty()
+
+        def failing(wav_file, buffers=None, **kwargs):
+            buffers(3)
+            raise MemoryError
+        monkeypatch.setattr(pipeline, "recording_to_images", failing)
+        with pytest.raises(MemoryError):
+            pipeline.render_to_queue("b.wav")
+
+        assert image_queue.empty()
+        assert sorted(slots["free"].get(timeout=1) for _ in range(4)) == [0, 1, 2, 3] # all slots released
+    finally:
+        pipeline._image_slots[1].close()
+        shm.close()
+        shm.unlink()
+
+""" After an error the inference processes are terminated instead of waiting for them, and the shared memory of the image slots is freed """
+def test_stop_inference_without_wait():
+    import multiprocessing as mp
+    import time
+    from multiprocessing import shared_memory
+    shm, _ = pipeline.create_image_slots(1, (4, 4, 3))
+    process = mp.get_context("spawn").Process(target=time.sleep, args=(60,), daemon=True) # Never reads the image queue
+
+    process.start()
+    pipeline.stop_inference(mp.Queue(), [process], shm, wait=False)
+
+    assert not process.is_alive()
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=shm.name)
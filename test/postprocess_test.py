@@ -75,3 +75,64 @@ def test_overlap_tidy_coerces_non_numeric_confidence_and_handles_missing():
     # the 'not_a_number' coerces to NaN and should not be chosen over the numeric 0.3
     assert len(out) == 1
     assert np.isclose(float(out.iloc[0]['confidence']), 0.3)
+
+""" Reference: overlap_tidy per file and category, using assign_groups and merge_via_graph """
+def reference_overlap_tidy(df, threshold=5):
+    df = df.copy()
+    num_cols = ['start_time_ms', 'end_time_ms', 'confidence']
+    df[num_cols] = df[num_cols].apply(pd.to_numeric, errors='coerce')
+    df = df[df['category'] != "Other"]
+
+    df_out = []
+    for (fname, cat), g in df.groupby(['filename', 'category'], group_keys=False):
+        df_out.append(merge_via_graph(assign_groups(g, threshold)))
+    df = pd.concat(df_out, ignore_index=True)
+
+    df_out = []
+    for (fname, cat, group_nr), g in df.groupby(['filename', 'category', 'group_nr'], group_keys=False):
+        df_out.append(g.nlargest(1, 'confidence'))
+    df_out = pd.concat(df_out, ignore_index=True)
+
+    return df_out.drop(columns=['start_group', 'end_group', 'group_nr'])
+
+def random_detections(rng, n):
+    start = rng.integers(0, 200, n) * rng.choice([1, 3, 7])
+    df = pd.DataFrame({
+        'filename': rng.choice(['b.wav', 'a.wav', 'c.wav'], n),
+        'filepath': 'dir',
+        'category': rng.choice(['Feeding buzz', 'Social call', 'Other'], n),
+        'confidence': rng.choice([0.1, 0.25, 0.5, 0.9], n) if rng.random() < 0.5 else rng.random(n).round(3), # many equal confidences
+        'start_time_ms': start,
+        'end_time_ms': start + rng.integers(5, 60, n),
+        'freq_min': rng.integers(10, 60, n).astype(str),
+        'freq_max': rng.integers(60, 120, n).astype(str),
+    })
+    if rng.random() < 0.5: # strings, missing and invalid values like in the output files
+        df = df.astype({'confidence': object, 'start_time_ms': object})
+        df.loc[rng.random(n) < 0.05, 'confidence'] = 'nan'
+        df.loc[rng.random(n) < 0.05, 'start_time_ms'] = None
+        df.loc[rng.random(n) < 0.2, 'confidence'] = df['confidence'].astype(str)
+    return df.sample(frac=1, random_state=int(rng.integers(1000))).reset_index(drop=True)
+
+""" Vectorised overlap_tidy gives exactly the same rows, in the same order, as the per group reference """
+@pytest.mark.parametrize("seed", range(40))
+def test_overlap_tidy_matches_reference(seed):
+    rng = np.random.default_rng(seed)
+    df = random_detections(rng, int(rng.integers(1, 400)))
+    if (df['category'] == 'Other').all(): df.loc[0, 'category'] = 'Social call'
+    threshold = int(rng.choice([0, 5, 20]))
+
+    pd.testing.assert_frame_equal(overlap_tidy(df, threshold=threshold), reference_overlap_tidy(df, threshold=threshold))
+
+""" Groups where all confidences are missing keep their first call, like nlargest does """
+def test_overlap_tidy_keeps_groups_without_confidence():
+    df = pd.DataFrame([
+        {'filename': 'f1', 'category': 'Feeding buzz', 'start_time_ms': 0, 'end_time_ms': 10, 'confidence': 'x'},
+        {'filename': 'f1', 'category': 'Feeding buzz', 'start_time_ms': 2, 'end_time_ms': 12, 'confidence': 'y'},
+        {'filename': 'f1', 'category': 'Feeding buzz', 'start_time_ms': 500, 'end_time_ms': 510, 'confidence': 0.4},
+    ])
+
+    out = overlap_tidy(df, threshold=5)
+
+    pd.testing.assert_frame_equal(out, reference_overlap_tidy(df, threshold=5))
+    assert list(out['start_time_ms']) == [0, 500]
@@ -1,19 +1,23 @@
 
 import os
 import numpy as np
+import pandas as pd
 import threading
 import pytest
 from types import SimpleNamespace
-from source.predict import predict_sono, recording_to_predict
+from source.predict import COLUMNS, DETECTION_DTYPE, predict_sono, results_to_rows, results_to_block, blocks_to_frame, recording_to_predict, recording_to_images, predict_images, model_input_layout, iter_segments, segment_count
 from source import visualise as vis
 from source.misc import read_clean_wav
+from scipy.io.wavfile import write
 
 """ Helpers that mimic the YOLO-like objects  """
-class DummyBox:
-    def __init__(self, xyxy, cls=0, conf=0.85):
-        self.xyxy = np.array([xyxy], dtype=float)
-        self.cls = np.array([cls])
-        self.conf = np.array([conf])
+class DummyBoxes:
+    def __init__(self, xyxy, cls=0, conf=0.85): # A single box, or lists of boxes
+        self.xyxy = np.array(xyxy, dtype=np.float32).reshape(-1, 4)
+        self.cls = np.array(cls, dtype=np.float32).reshape(-1)
+        self.conf = np.array(conf, dtype=np.float32).reshape(-1)
+    def __len__(self):
+        return len(self.xyxy)
 
 class DummyResult:
     def __init__(self, boxes, orig_shape=(300, 200), names=None): # orig_shape is (height, width)
@@ -34,27 +38,27 @@ class DummyModel:
 def test_predict_sono_basic_calculation():
     # Prepare a single box with coordinates and a result that maps to a class name
     # orig_shape: height=300, width=200
-    box = DummyBox(xyxy=[10, 20, 110, 220], cls=0, conf=0.85)
-    result = DummyResult(boxes=[box], orig_shape=(300, 200), names={0: "buzz"})
+    box = DummyBoxes(xyxy=[10, 20, 110, 220], cls=0, conf=0.85)
+    result = DummyResult(boxes=box, orig_shape=(300, 200), names={0: "buzz"})
     model = DummyModel(results=[result])
 
     filenames = ["rec_1000_2000.png"]               # filename stem split[-2] -> "1000"
     wav_path = "/path/to/audio.wav"
     csv_data = predict_sono(model=model, img_array=[np.zeros((10,10,3))], filenames=filenames, wav_path=wav_path, save=False)
 
-    assert isinstance(csv_data, list) and len(csv_data) == 1
-    row = csv_data[0]
+    assert list(csv_data.columns) == list(COLUMNS) and len(csv_data) == 1
+    row = csv_data.iloc[0]
 
     # expected calculations:
     # width=200 -> start_time = (10/200)*1000 + 1000 = 50 + 1000 = 1050
     # end_time   = (110/200)*1000 + 1000 = 550 + 1000 = 1550
-    assert row["start_time_ms"] == "1050"
-    assert row["end_time_ms"] == "1550"
+    assert row["start_time_ms"] == 1050
+    assert row["end_time_ms"] == 1550
     # frequencies:
     # y_min_corrected = height - y_max = 300 - 220 = 80 -> 80*(120/300)=32
     # y_max_corrected = 300 - 20 = 280 -> 280*(120/300)=112
-    assert row["freq_min"] == "32"
-    assert row["freq_max"] == "112"
+    assert row["freq_min"] == 32
+    assert row["freq_max"] == 112
     assert row["category"] == "buzz"
     assert abs(row["confidence"] - 0.85) < 1e-6
     assert row["filename"] == os.path.basename(wav_path)
@@ -64,7 +68,7 @@ def test_predict_sono_basic_calculation():
 def test_predict_sono_no_boxes_returns_empty():
     model = DummyModel(results=[])  # no results
     out = predict_sono(model=model, img_array=[], filenames=[], wav_path="x.wav", save=False)
-    assert out == []
+    assert out.empty and list(out.columns) == list(COLUMNS)
 
 """ Test empty array """
 def test_predict_sono_save_with_default_dir_raises():
@@ -82,26 +86,27 @@ def test_recording_to_predict_reads_and_calls_predict(monkeypatch):
     monkeypatch.setattr("source.predict.read_clean_wav", fake_read)
 
     # fake viz_audio_segment to return image arrays and filename strings
-    def fake_viz(segment_data, fs, folder_struc, filename_original, segment_duration, segment_number, time_img, colour_scale, write_plot, magn_weight, draw_freq_lines):
+    def fake_viz(segment_data, fs, folder_struc, filename_original, segment_duration, segment_number, time_img, colour_scale, write_plot, magn_weight, draw_freq_lines, spectrogram_data=None, renderer="lut", layout=None, out=None):
         # return a dummy image array and filename consistent with predict logic
         fname = f"{filename_original}_{time_img[0]}_{time_img[1]}.png"  # stem split[-2] should be the start time
         return np.zeros((10,10,3)), fname
     monkeypatch.setattr("source.visualise.viz_audio_segment", fake_viz)
 
     # Prepare model that returns a trivial result for each segment
-    box = DummyBox(xyxy=[0, 0, 10, 20], cls=0, conf=0.9)
-    result = DummyResult(boxes=[box], orig_shape=(100, 100), names={0: "buzz"})
+    box = DummyBoxes(xyxy=[0, 0, 10, 20], cls=0, conf=0.9)
+    result = DummyResult(boxes=box, orig_shape=(100, 100), names={0: "buzz"})
     # model will be used by recording_to_predict -> predict_sono, which will call model.predict once
     model = DummyModel(results=[result])
 
     out = recording_to_predict(wav_file="/some/file.wav", model=model, output_size=1, overlap=0, write_plot=False)
-    # it should return a list with entries corresponding to found boxes (one per segment)
-    assert isinstance(out, list)
-    assert len(out) >= 1
+    # it should return a block with detections corresponding to found boxes (one per segment)
+    header, detections = out
+    assert header["filepath"] == "/some/file.wav"
+    assert detections.dtype == DETECTION_DTYPE and len(detections) >= 1
     # basic sanity on the first row
-    first = out[0]
-    assert first["category"] == "buzz"
-    assert float(first["confidence"]) == 0.9
+    first = detections[0]
+    assert header["names"][first["category"]] == "buzz"
+    assert first["confidence"] == pytest.approx(0.9)
 
 """ Test cancel event in recording_to_predict when using app """
 def test_recording_to_predict_cancel_event(monkeypatch):
@@ -114,4 +119,185 @@ def test_recording_to_predict_cancel_event(monkeypatch):
     ev = threading.Event()
     ev.set()  # already cancelled
     out = recording_to_predict(wav_file="a.wav", model=model, cancel_event=ev)
-    assert out == []  # cancelled immediately
+    assert len(out[1]) == 0  # cancelled immediately
+
+""" Images of the shared whole-recording spectrogram match images of spectrograms computed per segment """
+@pytest.mark.parametrize("fs, overlap", [(192000, 0.5), (250000, 0.3)]) # segment hop is a multiple of the frame hop or is rounded to one
+def test_recording_to_images_shared_stft_matches_per_segment(monkeypatch, fs, overlap):
+    rng = np.random.default_rng(1)
+    t = np.arange(int(fs * 2.6)) / fs
+    audio = 0.05 * rng.standard_normal(t.size) + np.sin(2 * np.pi * (30000 + 20000 * t) * t) * (np.sin(2 * np.pi * 7 * t) > 0)
+    monkeypatch.setattr("source.predict.read_clean_wav", lambda wav_file: (fs, audio / np.max(np.abs(audio))))
+
+    shared, names_shared, _ = recording_to_images("/some/file.wav", output_size=1, overlap=overlap, shared_stft=True)
+    _, names_exact, _ = recording_to_images("/some/file.wav", output_size=1, overlap=overlap)
+
+    # Per segment spectrograms at the (rounded) segment starts used by shared_stft
+    monkeypatch.setattr(vis, "segment_spectrogram_data", lambda *args, **kwargs: None)
+    per_segment, names, _ = recording_to_images("/some/file.wav", output_size=1, overlap=overlap, shared_stft=True)
+
+    assert names == names_shared
+    assert len(per_segment) == len(shared)
+    for a, b in zip(per_segment, shared):
+        assert a.shape == b.shape
+        assert np.max(np.abs(a.astype(int) - b.astype(int))) <= 1 # only floating point differences
+
+    # Segment start times (ms) stay within 1 ms of the exact overlap
+    starts = lambda names: [int(n.split("_")[-2]) for n in names]
+    assert len(names_shared) == len(names_exact)
+    assert max(abs(a - b) for a, b in zip(starts(names_shared), starts(names_exact))) <= 1
+
+""" Rounding the segment starts of shared_stft to frames doesn't add up over a long recording: every start stays within half a frame hop of the exact overlap """
+def test_shared_stft_segment_starts_long_recording(monkeypatch):
+    fs, overlap = 250000, 0.3
+    total_samples = fs * 300
+    advance = fs - round(overlap * fs) # not a multiple of the frame hop
+    chunks = (np.zeros(min(fs * 10, total_samples - i), dtype=np.float32) for i in range(0, total_samples, fs * 10))
+
+    starts = [start for start, _, _ in iter_segments(chunks, total_samples, fs, advance, step=vis.FRAME_HOP)]
+
+    assert len(starts) == segment_count(total_samples, fs, advance, step=vis.FRAME_HOP) == segment_count(total_samples, fs, advance)
+    assert all(start % vis.FRAME_HOP == 0 for start in starts)
+    assert max(abs(start - k * advance) for k, start in enumerate(starts)) <= vis.FRAME_HOP / 2
+
+    # Start times of the images (ms) with shared_stft
+    monkeypatch.setattr("source.predict.read_clean_wav", lambda wav_file: (fs, np.zeros(total_samples, dtype=np.float32)))
+    monkeypatch.setattr(vis, "recording_spectrogram_data", lambda audio, fs: None)
+    monkeypatch.setattr(vis, "viz_audio_segment", lambda time_img, **kwargs: (None, f"IMG_{time_img[0]}_{time_img[1]}.png"))
+    _, _, offsets = recording_to_images("/some/file.wav", output_size=1, overlap=overlap, shared_stft=True)
+
+    assert len(offsets) == len(starts)
+    assert max(abs(offset - k * advance / fs * 1000) for k, offset in enumerate(offsets)) < 1 + vis.FRAME_HOP / 2 / fs * 1000 # truncated to whole ms
+
+""" Model input images predicted as one tensor give the same boxes as model.predict() on the spectrogram images """
+def test_predict_images_tensor_input_matches_model_predict(monkeypatch, yolo_stub):
+    model = yolo_stub
+    model.overrides["imgsz"] = 1280 # No resizing, only padding (416 x 1280)
+
+    fs = 250000
+    audio = np.random.default_rng(2).standard_normal(fs)
+    monkeypatch.setattr("source.predict.read_clean_wav", lambda wav_file: (fs, audio)) # One image, model.predict() predicts one at a time too
+
+    images, names, _ = recording_to_images("/some/file.wav", output_size=1, overlap=0)
+    inputs, names_tensor, _ = recording_to_images("/some/file.wav", output_size=1, overlap=0, layout=model_input_layout(model))
+
+    expected = predict_images(model, images)
+    results = predict_images(model, inputs, tensor_input=True)
+
+    assert names == names_tensor
+    assert inputs[0].shape == (416, 1280, 3)
+    assert len(results) == len(expected)
+    for a, b in zip(expected, results):
+        assert b.orig_shape == a.orig_shape
+        assert len(b.boxes) == len(a.boxes) > 0
+        assert np.allclose(b.boxes.xyxy.numpy(), a.boxes.xyxy.numpy(), atol=1e-3)
+        assert np.array_equal(b.boxes.cls.numpy(), a.boxes.cls.numpy())
+
+""" In bf16 the network runs in bfloat16 and the boxes are float32 on the spectrogram image, for model input images and spectrogram images """
+@pytest.mark.parametrize("tensor_input", [True, False])
+def test_predict_images_bf16(monkeypatch, tensor_input, yolo_stub):
+    torch = pytest.importorskip("torch")
+    model = yolo_stub
+
+    dtypes = []
+    model.model.model[-1].register_forward_hook(lambda module, inputs, output: dtypes.append(inputs[0][0].dtype))
+    shape = model_input_layout(model)["shape"] if tensor_input else vis.IMG_SIZE[::-1]
+    images = list(np.random.default_rng(4).integers(0, 256, (2,) + shape + (3,), dtype=np.uint8))
+
+    results = predict_images(model, images, tensor_input=tensor_input, precision="bf16")
+
+    assert dtypes == [torch.bfloat16]
+    assert len(results) == 2
+    for result in results:
+        assert len(result.boxes) > 0 and result.boxes.xyxy.dtype == torch.float32
+        assert (result.boxes.xyxy[:, [0, 2]] <= vis.IMG_SIZE[0]).all() and (result.boxes.xyxy[:, [1, 3]] <= vis.IMG_SIZE[1]).all()
+
+""" Segments cut from chunks of any size are the same as slices of the whole recording """
+@pytest.mark.parametrize("chunk_size", [1000, 4096, 25000, 100000])
+def test_iter_segments_matches_slices(chunk_size):
+    audio = np.arange(23456, dtype=np.float32)
+    chunks = iter([audio[i:i + chunk_size] for i in range(0, len(audio), chunk_size)])
+
+    segments = list(iter_segments(chunks, len(audio), segment_samples=5000, advance_samples=3500))
+
+    assert [start for start, _, _ in segments] == list(range(0, 23456 - 1500, 3500))
+    assert len(segments) == segment_count(len(audio), 5000, 3500)
+    for start, end, data in segments:
+        assert end == min(start + 5000, len(audio))
+        assert np.array_equal(data, audio[start:end])
+
+""" Streaming a recording from disk gives the same images as reading it whole """
+def test_recording_to_images_stream_matches_whole_recording(tmp_path):
+    fs = 250000
+    t = np.arange(int(fs * 2.3)) / fs
+    sig = 0.1 * np.random.default_rng(3).standard_normal(t.size) + 0.5 * np.sin(2 * np.pi * 40000 * t) * (np.sin(2 * np.pi * 3 * t) > 0)
+    wav = tmp_path / "rec.wav"
+    write(wav, fs, (sig * 10000).astype(np.int16))
+
+    images, names, _ = recording_to_images(str(wav), output_size=1, overlap=0.3)
+    streamed, names_streamed, _ = recording_to_images(str(wav), output_size=1, overlap=0.3, stream=True)
+
+    assert names_streamed == names
+    assert all(np.array_equal(a, b) for a, b in zip(images, streamed))
+
+""" Number of segments is known before rendering, for recordings shorter than, equal to and longer than a segment """
+@pytest.mark.parametrize("total_samples", [1, 4999, 5000, 5001, 8500, 8501, 23456])
+@pytest.mark.parametrize("advance_samples, step", [(3500, 1), (3500, 256), (3300, 256)])
+def test_segment_count(total_samples, advance_samples, step):
+    segments = list(iter_segments(iter([np.zeros(total_samples, dtype=np.float32)]), total_samples, 5000, advance_samples, step))
+    assert segment_count(total_samples, 5000, advance_samples, step) == len(segments)
+
+""" Helper: the original conversion of results to rows, one box at a time with the times and frequencies formatted as text """
+def reference_rows(results, filenames, wav_path):
+    rows = []
+    for idx, result in enumerate(results):
+        for box in range(len(result.boxes)):
+            x_min, y_min, x_max, y_max = result.boxes.xyxy[box].tolist()
+            height, width = result.orig_shape[:2]
+            start_file = int(os.path.splitext(filenames[idx])[0].split("_")[-2])
+            rows.append({"filename": os.path.basename(wav_path), "filepath": wav_path,
+                         "category": result.names[int(result.boxes.cls[box])], "confidence": float(result.boxes.conf[box]),
+                         "start_time_ms": f"{(x_min / width) * 1000 + start_file :.0f}", "end_time_ms": f"{(x_max / width) * 1000 + start_file :.0f}",
+                         "freq_min": f"{(height - y_max) * (120 / height) :.0f}", "freq_max": f"{(height - y_min) * (120 / height) :.0f}"})
+    return rows
+
+""" Boxes of many results converted at once give the same rows as the original conversion, with the offsets given or read from the filenames """
+@pytest.mark.parametrize("seed", range(5))
+def test_results_to_rows_matches_reference(seed):
+    rng = np.random.default_rng(seed)
+    results, filenames, offsets = [], [], []
+    for i in range(20):
+        n = rng.integers(0, 30)
+        x, y = np.sort(rng.uniform(0, 1280, (n, 2)), axis=1), np.sort(rng.uniform(0, 400, (n, 2)), axis=1)
+        xyxy = np.column_stack((x[:, 0], y[:, 0], x[:, 1], y[:, 1]))
+        xyxy[: n // 4] = np.round(xyxy[: n // 4] * 64) / 64 # boxes at exactly .5 ms or kHz, rounded to even
+        results.append(DummyResult(DummyBoxes(xyxy, rng.integers(0, 3, n), rng.uniform(0.1, 1, n)), orig_shape=(400, 1280), names={0: "buzz", 1: "social", 2: "Other"}))
+        offsets.append(i * 700)
+        filenames.append(f"rec_{i + 1:05d}_{i * 700}_{i * 700 + 1000}.png")
+
+    expected = reference_rows(results, filenames, "/path/to/rec.wav")
+    for rows in [results_to_rows(results, filenames, "/path/to/rec.wav"), results_to_rows(results, filenames, "/path/to/rec.wav", offsets=offsets)]:
+        assert len(rows) == len(expected)
+        assert (rows.dtypes[["start_time_ms", "end_time_ms", "freq_min", "freq_max"]] == np.int64).all()
+        text = rows.astype({c: str for c in ["start_time_ms", "end_time_ms", "freq_min", "freq_max"]}).astype(object)
+        assert text.to_dict("records") == expected
+
+""" Blocks of several recordings (with different category names) are combined in one table, the same as the tables of the blocks on their own """
+def test_blocks_to_frame_matches_rows_per_block():
+    rng = np.random.default_rng(0)
+    blocks, expected = [], []
+    for i, names in enumerate([{0: "buzz", 1: "social"}, {0: "social", 1: "Other", 2: "buzz"}, {0: "buzz"}, {0: "buzz", 1: "social"}]):
+        n = 0 if i == 2 else 10
+        results = [DummyResult(DummyBoxes(np.sort(rng.uniform(0, 100, (n, 4)), axis=1), rng.integers(0, len(names), n), rng.uniform(0.1, 1, n)), orig_shape=(100, 100), names=names)]
+        wav_path = f"/data/{'bcad'[i]}.wav"
+        blocks.append(results_to_block(results, ["x_00001_0_1000.png"], wav_path))
+        expected.append(results_to_rows(results, ["x_00001_0_1000.png"], wav_path))
+
+    df = blocks_to_frame(blocks)
+
+    assert list(df.columns) == list(COLUMNS)
+    assert list(df["filename"].cat.categories) == ["b.wav", "c.wav", "d.wav"] # sorted, without a.wav (no detections)
+    assert list(df["category"].cat.categories) == ["Other", "buzz", "social"]
+    as_objects = lambda df: df.astype({"filename": object, "filepath": object, "category": object})
+    assert as_objects(df).equals(as_objects(pd.concat(expected, ignore_index=True)))
+    assert blocks_to_frame([blocks[2]]).empty
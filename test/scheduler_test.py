@@ -0,0 +1,67 @@
+import os
+import time
+import psutil
+import pytest
+import torch
+import cv2
+import source.scheduler as scheduler
+
+""" The CPUs are divided over the processes, at least one thread per process """
+def test_thread_budget():
+    cpus = list(range(16))
+    assert scheduler.thread_budget(8, cpus) == 2
+    assert scheduler.thread_budget(3, cpus) == 5
+    assert scheduler.thread_budget(32, cpus) == 1
+    assert scheduler.thread_budget(1) == len(scheduler.available_cpus())
+
+""" Every process gets its own consecutive CPUs, starting again at the first CPU when there are too few """
+def test_core_sets():
+    sets = scheduler.core_sets(3, 2, cpus=[0, 1, 2, 3, 4, 5, 6, 7])
+    assert [sets.get(timeout=5) for _ in range(3)] == [[0, 1], [2, 3], [4, 5]]
+
+    sets = scheduler.core_sets(3, 2, cpus=[4, 5, 6, 7])
+    assert [sets.get(timeout=5) for _ in range(3)] == [[4, 5], [6, 7], [4, 5]]
+
+""" A worker limits the threads of torch and the thread variables, and pins itself to the CPUs it takes """
+def test_setup_worker(monkeypatch):
+    for variable in scheduler.THREAD_VARIABLES:
+        monkeypatch.setenv(variable, "64")
+    threads, cv2_threads, affinity = torch.get_num_threads(), cv2.getNumThreads(), scheduler.available_cpus()
+    pinned = []
+    monkeypatch.setattr(psutil.Process, "cpu_affinity", lambda self, cpus=None: pinned.append(cpus) if cpus is not None else affinity)
+
+    try:
+        cores = scheduler.core_sets(1, 1, cpus=affinity[-1:])
+        time.sleep(0.1) # Queue feeder thread
+        scheduler.setup_worker(1, cores)
+
+        assert torch.get_num_threads() == 1
+        assert all(os.environ[variable] == "1" for variable in scheduler.THREAD_VARIABLES)
+        assert pinned == [affinity[-1:]]
+
+        scheduler.setup_worker(None, cores) # No CPUs left: not pinned, threads unchanged
+        assert pinned == [affinity[-1:]]
+    finally:
+        torch.set_num_threads(threads)
+        cv2.setNumThreads(cv2_threads)
+
+""" autotune tries 1, 2, 4, ... processes with the CPUs divided over them """
+def test_autotune_candidates():
+    assert scheduler.autotune_candidates(list(range(16))) == [(1, 16), (2, 8), (4, 4), (8, 2), (16, 1)]
+    assert scheduler.autotune_candidates(list(range(12)), max_proc=6) == [(1, 12), (2, 6), (4, 3), (6, 2)]
+
+""" Helpers for autotune: recordings take longer with more threads """
+def init_sleepy(threads, cores):
+    os.environ["SLEEP_THREADS"] = str(threads)
+
+def analyse_sleepy(wav_file):
+    time.sleep(0.02 * int(os.environ["SLEEP_THREADS"]))
+    return wav_file
+
+""" autotune sets up the workers of every combination and returns the one that analyses the most recordings per second """
+def test_autotune_picks_fastest_combination():
+    best, throughput = scheduler.autotune(["a.wav", "b.wav"], analyse_sleepy, init_sleepy, candidates=[(1, 4), (2, 1)])
+
+    assert best == (2, 1)
+    assert set(throughput) == {(1, 4), (2, 1)}
+    assert throughput[(2, 1)] > throughput[(1, 4)]
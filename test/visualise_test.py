@@ -1,5 +1,6 @@
 import numpy as np
-from source.visualise import spectral_subtraction, create_spectrogram_data, viz_audio_segment, recording_to_visual
+from source.visualise import spectral_subtraction, create_spectrogram_data, viz_audio_segment, recording_to_visual, recording_spectrogram_data, segment_spectrogram_data, render_spectrogram, create_spectrogram_image_data, letterbox_layout, PAD_VALUE, image_shape
+import pytest
 import numpy as np
 from unittest.mock import patch
 
@@ -133,3 +134,190 @@ def test_freq_lines_draw_white_rows():
     assert np.any(img[:, :, 0] == 255)
 
 
+
+""" Segment cut from the spectrogram of the whole recording equals the spectrogram of only the segment when frames align """
+def test_segment_spectrogram_matches_create_spectrogram_data():
+    fs = 96000
+    x = np.random.randn(3 * fs)
+    start, end = 256 * 200, 256 * 200 + fs
+
+    f1, t1, S1 = create_spectrogram_data(x[start:end], fs, 0, 1.0)
+    f2, t2, S2 = segment_spectrogram_data(recording_spectrogram_data(x, fs), fs, start, end, 1.0)
+
+    assert np.allclose(f1, f2)
+    assert np.allclose(t1, t2)
+    assert S1.shape == S2.shape
+    assert np.allclose(S1, S2, rtol=1e-10, atol=1e-20)
+
+""" Segments that can't be cut from the whole recording are left to the per-segment computation """
+def test_segment_spectrogram_returns_none_for_short_segments():
+    fs = 48000
+    x = np.random.randn(fs)
+    rec = recording_spectrogram_data(x, fs)
+
+    assert segment_spectrogram_data(rec, fs, fs - 300, fs, 1.0) is None
+
+""" Lookup table renderer gives the same image as the matplotlib colormap + PIL resize path """
+@pytest.mark.parametrize("fs", [96000, 250000, 384000, 500000])
+@pytest.mark.parametrize("colour_scale", ["jet", "gray"])
+def test_lut_renderer_matches_pil_renderer(fs, colour_scale):
+    x = np.random.randn(fs)
+    kwargs = dict(segment_data=x, fs=fs, folder_struc=".", filename_original="f", segment_duration=1, segment_number=1,
+                  time_img=[0, 1000], colour_scale=colour_scale, write_plot=False, magn_weight=0, draw_freq_lines=True)
+
+    img_pil, name_pil = viz_audio_segment(**kwargs, renderer="pil")
+    img_lut, name_lut = viz_audio_segment(**kwargs, renderer="lut")
+
+    assert name_pil == name_lut
+    assert img_pil.shape == img_lut.shape
+    assert np.max(np.abs(img_pil.astype(int) - img_lut.astype(int))) <= 1 # identical apart from rare rounding of resampling weights
+    assert np.mean(img_pil != img_lut) < 1e-3
+
+""" Segments without any contrast (e.g. digital silence) get the same image as the PIL path """
+@pytest.mark.filterwarnings("ignore:invalid value encountered in divide")
+def test_lut_renderer_silent_segment():
+    kwargs = dict(segment_data=np.zeros(48000), fs=48000, folder_struc=".", filename_original="f", segment_duration=1, segment_number=1,
+                  time_img=[0, 1000], colour_scale="jet", write_plot=False, magn_weight=0, draw_freq_lines=True)
+
+    img_pil, _ = viz_audio_segment(**kwargs, renderer="pil")
+    img_lut, _ = viz_audio_segment(**kwargs, renderer="lut")
+
+    assert np.array_equal(img_pil, img_lut)
+
+""" A silent recording is normalised by 0 (NaN samples), and gets the colour of NaN with every renderer instead of failing """
+@pytest.mark.filterwarnings("ignore:invalid value encountered")
+@pytest.mark.parametrize("renderer", ["lut", "direct"])
+def test_renderers_silent_recording(renderer):
+    from source.misc import highpass_normalise
+    segment = highpass_normalise(np.zeros(48000, dtype=np.int16), 48000)
+    kwargs = dict(segment_data=segment, fs=48000, folder_struc=".", filename_original="f", segment_duration=1, segment_number=1,
+                  time_img=[0, 1000], colour_scale="jet", write_plot=False, magn_weight=0, draw_freq_lines=True)
+
+    img_pil, _ = viz_audio_segment(**kwargs, renderer="pil")
+    img, _ = viz_audio_segment(**kwargs, renderer=renderer)
+
+    assert np.isnan(segment).all()
+    assert np.array_equal(img_pil, img)
+
+""" Renderer writes into a given output buffer """
+def test_render_spectrogram_writes_into_out():
+    _, _, Sxx = create_spectrogram_data(np.random.randn(48000), 48000, 0, 1.0)
+    out = np.zeros((200, 640, 3), dtype=np.uint8)
+
+    img = render_spectrogram(Sxx, colour_scale="jet", draw_freq_lines=False, size=(640, 200), out=out)
+
+    assert img is out
+    assert out.any()
+
+""" Spectrogram at image resolution: a 40 kHz tone between 0.4 and 0.6 s ends up in the matching row and columns """
+@pytest.mark.parametrize("fs", [192000, 250000, 384000, 500000])
+def test_create_spectrogram_image_data_tone_position(fs):
+    t = np.arange(fs) / fs
+    audio = np.sin(2 * np.pi * 40000 * t) * ((t > 0.4) & (t < 0.6))
+
+    frequencies, times, Sxx = create_spectrogram_image_data(audio, fs, 0, 1.0)
+
+    assert Sxx.shape == (400, 1280)
+    assert len(frequencies) == 400 and len(times) == 1280
+    assert abs(np.argmax(Sxx[:, 640]) - 40000 / 300) <= 1 # rows are 300 Hz apart
+    active = np.where(Sxx[133] > Sxx[133].max() / 10)[0]
+    assert abs(active[0] - 512) <= 3 and abs(active[-1] - 768) <= 3
+
+""" Frequencies above the Nyquist frequency are empty and get the lowest colour """
+def test_direct_renderer_pads_above_nyquist():
+    fs = 96000
+    kwargs = dict(segment_data=np.random.default_rng(0).standard_normal(fs), fs=fs, folder_struc=".", filename_original="f", segment_duration=1, segment_number=1,
+                  time_img=[0, 1000], colour_scale="gray", write_plot=False, magn_weight=0, draw_freq_lines=False)
+
+    img, _ = viz_audio_segment(**kwargs, renderer="direct")
+
+    assert img.shape == (400, 1280) # gray images have a single channel
+    assert (img[:400 - 48000 // 300 - 1] == 0).all() # image is flipped, high frequencies at the top
+    assert img[400 - 48000 // 300:].any(axis=1).all()
+
+""" Helper: boxes (x, y, width, height) of the call regions (red in the jet colour scale) of an image, a stand-in for detections without a trained model """
+def call_regions(img):
+    import cv2
+    hot = ((img[:, :, 2] > 128) & (img[:, :, 0] < 128)).astype(np.uint8)
+    _, _, stats, _ = cv2.connectedComponentsWithStats(hot)
+    return sorted(tuple(int(v) for v in box[:4]) for box in stats[1:] if box[4] > 50)
+
+""" The direct renderer differs from the lut renderer pixel by pixel (background noise is rendered at another resolution, mean difference ~10/45/5 per B/G/R channel),
+    but the calls are at the same times and overlapping frequencies, with call bands up to 2.5 times as tall (wider in frequency) at high sample rates """
+@pytest.mark.parametrize("fs", [192000, 250000, 384000, 500000])
+def test_direct_renderer_close_to_lut(fs):
+    t = np.arange(fs) / fs
+    x = 0.05 * np.random.default_rng(0).standard_normal(fs) + np.sin(2 * np.pi * (30000 + 20000 * t) * t) * (np.sin(2 * np.pi * 7 * t) > 0) # 7 chirps in noise
+    kwargs = dict(segment_data=x / np.max(np.abs(x)), fs=fs, folder_struc=".", filename_original="f", segment_duration=1, segment_number=1,
+                  time_img=[0, 1000], colour_scale="jet", write_plot=False, magn_weight=0, draw_freq_lines=False)
+
+    img_lut, _ = viz_audio_segment(**kwargs, renderer="lut")
+    img_direct, _ = viz_audio_segment(**kwargs, renderer="direct")
+
+    difference = np.abs(img_lut.astype(int) - img_direct.astype(int)).mean(axis=(0, 1))
+    assert (difference < [16, 64, 12]).all()
+    assert abs(img_lut.mean() - img_direct.mean()) < 2
+
+    regions_lut, regions_direct = call_regions(img_lut), call_regions(img_direct)
+    assert len(regions_lut) == len(regions_direct) == 7
+    for (x_lut, y_lut, w_lut, h_lut), (x_direct, y_direct, w_direct, h_direct) in zip(regions_lut, regions_direct):
+        assert abs(x_lut - x_direct) <= 2 and abs(w_lut - w_direct) <= 2 # same times
+        assert y_direct <= y_lut + h_lut / 2 <= y_direct + h_direct and y_lut <= y_direct + h_direct / 2 <= y_lut + h_lut # overlapping frequencies
+        assert 0.7 <= h_direct / h_lut <= 3
+
+""" Layout of the model input is the same as the letterbox of ultralytics """
+@pytest.mark.parametrize("imgsz", [640, 1280, 1024, (416, 1280), 960])
+def test_letterbox_layout_matches_ultralytics(imgsz):
+    LetterBox = pytest.importorskip("ultralytics.data.augment").LetterBox
+    image = np.zeros((400, 1280, 3), dtype=np.uint8)
+    new_shape = (imgsz, imgsz) if isinstance(imgsz, int) else imgsz
+
+    letterboxed = LetterBox(new_shape, auto=True, stride=32)(image=image)
+    layout = letterbox_layout(imgsz, 32)
+
+    assert letterboxed.shape[:2] == layout["shape"]
+    # Image area is the only part that isn't padding
+    rows, cols = np.where(letterboxed[..., 0] != PAD_VALUE)
+    width, height = layout["size"]
+    assert (rows.min(), rows.max(), cols.min(), cols.max()) == (layout["top"], layout["top"] + height - 1, layout["left"], layout["left"] + width - 1)
+
+""" Rendering in the model input layout gives the padded RGB image, which is what ultralytics feeds to the model """
+@pytest.mark.parametrize("colour_scale", ["jet", "gray"])
+def test_viz_audio_segment_renders_model_input(colour_scale):
+    LetterBox = pytest.importorskip("ultralytics.data.augment").LetterBox
+    kwargs = dict(segment_data=np.random.randn(250000), fs=250000, folder_struc=".", filename_original="f", segment_duration=1, segment_number=1,
+                  time_img=[0, 1000], colour_scale=colour_scale, write_plot=False, magn_weight=0, draw_freq_lines=True)
+
+    image, name = viz_audio_segment(**kwargs)
+    model_input, name_input = viz_audio_segment(**kwargs, layout=letterbox_layout(1280, 32))
+
+    if colour_scale == "gray": image = np.repeat(image[:, ::-1, np.newaxis], 3, axis=2) # the BGR flip of viz_audio_segment mirrors 2D gray images, model input isn't mirrored
+    expected = LetterBox((1280, 1280), auto=True, stride=32)(image=np.ascontiguousarray(image))[..., ::-1] # ultralytics converts BGR to RGB
+
+    assert name_input == name
+    assert np.array_equal(model_input, expected)
+
+    # Smaller model input: the image is rendered at the smaller size within the padding
+    layout = letterbox_layout(640, 32)
+    model_input, _ = viz_audio_segment(**kwargs, layout=layout)
+    assert model_input.shape == (224, 640, 3)
+    assert (model_input[:layout["top"]] == PAD_VALUE).all() and (model_input[layout["top"] + 200:] == PAD_VALUE).all()
+
+""" The PIL renderer can't render the model input """
+def test_viz_audio_segment_layout_needs_lut_renderer():
+    with pytest.raises(ValueError):
+        viz_audio_segment(np.zeros(1000), 1000, ".", "f", 1, 1, [0, 1000], "jet", False, 0, True, renderer="pil", layout=letterbox_layout(640, 32))
+
+""" Images are rendered into a given array, which has the shape of image_shape() """
+@pytest.mark.parametrize("renderer, colour_scale, imgsz", [("lut", "jet", None), ("pil", "jet", None), ("lut", "gray", None), ("direct", "jet", 640)])
+def test_viz_audio_segment_renders_into_out(renderer, colour_scale, imgsz):
+    layout = letterbox_layout(imgsz, 32) if imgsz else None
+    kwargs = dict(segment_data=np.random.default_rng(0).standard_normal(96000), fs=96000, folder_struc=".", filename_original="f", segment_duration=1, segment_number=1,
+                  time_img=[0, 1000], colour_scale=colour_scale, write_plot=False, magn_weight=0, draw_freq_lines=True, renderer=renderer, layout=layout)
+    out = np.zeros(image_shape(colour_scale, layout), dtype=np.uint8)
+
+    expected, _ = viz_audio_segment(**kwargs)
+    image, _ = viz_audio_segment(**kwargs, out=out)
+
+    assert np.shares_memory(image, out)
+    assert np.array_equal(image, expected)
@@ -0,0 +1,98 @@
+import source.workers as workers
+
+""" Helper YOLO object that counts how often a model is loaded """
+class CountingYOLO:
+    loaded = 0
+    def __init__(self, model_path):
+        CountingYOLO.loaded += 1
+        self.model_path = model_path
+
+""" Model is loaded once per process and model path """
+def test_get_model_loads_once_per_path(monkeypatch):
+    monkeypatch.setattr(workers, "YOLO", CountingYOLO)
+    monkeypatch.setattr(workers, "_models", {})
+    CountingYOLO.loaded = 0
+
+    m1 = workers.get_model("a.pt")
+    m2 = workers.get_model("a.pt")
+    m3 = workers.get_model("b.pt")
+
+    assert m1 is m2
+    assert m3 is not m1
+    assert CountingYOLO.loaded == 2
+
+""" Initialiser fills the registry, so tasks don't load the model again """
+def test_init_worker_preloads_model(monkeypatch):
+    monkeypatch.setattr(workers, "YOLO", CountingYOLO)
+    monkeypatch.setattr(workers, "_models", {})
+    CountingYOLO.loaded = 0
+
+    workers.init_worker("a.pt")
+    workers.get_model("a.pt")
+
+    assert CountingYOLO.loaded == 1
+
+""" Helper YOLO object with a small torch network """
+class TorchYOLO:
+    def __init__(self, model_path):
+        import torch
+        self.model = torch.nn.Sequential(torch.nn.Conv2d(3, 4, 3), torch.nn.BatchNorm2d(4))
+
+""" Weights of a shared model live in shared memory, so workers don't need their own copy """
+def test_load_shared_model_moves_weights_to_shared_memory(monkeypatch):
+    monkeypatch.setattr(workers, "YOLO", TorchYOLO)
+    monkeypatch.setattr(workers, "_models", {})
+
+    model = workers.load_shared_model("a.pt")
+
+    assert all(p.is_shared() for p in model.model.parameters())
+    assert not model.model.training
+    assert workers.get_model("a.pt") is model
+
+""" Initialiser registers the model of the main process instead of loading a new one """
+def test_init_worker_uses_given_model(monkeypatch):
+    monkeypatch.setattr(workers, "YOLO", CountingYOLO)
+    monkeypatch.setattr(workers, "_models", {})
+    CountingYOLO.loaded = 0
+    shared = object()
+
+    workers.init_worker("a.pt", shared)
+
+    assert workers.get_model("a.pt") is shared
+    assert CountingYOLO.loaded == 0
+
+""" Memory is reported for running child processes """
+def test_worker_memory_reports_child_processes():
+    import subprocess, sys
+    child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(5)"])
+    try:
+        memory = workers.worker_memory()
+    finally:
+        child.kill()
+        child.wait()
+
+    assert child.pid in memory
+    assert memory[child.pid] > 0
+
+""" Results are yielded as soon as they are done, with at most max_pending items submitted at once """
+def test_submit_as_completed_yields_done_items_first():
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    release = threading.Event()
+    running = []
+
+    def work(item):
+        running.append(item)
+        if item == "slow": release.wait(5)
+        return item.upper()
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        out = []
+        for item, result in workers.submit_as_completed(executor, work, ["slow", "a", "b", "c"], max_pending=2):
+            out.append((item, result))
+            if item == "c":
+                assert "slow" not in dict(out) # the other items don't wait for the slow one
+                release.set()
+
+    assert out == [("a", "A"), ("b", "B"), ("c", "C"), ("slow", "SLOW")]
+    assert running[:2] == ["slow", "a"] # b only starts when a is done
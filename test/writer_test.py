@@ -0,0 +1,123 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import source.writer as writer
+from source.predict import DETECTION_DTYPE, blocks_to_frame
+from source.postprocess import overlap_tidy
+
+""" Helper: block of detections (see predict.results_to_block) of a recording with n overlapping calls """
+def make_block(name, n, rng):
+    detections = np.zeros(n, dtype=DETECTION_DTYPE)
+    detections["category"] = rng.integers(0, 3, n)
+    detections["confidence"] = rng.uniform(0.1, 1, n)
+    detections["start_time_ms"] = rng.integers(0, 20, n) * 100 + rng.integers(0, 4, n)
+    detections["end_time_ms"] = detections["start_time_ms"] + 50
+    return {"filename": f"{name}.wav", "filepath": f"/data/{name}.wav", "names": ("buzz", "social", "Other")}, detections
+
+""" Detections written in chunks are the same as tidying all of them at once, and the output only gets its name when the writer is stopped """
+def test_writer_writes_chunks_of_tidied_detections(tmp_path):
+    rng = np.random.default_rng(0)
+    blocks = [make_block(f"rec_{i:03d}", 0 if i % 4 == 0 else 30, rng) for i in range(25)]
+    path = str(tmp_path / "output.csv")
+
+    output_writer = writer.start_writer(path, write_every=10)
+    for block in blocks:
+        output_writer["queue"].put(block)
+    writer.stop_writer(output_writer)
+
+    assert not (tmp_path / "output.csv.part").exists()
+    written = pd.read_csv(path)
+    expected = overlap_tidy(blocks_to_frame(blocks), threshold=5)
+    pd.testing.assert_frame_equal(written, expected, check_dtype=False, check_categorical=False)
+
+""" A chunk is on disk before the batch is done """
+def test_writer_appends_chunks_to_part_file(tmp_path):
+    rng = np.random.default_rng(1)
+    path = str(tmp_path / "output.csv")
+
+    output_writer = writer.start_writer(path, write_every=2)
+    for i in range(3):
+        output_writer["queue"].put(make_block(f"rec_{i}", 10, rng))
+
+    lines = []
+    for _ in range(500): # until the first chunk (2 recordings) is written
+        lines = open(path + ".part").read().splitlines() if os.path.exists(path + ".part") else []
+        if len(lines) > 1: break
+        output_writer["thread"].join(0.01)
+
+    files = {line.split(",")[0] for line in lines[1:]}
+    writer.stop_writer(output_writer)
+
+    assert files == {"rec_0.wav", "rec_1.wav"}
+    assert set(pd.read_csv(path)["filename"]) == {"rec_0.wav", "rec_1.wav", "rec_2.wav"}
+
+""" Without detections the output only has the header, and cancelled output is removed """
+def test_writer_empty_and_cancelled(tmp_path):
+    path = str(tmp_path / "output.csv")
+    output_writer = writer.start_writer(path)
+    output_writer["queue"].put(make_block("rec", 0, np.random.default_rng(2)))
+    writer.stop_writer(output_writer)
+    assert pd.read_csv(path).empty and len(pd.read_csv(path).columns) == 8
+
+    path = str(tmp_path / "cancelled.csv")
+    output_writer = writer.start_writer(path)
+    output_writer["queue"].put(make_block("rec", 5, np.random.default_rng(2)))
+    writer.stop_writer(output_writer, commit=False)
+    assert list(tmp_path.iterdir()) == [tmp_path / "output.csv"]
+
+""" Errors in the writer thread are raised when stopping it """
+def test_writer_raises_errors(tmp_path, monkeypatch):
+    monkeypatch.setattr(writer, "overlap_tidy", lambda df, threshold: 1 / 0)
+    output_writer = writer.start_writer(str(tmp_path / "output.csv"))
+    output_writer["queue"].put(make_block("rec", 5, np.random.default_rng(3)))
+
+    with pytest.raises(ZeroDivisionError):
+        writer.stop_writer(output_writer)
+
+""" Parquet and Arrow output have a row group or record batch per chunk, typed numbers and dictionary encoded names, with the same rows as csv """
+@pytest.mark.parametrize("output_format", ["parquet", "arrow"])
+def test_writer_columnar_output(tmp_path, output_format):
+    pa = pytest.importorskip("pyarrow")
+    rng = np.random.default_rng(4)
+    blocks = [make_block(f"rec_{i}", 20, rng) for i in range(7)]
+
+    for fmt in ["csv", output_format]:
+        output_writer = writer.start_writer(str(tmp_path / f"output.{fmt}"), write_every=3, output_format=writer.resolve_output_format(fmt))
+        for block in blocks:
+            output_writer["queue"].put(block)
+        writer.stop_writer(output_writer)
+
+    if output_format == "parquet":
+        pq = pytest.importorskip("pyarrow.parquet")
+        assert pq.ParquetFile(tmp_path / "output.parquet").metadata.num_row_groups == 3
+        table = pq.read_table(tmp_path / "output.parquet")
+    else:
+        batches = list(pa.ipc.open_stream(tmp_path / "output.arrow"))
+        assert len(batches) == 3
+        table = pa.Table.from_batches(batches)
+
+    assert pa.types.is_dictionary(table.schema.field("filepath").type)
+    assert table.schema.field("start_time_ms").type == pa.int32()
+    df = table.to_pandas()
+    pd.testing.assert_frame_equal(df, pd.read_csv(tmp_path / "output.csv"), check_dtype=False, check_categorical=False, atol=1e-7)
+
+""" Unknown output formats are refused before analysing """
+def test_resolve_output_format_unknown():
+    with pytest.raises(ValueError):
+        writer.resolve_output_format("xlsx")
+
+""" By default every recording is written and logged on its own when logging, and in chunks of 100 otherwise """
+@pytest.mark.parametrize("log_path, chunk_sizes", [(False, [100, 20]), (True, [1] * 120)])
+def test_writer_default_write_every(tmp_path, monkeypatch, log_path, chunk_sizes):
+    rng = np.random.default_rng(2)
+    chunks = []
+    monkeypatch.setattr(writer, "write_chunk", lambda write, blocks, headers, *args: chunks.append(len(headers)))
+    monkeypatch.setattr(writer.log, "start_output", lambda *args: None)
+
+    output_writer = writer.start_writer(str(tmp_path / "output.csv"), log_path=str(tmp_path) if log_path else False)
+    for i in range(120):
+        output_writer["queue"].put(make_block(f"rec_{i}", 2, rng))
+    writer.stop_writer(output_writer)
+
+    assert chunks == chunk_sizes